@@ -0,0 +1,68 @@
+"""Offline builder for the GPT answer index: turns logged (question, answer) pairs into answer_index.npz.
+
+The bot logs every standalone question and its GPT answer to bot_state.db.
+Run this (by hand or from cron) to rebuild the similarity index the bot
+answers near-duplicate questions from; a running bot picks up the new file
+within 30 minutes. Only the latest answer per question and scope (habit,
+streak range, group) is kept, and logged answers older than --max-age-days
+are deleted from the database.
+
+    python build_answer_index.py --max-age-days 30
+"""
+import argparse
+import datetime
+import os
+import random
+import time
+
+import mainv3wgpt as bot
+
+def cutoff_iso(max_age_days):
+    return (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=max_age_days)).isoformat(timespec="seconds")
+
+def prune_answers(db, max_age_days):
+    """Delete logged questions and answers older than the max age; they hold users' own words."""
+    with db:
+        return db.execute("DELETE FROM gpt_answers WHERE created_at < ?", (cutoff_iso(max_age_days),)).rowcount
+
+def load_pairs(db, max_age_days):
+    """Return [(question, partition, answer)], the latest answer per question in each partition."""
+    # Rows logged before the scope was recorded (NULL bucket) can't be placed in a partition
+    rows = db.execute(
+        "SELECT question, habit, bucket, group_name, answer FROM gpt_answers "
+        "WHERE created_at >= ? AND bucket IS NOT NULL ORDER BY id", (cutoff_iso(max_age_days),)
+    ).fetchall()
+    latest = {}
+    for question, habit, bucket, group, answer in rows:
+        partition = bot.answer_partition(habit, bucket, group or "")
+        latest[(bot.normalize_question(question), partition)] = (question, partition, answer)
+    return list(latest.values())
+
+def benchmark(index, pairs, samples=200):
+    picks = random.sample(pairs, min(samples, len(pairs)))
+    started = time.perf_counter()
+    found = sum(index.lookup(question, partition, bot.GPT_SIMILAR_THRESHOLD) is not None for question, partition, _ in picks)
+    elapsed = (time.perf_counter() - started) / max(1, len(picks))
+    print(f"Lookup: {elapsed * 1000:.2f}ms per question, {found}/{len(picks)} stored questions found again")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=bot.BOT_STATE_DB_PATH, help="bot state database with the gpt_answers log")
+    parser.add_argument("--output", default=bot.GPT_ANSWER_INDEX_PATH, help="index file to write")
+    parser.add_argument("--max-age-days", type=float, default=30, help="delete and ignore answers older than this")
+    args = parser.parse_args()
+
+    # Opened through BotStateStore so an older database gets the current gpt_answers columns
+    db = bot.BotStateStore(args.db).db()
+    print(f"Deleted {prune_answers(db, args.max_age_days)} answers older than {args.max_age_days:g} days")
+    pairs = load_pairs(db, args.max_age_days)
+    started = time.perf_counter()
+    index = bot.AnswerIndex.build(pairs)
+    print(f"Built index over {len(pairs)} pairs in {time.perf_counter() - started:.2f}s")
+    # Write next to the target and swap it in, so the bot never loads a half-written file
+    partial = f"{args.output}.partial"
+    index.save(partial)
+    os.replace(partial, args.output)
+    print(f"Wrote {args.output} ({os.path.getsize(args.output) / 1024 / 1024:.1f} MB)")
+    if pairs:
+        benchmark(index, pairs)
@@ -1,30 +1,37 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import base64
-
-# Write Google credentials file from base64 env variable if present
-creds_b64 = os.getenv("GOOGLE_CREDS_B64")
-if creds_b64:
-    with open("dopamine_bot_credentials.json", "wb") as f:
-        f.write(base64.b64decode(creds_b64))
-    print("[DEBUG] GOOGLE_CREDS_B64 present: True")
-else:
-    print("[DEBUG] GOOGLE_CREDS_B64 present: False")
-
-print("[DEBUG] File exists after write:", os.path.exists("dopamine_bot_credentials.json"))
-print("[DEBUG] Current working directory:", os.getcwd())
-
 import asyncio
+import bisect
+import collections
+import contextlib
 import datetime
+import hmac
+import importlib
+import json
+import random
+import re
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import gspread
-import openai
+import httpx
+import numpy as np
+from google.auth.exceptions import TransportError as GoogleAuthTransportError
 from google.oauth2.service_account import Credentials
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes,
-    CallbackQueryHandler, MessageHandler, filters
+    ApplicationBuilder, BasePersistence, BaseUpdateProcessor, CommandHandler, ContextTypes,
+    CallbackQueryHandler, MessageHandler, PersistenceInput, filters
 )
 from dotenv import load_dotenv
 load_dotenv()
@@ -45,7 +52,9 @@ SHEET_COLUMNS = {
     'MEDIA_TYPE': 9,
     'REMINDER_SENT': 10,
     'SHARED_MILESTONES': 11,
-    'FEEDBACK_COMPLETED': 12
+    'FEEDBACK_COMPLETED': 12,
+    'TIMEZONE': 13,
+    'CHECKIN_TIME': 14
 }
 
 # Error message constants
@@ -60,7 +69,6 @@ ERROR_MESSAGES = {
 
 # OpenAI API setup
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai.api_key = OPENAI_API_KEY
 
 # Timezone setup - PHT (Philippine Time)
 PHT_TIMEZONE = datetime.timezone(datetime.timedelta(hours=8))  # UTC+8
@@ -81,19 +89,1056 @@ def get_pht_timestamp():
 # If you see connection errors, check your network, DNS, VPN, or firewall settings.
 
 # ✅ Google Sheets setup
+# Nothing here touches the network at import time: the credentials file is
+# written, gspread authorized and each tab opened on first use, from the
+# Sheets thread pool.
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 CREDENTIALS_FILE = os.getenv('DOPAMINE_BOT_CREDENTIALS', "dopamine_bot_credentials.json")
-CREDS = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-gc = gspread.authorize(CREDS)
 SHEET_ID = "1Oif-d33v0tMImy2-PyppqFwT9H2DfsIimYlswD3QOfQ"
-worksheet = gc.open_by_key(SHEET_ID).sheet1
 
-# Feedback tab setup
-try:
-    feedback_sheet = gc.open_by_key(SHEET_ID).worksheet("Feedback")
-except Exception:
-    feedback_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Feedback", rows=1000, cols=10)
-    feedback_sheet.append_row(["user_id", "username", "milestone", "question", "answer", "timestamp", "permission"])
+# Blocking gspread calls run on a small dedicated pool so a slow Sheets
+# response never stalls the event loop
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT_SECONDS = float(os.getenv("SHEETS_CALL_TIMEOUT_SECONDS", "20"))
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+gc = None
+_client_lock = threading.Lock()
+
+def write_google_credentials():
+    """Write the service account file from the base64 GOOGLE_CREDS_B64 env variable, if present."""
+    creds_b64 = os.getenv("GOOGLE_CREDS_B64")
+    if creds_b64:
+        with open(CREDENTIALS_FILE, "wb") as f:
+            f.write(base64.b64decode(creds_b64))
+    print(f"[DEBUG] GOOGLE_CREDS_B64 present: {bool(creds_b64)}")
+    print("[DEBUG] Credentials file exists:", os.path.exists(CREDENTIALS_FILE))
+
+def get_sheets_client():
+    """Blocking: authorize gspread on first use and return the shared client."""
+    global gc
+    with _client_lock:
+        if gc is None:
+            write_google_credentials()
+            gc = gspread.authorize(Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES))
+            gc.set_timeout(SHEETS_CALL_TIMEOUT_SECONDS)
+        return gc
+
+class WorksheetRegistry:
+    """Opens the spreadsheet and each of its tabs once and hands out the cached handles.
+
+    Tabs are declared up front with their headers; a missing tab is created
+    with its header row the first time it is opened. Handles are only
+    re-opened after a Sheets API error on them (a tab renamed or deleted by
+    hand), so the metadata round trips stay off the hot path. All methods
+    are blocking and meant for the Sheets thread pool.
+    """
+
+    def __init__(self, sheet_id):
+        self.sheet_id = sheet_id
+        self._tabs = {}
+        self._handles = {}
+        self._spreadsheet = None
+        self._lock = threading.RLock()
+
+    def declare(self, name, title=None, headers=None, rows=1000, cols=10):
+        """Declare a tab by name; title None means the spreadsheet's first sheet."""
+        self._tabs[name] = {'title': title, 'headers': headers, 'rows': rows, 'cols': cols}
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = get_sheets_client().open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    def open(self, name):
+        """Return the worksheet handle for a declared tab, opening or creating it if needed."""
+        with self._lock:
+            if name in self._handles:
+                return self._handles[name]
+            tab = self._tabs[name]
+            spreadsheet = self.spreadsheet()
+            if tab['title'] is None:
+                sheet = spreadsheet.sheet1
+            else:
+                try:
+                    sheet = spreadsheet.worksheet(tab['title'])
+                except gspread.exceptions.WorksheetNotFound:
+                    print(f"[DEBUG] Creating missing {tab['title']} tab")
+                    sheet = spreadsheet.add_worksheet(title=tab['title'], rows=tab['rows'], cols=tab['cols'])
+                    if tab['headers']:
+                        sheet.append_row(tab['headers'])
+            self._handles[name] = sheet
+            return sheet
+
+    def open_all(self):
+        """Open every declared tab, creating the missing ones."""
+        for name in self._tabs:
+            self.open(name)
+
+    def invalidate(self, name):
+        """Drop a tab's handle (and the spreadsheet's) so the next open fetches fresh metadata."""
+        with self._lock:
+            self._handles.pop(name, None)
+            self._spreadsheet = None
+
+    @contextlib.contextmanager
+    def using(self, name):
+        """Yield a tab's handle; a Sheets API error invalidates it before propagating."""
+        sheet = self.open(name)
+        try:
+            yield sheet
+        except gspread.exceptions.APIError:
+            self.invalidate(name)
+            raise
+
+worksheets = WorksheetRegistry(SHEET_ID)
+worksheets.declare("users")
+worksheets.declare("checkins", "Daily Check-ins", ["user_id", "status", "timestamp"], cols=5)
+worksheets.declare("feedback", "Feedback", ["user_id", "username", "milestone", "question", "answer", "timestamp", "permission"])
+
+async def run_sheets_call(fn, *args, timeout=SHEETS_CALL_TIMEOUT_SECONDS):
+    """Run a blocking gspread call on the Sheets pool and wait at most timeout seconds."""
+    future = asyncio.get_running_loop().run_in_executor(sheets_executor, fn, *args)
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout=timeout)
+
+# Write-behind settings for Sheets mutations
+SHEETS_FLUSH_INTERVAL_SECONDS = float(os.getenv("SHEETS_FLUSH_INTERVAL_SECONDS", "2"))
+SHEETS_FLUSH_BATCH_SIZE = int(os.getenv("SHEETS_FLUSH_BATCH_SIZE", "100"))
+# A write that keeps failing with a transient error is given up on after this many attempts
+SHEETS_WRITE_MAX_ATTEMPTS = int(os.getenv("SHEETS_WRITE_MAX_ATTEMPTS", "8"))
+
+def is_transient_sheets_error(error):
+    """True for Sheets failures worth retrying: rate limits, server errors and network trouble."""
+    if isinstance(error, gspread.exceptions.APIError):
+        status = getattr(error.response, 'status_code', None) or error.code
+        return status == 429 or status >= 500
+    return isinstance(error, (OSError, GoogleAuthTransportError))
+
+class SheetWriteQueue:
+    """Write-behind queue for Google Sheets appends and cell updates.
+
+    Handlers queue their writes and return immediately. A background task
+    flushes them every SHEETS_FLUSH_INTERVAL_SECONDS, or as soon as
+    SHEETS_FLUSH_BATCH_SIZE writes are waiting, as one append_rows and one
+    batch_update per worksheet. Writes are flushed in the order they were
+    queued, so a user's rows never land out of order.
+
+    Each worksheet fails on its own. After a transient error (429, 5xx,
+    network) the sheet's writes go back to the front of the queue and that
+    sheet backs off; other sheets keep flushing. A write that is rejected
+    outright (any other 4xx) is retried on its own to find the bad one, and
+    writes that are rejected or run out of attempts are moved to the
+    unsent_sheet_writes table in bot_state instead of blocking the queue.
+    Writes still queued at shutdown are saved there too and re-queued on the
+    next start.
+    """
+
+    def __init__(self, flush_interval, batch_size, registry, max_attempts=SHEETS_WRITE_MAX_ATTEMPTS):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.registry = registry
+        self.max_attempts = max_attempts
+        self._ops = collections.deque()
+        self._inflight = []
+        self._lock = threading.Lock()        # guards _ops/_inflight
+        self._write_lock = threading.Lock()  # held while a batch is being written
+        self._flush_guard = None
+        self._wakeup = None
+        self._loop = None
+        self._task = None
+        self._sheet_failures = {}  # sheet -> consecutive failed flushes
+        self._retry_at = {}        # sheet -> monotonic time its writes may be retried
+        self.dead_lettered = 0
+
+    def _enqueue(self, op):
+        with self._lock:
+            self._ops.append(op)
+            full = len(self._ops) >= self.batch_size
+        if full and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def append_row(self, sheet, row):
+        self._enqueue({'sheet': sheet, 'kind': 'append', 'row': list(row)})
+
+    def update_cell(self, sheet, row, col, value):
+        self._enqueue({'sheet': sheet, 'kind': 'update', 'cell': (row, col), 'value': value})
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._inflight) + len(self._ops)
+
+    def pending(self, sheet):
+        """Return queued and in-flight writes for one sheet, oldest first."""
+        with self._lock:
+            return [op for op in self._inflight + list(self._ops) if op['sheet'] == sheet]
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Hold off flushes while a sheet is re-read and pending writes are overlaid on it."""
+        with self._write_lock:
+            yield
+
+    @staticmethod
+    def _write_ops(sheet, ops):
+        appends = [op for op in ops if op['kind'] == 'append']
+        if appends:
+            sheet.append_rows([op['row'] for op in appends])
+        updates = [op for op in ops if op['kind'] == 'update']
+        if updates:
+            cells = {}
+            for op in updates:
+                cells[op['cell']] = op['value']  # last write to a cell wins
+            sheet.batch_update([
+                {'range': gspread.utils.rowcol_to_a1(row, col), 'values': [[value]]}
+                for (row, col), value in cells.items()
+            ], raw=False)
+
+    def _write_group(self, sheet_name, ops):
+        """Write ops of one kind to a sheet. Returns (ops to retry, [(op, reason)] to give up on, transient error or None)."""
+        try:
+            with self.registry.using(sheet_name) as sheet:
+                self._write_ops(sheet, ops)
+            return [], [], None
+        except Exception as e:
+            error = e
+        if is_transient_sheets_error(error):
+            retry, dropped = [], []
+            for op in ops:
+                op['attempts'] = op.get('attempts', 0) + 1
+                if op['attempts'] >= self.max_attempts:
+                    dropped.append((op, f"gave up after {op['attempts']} attempts: {error}"))
+                else:
+                    retry.append(op)
+            return retry, dropped, error
+        if len(ops) == 1:
+            return [], [(ops[0], f"rejected: {error}")], None
+        # Rejected outright: write the ops one at a time so only the bad ones are dropped
+        retry, dropped = [], []
+        for i, op in enumerate(ops):
+            op_retry, op_dropped, transient = self._write_group(sheet_name, [op])
+            retry += op_retry
+            dropped += op_dropped
+            if transient is not None:
+                return retry + ops[i + 1:], dropped, transient
+        return retry, dropped, None
+
+    def _write_sheet(self, sheet_name, ops):
+        """Write one sheet's appends, then its cell updates; a transient failure leaves the rest for the retry."""
+        retry, dropped = [], []
+        for kind in ('append', 'update'):
+            group = [op for op in ops if op['kind'] == kind]
+            if not group:
+                continue
+            group_retry, group_dropped, error = self._write_group(sheet_name, group)
+            retry += group_retry
+            dropped += group_dropped
+            if error is not None:
+                later = [op for op in ops if op['kind'] == 'update'] if kind == 'append' else []
+                return retry + later, dropped, error
+        return retry, dropped, None
+
+    def _write_batch(self, batch):
+        """Write a batch sheet by sheet. Returns (ops written, [(op, reason)] given up on, {sheet: transient error})."""
+        written = set()
+        dropped = []
+        errors = {}
+        with self._write_lock:
+            try:
+                by_sheet = {}
+                for op in batch:
+                    by_sheet.setdefault(op['sheet'], []).append(op)
+                for sheet_name, ops in by_sheet.items():
+                    retry, sheet_dropped, error = self._write_sheet(sheet_name, ops)
+                    dropped += sheet_dropped
+                    if error is not None:
+                        errors[sheet_name] = error
+                    retried = {id(op) for op in retry}
+                    written.update(id(op) for op in ops if id(op) not in retried)
+            finally:
+                with self._lock:
+                    failed = [op for op in batch if id(op) not in written]
+                    self._ops.extendleft(reversed(failed))
+                    self._inflight = []
+        return len(written) - len(dropped), dropped, errors
+
+    def _take_ready(self):
+        # Sheets that are backing off keep their writes queued, in order, for a later flush
+        now = time.monotonic()
+        with self._lock:
+            batch = [op for op in self._ops if self._retry_at.get(op['sheet'], 0) <= now]
+            if len(batch) == len(self._ops):
+                self._ops.clear()
+            else:
+                taken = {id(op) for op in batch}
+                self._ops = collections.deque(op for op in self._ops if id(op) not in taken)
+            self._inflight = batch
+        return batch
+
+    async def flush(self):
+        """Write everything that is due. Returns False if writes are still waiting to be retried."""
+        if self._flush_guard is None:
+            self._flush_guard = asyncio.Lock()
+        async with self._flush_guard:
+            batch = self._take_ready()
+            if batch:
+                # No wait_for here: the batch owns the queue state until it finishes,
+                # and the HTTP timeout on gc bounds each request
+                written, dropped, errors = await run_sheets_call(self._write_batch, batch, timeout=None)
+                for sheet_name in {op['sheet'] for op in batch}:
+                    if sheet_name in errors:
+                        failures = self._sheet_failures.get(sheet_name, 0) + 1
+                        self._sheet_failures[sheet_name] = failures
+                        self._retry_at[sheet_name] = time.monotonic() + min(60, 2 ** failures)
+                        print(f"[ERROR] Writes to sheet {sheet_name} failed (attempt {failures}), will retry: {errors[sheet_name]}")
+                    else:
+                        self._sheet_failures.pop(sheet_name, None)
+                        self._retry_at.pop(sheet_name, None)
+                if dropped:
+                    self.dead_lettered += len(dropped)
+                    await self._save_unsent(dropped)
+                if written:
+                    print(f"[DEBUG] Flushed {written} queued sheet writes")
+            return self.pending_count() == 0
+
+    async def _save_unsent(self, dropped):
+        for op, reason in dropped:
+            print(f"[ERROR] Sheet write to {op['sheet']} not sent ({reason}): {op}")
+        try:
+            await bot_state.run(lambda: save_unsent_sheet_writes(bot_state.db(), dropped))
+        except Exception as e:
+            print(f"[ERROR] Could not save {len(dropped)} unsent sheet writes: {e}")
+
+    async def _restore_unsent(self):
+        try:
+            ops = await bot_state.run(lambda: take_shutdown_sheet_writes(bot_state.db()))
+        except Exception as e:
+            print(f"[ERROR] Could not read sheet writes saved at shutdown: {e}")
+            return
+        if ops:
+            with self._lock:
+                self._ops.extendleft(reversed(ops))
+            print(f"[DEBUG] Re-queued {len(ops)} sheet writes saved at the last shutdown")
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await self._restore_unsent()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[ERROR] Sheet write flush failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the background task and flush whatever is still queued; what can't be written is saved for the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for attempt in range(3):
+            self._retry_at.clear()
+            try:
+                if await self.flush():
+                    return
+            except Exception as e:
+                print(f"[ERROR] Sheet write flush failed on shutdown: {e}")
+            await asyncio.sleep(2 ** attempt)
+        with self._lock:
+            left = list(self._ops)
+            self._ops.clear()
+        counts = collections.Counter(op['sheet'] for op in left)
+        print(f"[ERROR] {len(left)} sheet writes could not be flushed on shutdown, saving them for the next start: {dict(counts)}")
+        await self._save_unsent([(op, "shutdown") for op in left])
+
+sheet_writes = SheetWriteQueue(SHEETS_FLUSH_INTERVAL_SECONDS, SHEETS_FLUSH_BATCH_SIZE, worksheets)
+
+# Users sheet headers in column order, as returned by get_all_records()
+USER_SHEET_HEADERS = [name.lower() for name, _ in sorted(SHEET_COLUMNS.items(), key=lambda item: item[1])]
+
+# How often (seconds) the user index re-reads the users sheet to pick up edits made by hand
+USER_INDEX_REFRESH_SECONDS = int(os.getenv("USER_INDEX_REFRESH_SECONDS", "300"))
+
+class UserIndex:
+    """Process-wide user_id -> (row number, record) index over the users sheet.
+
+    The sheet is read once and then kept current by the bot's own writes, so
+    looking up a user no longer downloads and scans every row. A full re-read
+    happens every USER_INDEX_REFRESH_SECONDS to pick up manual edits.
+    Refreshes run on the Sheets thread pool; lookups and writes run on the
+    event loop, so the swap is done under a lock.
+    """
+
+    def __init__(self, registry, refresh_seconds):
+        self.registry = registry
+        self.refresh_seconds = refresh_seconds
+        self._records = []
+        self._by_id = {}
+        self._loaded_at = None
+        self._headers_checked = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @staticmethod
+    def _record_from_values(values):
+        return {header: (values[i] if i < len(values) else "") for i, header in enumerate(USER_SHEET_HEADERS)}
+
+    def _ensure_headers(self):
+        # Columns added after the sheet was created get their header cell written
+        # once, before the first read, so get_all_records() returns them
+        with self.registry.using("users") as sheet:
+            header_row = sheet.row_values(1)
+            missing = [
+                {'range': gspread.utils.rowcol_to_a1(1, i + 1), 'values': [[header]]}
+                for i, header in enumerate(USER_SHEET_HEADERS)
+                if i >= len(header_row) or not header_row[i]
+            ]
+            if missing:
+                print(f"[DEBUG] Adding {len(missing)} missing headers to the users sheet")
+                sheet.batch_update(missing)
+        self._headers_checked = True
+
+    def refresh(self):
+        """Reload every user row from the sheet, keeping writes that are still queued."""
+        if not self._headers_checked:
+            self._ensure_headers()
+        with sheet_writes.paused():
+            with self.registry.using("users") as sheet:
+                records = sheet.get_all_records()
+            for record in records:
+                for header in USER_SHEET_HEADERS:
+                    record.setdefault(header, "")
+            with self._lock:
+                for op in sheet_writes.pending("users"):
+                    if op['kind'] == 'append':
+                        records.append(self._record_from_values(op['row']))
+                    else:
+                        row_number, col = op['cell']
+                        if 0 <= row_number - 2 < len(records):
+                            records[row_number - 2][USER_SHEET_HEADERS[col - 1]] = op['value']
+                by_id = {}
+                for i, row in enumerate(records):
+                    user_id = str(row.get('user_id', ''))
+                    if user_id and user_id not in by_id:
+                        by_id[user_id] = (i + 2, row)  # +2: header row and 1-based rows
+                self._records = records
+                self._by_id = by_id
+                self._loaded_at = time.monotonic()
+        print(f"[DEBUG] User index loaded {len(by_id)} users")
+
+    def is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return self.refresh_seconds > 0 and time.monotonic() - self._loaded_at > self.refresh_seconds
+
+    def ensure_fresh(self):
+        """Blocking: load or re-read the sheet if the index is missing or stale."""
+        with self._refresh_lock:
+            if not self.is_stale():
+                return
+            if self._loaded_at is None:
+                self.refresh()
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last known rows and try again in 30 seconds
+                print(f"[ERROR] Failed to refresh user index: {e}")
+                self._loaded_at = time.monotonic() - self.refresh_seconds + 30
+
+    def get(self, user_id):
+        """Return the user's record, or None if they are not in the sheet."""
+        entry = self._by_id.get(str(user_id))
+        return entry[1] if entry else None
+
+    def records(self):
+        """Return all user rows in sheet order."""
+        return list(self._records)
+
+    def update_field(self, user_id, column, value):
+        """Queue a write of one SHEET_COLUMNS field and keep the index in step."""
+        with self._lock:
+            entry = self._by_id.get(str(user_id))
+            if not entry:
+                return False
+            row_number, record = entry
+            sheet_writes.update_cell("users", row_number, SHEET_COLUMNS[column], value)
+            record[column.lower()] = value
+            return True
+
+    def append_user(self, values):
+        """Queue a new user row and register it in the index."""
+        with self._lock:
+            sheet_writes.append_row("users", values)
+            record = self._record_from_values(values)
+            self._records.append(record)
+            self._by_id.setdefault(str(record['user_id']), (len(self._records) + 1, record))
+
+user_index = UserIndex(worksheets, USER_INDEX_REFRESH_SECONDS)
+
+def read_checkin_history():
+    """Blocking: every row of the Daily Check-ins tab."""
+    with worksheets.using("checkins") as sheet:
+        return sheet.get_all_records()
+
+class StreakEngine:
+    """Per-user streak counters kept up to date as check-ins are written.
+
+    The Daily Check-ins history is read once on cold start; after that every
+    check-in the bot writes updates the counters in O(1), so nobody has to
+    walk the full log to find a user's current streak.
+    """
+
+    def __init__(self):
+        self._state = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @staticmethod
+    def empty_state():
+        return {
+            'current_streak': 0,
+            'last_status': '',
+            'consecutive_no': 0,
+            'last_checkin_date': '',
+        }
+
+    def _apply(self, user_id, status, timestamp):
+        state = self._state.setdefault(str(user_id), self.empty_state())
+        if status == "yes":
+            state['current_streak'] += 1
+            state['consecutive_no'] = 0
+        elif status == "no":
+            state['current_streak'] = 0
+            state['consecutive_no'] += 1
+        else:
+            # "reset" (stop, restart, onboarding) or anything else breaks both runs
+            state['current_streak'] = 0
+            state['consecutive_no'] = 0
+        state['last_status'] = status
+        state['last_checkin_date'] = str(timestamp)[:10]
+
+    def rebuild(self, history):
+        """Recompute every user's counters from the full check-in log."""
+        with self._lock:
+            self._state = {}
+            for entry in history:
+                if entry.get("user_id", "") != "":
+                    self._apply(entry.get("user_id"), entry.get("status", ""), entry.get("timestamp", ""))
+            self.loaded = True
+        print(f"[DEBUG] Streak engine rebuilt for {len(self._state)} users")
+
+    def ensure_loaded(self):
+        """Blocking: read the check-in log once if it has not been loaded yet."""
+        with self._load_lock:
+            if self.loaded:
+                return
+            with sheet_writes.paused():
+                history = read_checkin_history()
+                history += [
+                    {"user_id": op['row'][0], "status": op['row'][1], "timestamp": op['row'][2]}
+                    for op in sheet_writes.pending("checkins") if op['kind'] == 'append'
+                ]
+                self.rebuild(history)
+
+    def record(self, user_id, status, timestamp):
+        """Apply one newly written check-in row."""
+        with self._lock:
+            if self.loaded:
+                self._apply(user_id, status, timestamp)
+
+    def get(self, user_id):
+        """Return a copy of the user's counters (zeros if the log isn't loaded)."""
+        return dict(self._state.get(str(user_id), self.empty_state()))
+
+streaks = StreakEngine()
+
+# How long (seconds) a user's GPT context is reused before it is rebuilt
+USER_CONTEXT_TTL_SECONDS = float(os.getenv("USER_CONTEXT_TTL_SECONDS", "600"))
+
+class UserContextCache:
+    """TTL cache of the {fasting_target, current_streak, group} context sent to GPT.
+
+    Storage writes that change a user's profile or streak (check-ins, stop,
+    reset, onboarding) invalidate the entry, so the TTL only bounds how long
+    hand edits in the Sheet take to show up.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, user_id):
+        entry = self._entries.get(str(user_id))
+        if entry is None:
+            return None
+        expires, context = entry
+        if time.monotonic() >= expires:
+            self._entries.pop(str(user_id), None)
+            return None
+        return dict(context)
+
+    def put(self, user_id, context):
+        self._entries[str(user_id)] = (time.monotonic() + self.ttl, dict(context))
+
+    def invalidate(self, user_id):
+        self._entries.pop(str(user_id), None)
+
+user_contexts = UserContextCache(USER_CONTEXT_TTL_SECONDS)
+
+class SheetsStorage:
+    """Async storage adapter over Google Sheets.
+
+    Handlers await these methods instead of calling gspread directly. Reads
+    are answered from the user index and streak engine; when those need the
+    network (cold start, periodic refresh) the blocking call runs on the
+    Sheets thread pool with a per-call timeout. Writes go through the
+    write-behind queue, so none of these methods block the event loop.
+    """
+
+    def __init__(self, index, streak_engine, writes):
+        self.index = index
+        self.streaks = streak_engine
+        self.writes = writes
+
+    async def _ensure_index(self):
+        if self.index.is_stale():
+            await run_sheets_call(self.index.ensure_fresh)
+
+    async def load_streaks(self):
+        """Make sure the streak engine has read the check-in log."""
+        if not self.streaks.loaded:
+            await run_sheets_call(self.streaks.ensure_loaded)
+
+    async def get_user(self, user_id):
+        await self._ensure_index()
+        return self.index.get(user_id)
+
+    async def list_users(self):
+        await self._ensure_index()
+        return self.index.records()
+
+    async def update_user_fields(self, user_id, fields):
+        """Update several SHEET_COLUMNS fields for one user. Returns False if the user is unknown."""
+        await self._ensure_index()
+        updated = False
+        for column, value in fields.items():
+            updated = self.index.update_field(user_id, column, value) or updated
+        user_contexts.invalidate(user_id)
+        return updated
+
+    async def upsert_user(self, user_id, fields):
+        """Update an existing user's fields, or append a new user row built from them."""
+        if await self.update_user_fields(user_id, fields):
+            return
+        values = {'USER_ID': str(user_id)}
+        values.update(fields)
+        row = [values.get(name, "") for name, _ in sorted(SHEET_COLUMNS.items(), key=lambda item: item[1])]
+        self.index.append_user(row)
+        user_contexts.invalidate(user_id)
+
+    async def get_streak(self, user_id):
+        await self.load_streaks()
+        return self.streaks.get(user_id)
+
+    async def append_checkin(self, user_id, status, timestamp=None):
+        """Queue a row for Daily Check-ins and update the user's streak counters."""
+        await self.load_streaks()
+        timestamp = timestamp or get_pht_timestamp()
+        self.writes.append_row("checkins", [user_id, status, timestamp])
+        self.streaks.record(user_id, status, timestamp)
+        user_contexts.invalidate(user_id)
+        return timestamp
+
+    async def append_feedback(self, row):
+        self.writes.append_row("feedback", row)
+
+    async def warm_up(self):
+        """Open every tab and load the user index and streak counters ahead of the first request."""
+        await run_sheets_call(worksheets.open_all)
+        await asyncio.gather(self._ensure_index(), self.load_streaks())
+
+    async def start(self):
+        self.writes.start()
+
+    async def stop(self):
+        await self.writes.stop()
+
+# Storage backend: "sheets" (Google Sheets is the system of record) or
+# "sqlite" (local database, with the Sheet kept as a mirror for the ops team)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets").lower()
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "dopamine_bot.db")
+SQLITE_MIRROR_TO_SHEETS = os.getenv("SQLITE_MIRROR_TO_SHEETS", "1") == "1"
+SQLITE_REPLICATION_INTERVAL_SECONDS = float(os.getenv("SQLITE_REPLICATION_INTERVAL_SECONDS", "5"))
+SQLITE_REPLICATION_BATCH_SIZE = int(os.getenv("SQLITE_REPLICATION_BATCH_SIZE", "500"))
+# An empty database must be seeded from the Sheet before the bot serves from it; startup fails after this many tries
+SQLITE_SEED_ATTEMPTS = int(os.getenv("SQLITE_SEED_ATTEMPTS", "5"))
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT DEFAULT '',
+    detox_days TEXT DEFAULT '',
+    fasting_target TEXT DEFAULT '',
+    "group" TEXT DEFAULT '',
+    status TEXT DEFAULT '',
+    reminder TEXT DEFAULT '',
+    media_id TEXT DEFAULT '',
+    media_type TEXT DEFAULT '',
+    reminder_sent TEXT DEFAULT '',
+    shared_milestones TEXT DEFAULT '',
+    feedback_completed TEXT DEFAULT '',
+    timezone TEXT DEFAULT '',
+    checkin_time TEXT DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS checkins (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_checkins_user_ts ON checkins (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_checkins_ts ON checkins (timestamp);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT,
+    username TEXT,
+    milestone TEXT,
+    question TEXT,
+    answer TEXT,
+    timestamp TEXT,
+    permission TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_feedback_user_ts ON feedback (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_feedback_ts ON feedback (timestamp);
+CREATE TABLE IF NOT EXISTS sheet_outbox (
+    id INTEGER PRIMARY KEY,
+    sheet TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+class SqliteStorage:
+    """Local SQLite storage backend with the Google Sheet as an async mirror.
+
+    Users, check-ins and feedback live in SQLite, so hot-path reads and writes
+    take microseconds and never touch the Sheets quota. Every write also
+    lands in a sheet_outbox table in the same transaction; a background
+    replicator drains the outbox in order into the mirror SheetsStorage,
+    which keeps the existing SHEET_ID spreadsheet up to date for the ops
+    team. An empty database is seeded from the Sheet on first start, retried
+    with backoff; if that keeps failing, start() raises rather than serve
+    (and replicate) an empty user list. With mirror=None the backend runs
+    fully offline.
+    """
+
+    def __init__(self, path, mirror=None, replication_interval=5, replication_batch_size=500, seed_attempts=SQLITE_SEED_ATTEMPTS):
+        self.path = path
+        self.mirror = mirror
+        self.replication_interval = replication_interval
+        self.replication_batch_size = replication_batch_size
+        self.seed_attempts = seed_attempts
+        self.streaks = StreakEngine()
+        self._conn = None
+        # One worker thread owns the connection, which also serializes access
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._task = None
+        self._fed_upto = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SQLITE_SCHEMA)
+            # Databases created before a column was added to SHEET_COLUMNS get it here
+            existing = {row['name'] for row in self._conn.execute("PRAGMA table_info(users)")}
+            for header in USER_SHEET_HEADERS:
+                if header not in existing:
+                    self._conn.execute(f'ALTER TABLE users ADD COLUMN "{header}" TEXT DEFAULT \'\'')
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @staticmethod
+    def _user_record(row):
+        return {header: row[header] for header in USER_SHEET_HEADERS}
+
+    # --- blocking helpers (run on the sqlite thread) ---
+
+    def _get_user(self, user_id):
+        row = self._db().execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self._user_record(row) if row else None
+
+    def _list_users(self):
+        rows = self._db().execute("SELECT * FROM users ORDER BY rowid").fetchall()
+        return [self._user_record(row) for row in rows]
+
+    def _outbox(self, db, sheet, kind, payload):
+        if self.mirror is None:
+            return
+        db.execute("INSERT INTO sheet_outbox (sheet, kind, payload) VALUES (?, ?, ?)", (sheet, kind, json.dumps(payload)))
+
+    def _update_user_fields(self, user_id, fields):
+        db = self._db()
+        assignments = ", ".join(f'"{column.lower()}" = ?' for column in fields)
+        with db:
+            cursor = db.execute(
+                f"UPDATE users SET {assignments} WHERE user_id = ?",
+                [str(value) for value in fields.values()] + [str(user_id)]
+            )
+            if cursor.rowcount == 0:
+                return False
+            row = self._get_user(user_id)
+            self._outbox(db, "users", "update", {
+                'user_id': str(user_id),
+                'fields': {column: str(value) for column, value in fields.items()},
+                'row': {column.upper(): value for column, value in row.items()},
+            })
+        return True
+
+    def _upsert_user(self, user_id, fields):
+        db = self._db()
+        values = {'USER_ID': str(user_id)}
+        values.update({column: str(value) for column, value in fields.items()})
+        columns = ", ".join(f'"{column.lower()}"' for column in values)
+        placeholders = ", ".join("?" for _ in values)
+        updates = ", ".join(f'"{column.lower()}" = excluded."{column.lower()}"' for column in values if column != 'USER_ID')
+        with db:
+            db.execute(
+                f"INSERT INTO users ({columns}) VALUES ({placeholders}) ON CONFLICT(user_id) DO UPDATE SET {updates}",
+                list(values.values())
+            )
+            row = self._get_user(user_id)
+            self._outbox(db, "users", "upsert", {
+                'user_id': str(user_id),
+                'fields': {column: value for column, value in values.items() if column != 'USER_ID'},
+                'row': {column.upper(): value for column, value in row.items()},
+            })
+
+    def _append_checkin(self, row):
+        db = self._db()
+        with db:
+            db.execute("INSERT INTO checkins (user_id, status, timestamp) VALUES (?, ?, ?)", [str(value) for value in row])
+            self._outbox(db, "checkins", "append", [str(value) for value in row])
+
+    def _append_feedback(self, row):
+        db = self._db()
+        values = [str(value) for value in row] + [""] * (7 - len(row))
+        with db:
+            db.execute(
+                "INSERT INTO feedback (user_id, username, milestone, question, answer, timestamp, permission) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                values[:7]
+            )
+            self._outbox(db, "feedback", "append", list(row))
+
+    def _load_checkins(self):
+        rows = self._db().execute("SELECT user_id, status, timestamp FROM checkins ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def _is_empty(self):
+        return self._db().execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    def _seed(self, users, history):
+        db = self._db()
+        with db:
+            for record in users:
+                user_id = str(record.get('user_id', ''))
+                if not user_id:
+                    continue
+                values = [user_id] + [str(record.get(header, "")) for header in USER_SHEET_HEADERS[1:]]
+                columns = ", ".join(f'"{header}"' for header in USER_SHEET_HEADERS)
+                db.execute(f"INSERT OR IGNORE INTO users ({columns}) VALUES ({', '.join('?' for _ in values)})", values)
+            db.executemany(
+                "INSERT INTO checkins (user_id, status, timestamp) VALUES (?, ?, ?)",
+                [(str(r.get("user_id", "")), str(r.get("status", "")), str(r.get("timestamp", ""))) for r in history if r.get("user_id", "") != ""]
+            )
+
+    def _read_outbox(self, limit):
+        rows = self._db().execute("SELECT id, sheet, kind, payload FROM sheet_outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(row['id'], row['sheet'], row['kind'], json.loads(row['payload'])) for row in rows]
+
+    def _delete_outbox(self, upto_id):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM sheet_outbox WHERE id <= ?", (upto_id,))
+
+    # --- async storage interface (same as SheetsStorage) ---
+
+    async def get_user(self, user_id):
+        return await self._run(self._get_user, user_id)
+
+    async def list_users(self):
+        return await self._run(self._list_users)
+
+    async def update_user_fields(self, user_id, fields):
+        updated = await self._run(self._update_user_fields, user_id, fields)
+        user_contexts.invalidate(user_id)
+        return updated
+
+    async def upsert_user(self, user_id, fields):
+        await self._run(self._upsert_user, user_id, fields)
+        user_contexts.invalidate(user_id)
+
+    async def load_streaks(self):
+        if not self.streaks.loaded:
+            self.streaks.rebuild(await self._run(self._load_checkins))
+
+    async def get_streak(self, user_id):
+        await self.load_streaks()
+        return self.streaks.get(user_id)
+
+    async def append_checkin(self, user_id, status, timestamp=None):
+        await self.load_streaks()
+        timestamp = timestamp or get_pht_timestamp()
+        await self._run(self._append_checkin, [user_id, status, timestamp])
+        self.streaks.record(user_id, status, timestamp)
+        user_contexts.invalidate(user_id)
+        return timestamp
+
+    async def append_feedback(self, row):
+        await self._run(self._append_feedback, row)
+
+    async def warm_up(self):
+        """Everything is read from the local database; there is nothing to preload."""
+
+    # --- replication to the Sheet ---
+
+    async def _seed_from_mirror(self):
+        if not await self._run(self._is_empty):
+            return
+        print("[DEBUG] SQLite store is empty, seeding users and check-ins from Google Sheets")
+        users = await self.mirror.list_users()
+        history = await run_sheets_call(read_checkin_history)
+        await self._run(self._seed, users, history)
+        print(f"[DEBUG] Seeded {len(users)} users and {len(history)} check-ins into SQLite")
+
+    async def _seed_with_retries(self):
+        for attempt in range(1, self.seed_attempts + 1):
+            try:
+                await self._seed_from_mirror()
+                return
+            except Exception as e:
+                if attempt == self.seed_attempts:
+                    raise RuntimeError(f"Could not seed the empty SQLite store from Google Sheets after {attempt} attempts: {e}") from e
+                delay = min(60, 2 ** attempt)
+                print(f"[ERROR] Seeding SQLite from Google Sheets failed (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def _apply_to_mirror(self, sheet, kind, payload):
+        if sheet == "users":
+            if not await self.mirror.update_user_fields(payload['user_id'], payload['fields']):
+                await self.mirror.upsert_user(payload['user_id'], {
+                    column: value for column, value in payload['row'].items() if column != 'USER_ID'
+                })
+        else:
+            self.mirror.writes.append_row(sheet, payload)
+
+    async def replicate_once(self):
+        """Push the next batch of outbox rows to the Sheet. Returns True once they are written."""
+        # Only feed a new batch once the previous one has been flushed
+        if self.mirror.writes.pending_count() == 0:
+            for outbox_id, sheet, kind, payload in await self._run(self._read_outbox, self.replication_batch_size):
+                await self._apply_to_mirror(sheet, kind, payload)
+                self._fed_upto = outbox_id
+        if not await self.mirror.writes.flush():
+            return False
+        if self._fed_upto is not None:
+            await self._run(self._delete_outbox, self._fed_upto)
+            self._fed_upto = None
+        return True
+
+    async def _replicate_forever(self):
+        failures = 0
+        while True:
+            try:
+                ok = await self.replicate_once()
+            except Exception as e:
+                print(f"[ERROR] Sheet replication failed: {e}")
+                ok = False
+            failures = 0 if ok else failures + 1
+            await asyncio.sleep(self.replication_interval if ok else min(60, self.replication_interval * 2 ** failures))
+
+    async def start(self):
+        await self._run(self._db)
+        if self.mirror is not None:
+            await self._seed_with_retries()
+            self._task = asyncio.create_task(self._replicate_forever())
+        print(f"[DEBUG] SQLite storage ready at {self.path} (mirror to Sheets: {self.mirror is not None})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            try:
+                await self.replicate_once()
+            except Exception as e:
+                print(f"[ERROR] Final Sheet replication failed, outbox kept for next start: {e}")
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+sheets_storage = SheetsStorage(user_index, streaks, sheet_writes)
+if STORAGE_BACKEND == "sqlite":
+    storage = SqliteStorage(
+        SQLITE_DB_PATH,
+        mirror=sheets_storage if SQLITE_MIRROR_TO_SHEETS else None,
+        replication_interval=SQLITE_REPLICATION_INTERVAL_SECONDS,
+        replication_batch_size=SQLITE_REPLICATION_BATCH_SIZE,
+        seed_attempts=SQLITE_SEED_ATTEMPTS
+    )
+else:
+    storage = sheets_storage
+print(f"[DEBUG] Storage backend: {STORAGE_BACKEND}")
+
+async def get_user_context(user_id):
+    """Return the user's GPT context, from the cache when possible."""
+    user_context = user_contexts.get(user_id)
+    if user_context is not None:
+        return user_context
+    user_data = await storage.get_user(user_id)
+    if not user_data:
+        print("[DEBUG] User not found in system, using default context")
+        return {
+            'fasting_target': 'Unknown',
+            'current_streak': 0,
+            'group': 'None'
+        }
+    # Get current streak
+    try:
+        current_streak = (await storage.get_streak(user_id))['current_streak']
+    except Exception as e:
+        print(f"[DEBUG] Error getting check-in history: {e}")
+        return {
+            'fasting_target': user_data.get('fasting_target', 'Unknown'),
+            'current_streak': 0,
+            'group': user_data.get('group', 'None')
+        }
+    user_context = {
+        'fasting_target': user_data.get('fasting_target', 'Unknown'),
+        'current_streak': current_streak,
+        'group': user_data.get('group', 'None')
+    }
+    user_contexts.put(user_id, user_context)
+    return user_context
 
 # Milestone streaks to trigger feedback
 MILESTONE_DAYS = [1, 7, 14, 30, 60, 90]
@@ -279,7 +1324,6 @@ async def handle_welcome_start(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
 MEDIA_DIR = "user_commitments"
-os.makedirs(MEDIA_DIR, exist_ok=True)
 
 # Group prompts database
 GROUP_PROMPTS = {
@@ -435,13 +1479,11 @@ GROUP_PROMPTS = {
     }
 }
 
-# Group prompt tracking - store current prompt index for each group
-GROUP_PROMPT_INDEX = {
-    "General": 0,
-    "NoFap": 0,
-    "ScreenBreak": 0,
-    "GameBreak": 0,
-    "Moneytalk": 0
+# Prompt rotation, built once: (prompts, count) per group and kind ("text" or "polls").
+# The position of each rotation is stored in the bot state database so it survives restarts.
+GROUP_PROMPT_ROTATION = {
+    group_key: {kind: (tuple(prompts), len(prompts)) for kind, prompts in kinds.items()}
+    for group_key, kinds in GROUP_PROMPTS.items()
 }
 
 # ✅ Helper to get latest detox entry per user
@@ -475,124 +1517,1237 @@ def get_file_extension(media_type):
     }
     return extensions.get(media_type, '.ogg')
 
-async def get_chatgpt_response(user_question, user_context):
-    print(f"[DEBUG] get_chatgpt_response called with question: {user_question} and context: {user_context}")
-    if not OPENAI_API_KEY:
-        print("[DEBUG] OPENAI_API_KEY not set")
-        return "I'm sorry, I'm not able to provide personalized advice right now. Please try again later."
-    try:
-        # Build context-aware prompt
-        habit_target = user_context.get('fasting_target', 'their habit')
-        current_streak = user_context.get('current_streak', 0)
-        group = user_context.get('group', 'None')
-        system_prompt = f"""You are a supportive friend and accountability partner helping with habit transformation. Be warm, conversational, and personal - like talking to a friend, not reading from a textbook. You have deep knowledge of neuroscience, psychology, and consciousness.
+# Shared OpenAI client: one pooled, keep-alive HTTP connection pool for every
+# completion, with a cap on how many completions are in flight at once
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "10"))
+openai_client = None
+openai_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
 
-User Context:
-- They are trying to break the habit of: {habit_target}
-- Current streak: {current_streak} days
-- Accountability group: {group}
+def get_openai_client():
+    """Return the shared AsyncOpenAI client, creating it on first use."""
+    global openai_client
+    if openai_client is None:
+        import openai  # imported on first use (or by warm_up_openai): it is the slowest import here
+        openai_client = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_SECONDS
+                ),
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+        )
+        print(f"[DEBUG] Created shared OpenAI client (max {OPENAI_MAX_CONNECTIONS} connections, {OPENAI_MAX_CONCURRENCY} concurrent completions)")
+    return openai_client
 
-Guidelines:
-- Talk like a real person having a conversation, not a chatbot
-- Give specific, actionable advice tailored to their situation
-- Use their name or refer to their specific habit when possible
-- Be encouraging and celebrate their progress
-- Only end conversations when the user explicitly says goodbye, thanks, or indicates they're done
-- If the user asks something outside of habit change, motivation, or wellness, admit it's outside your expertise and do NOT try to answer
-- Avoid generic lists and bullet points unless specifically asked
-- Use natural language and conversational tone
-- Focus on helping with their specific habit: {habit_target}
-- Be conversational and engaging - ask follow-up questions when appropriate
-- NEVER share personal stories, experiences, or anecdotes about yourself
-- NEVER pretend to have personal experiences or memories
-- Use general examples and research-based insights instead of personal stories
-- Ask follow-up questions to keep the conversation flowing
-- AVOID repetitive greetings like "Hey there!", "Hello!", or "Hi!" - jump straight into the conversation
-- Vary your conversation starters - don't use the same greeting patterns repeatedly
-- Be natural and authentic in your responses
+async def close_openai_client():
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
 
-Deep Knowledge Areas (use when relevant):
-🧠 **Dopamine Neuroscience**: Explain how dopamine works, reward pathways, tolerance, and how to reset your brain's reward system
-🎯 **Purpose & Meaning**: Help users connect their habit change to deeper purpose, values, and life vision
-🌑 **Shadow Work**: Guide users to explore the unconscious patterns, fears, and wounds driving their habits
-⚡ **Energy & Desire Transmutation**: Teach how to redirect addictive energy into creative, productive, and spiritual pursuits
-🧘 **Awareness & Mindfulness**: Help develop present-moment awareness and conscious choice-making
-🔄 **Subconscious Reprogramming**: Explain how to rewire neural pathways and change limiting beliefs
-😌 **Parasympathetic vs Sympathetic**: Teach nervous system regulation and stress management
-💫 **Consciousness & Higher Self**: Guide users toward their authentic self beyond ego and conditioning
+GPT_NOT_CONFIGURED_REPLY = "I'm sorry, I'm not able to provide personalized advice right now. Please try again later."
+GPT_TIMEOUT_REPLY = "I'm having trouble connecting to my advice system right now (timeout). Try asking me again in a moment!"
+GPT_ERROR_REPLY = "I'm having trouble connecting to my advice system right now. Try asking me again in a moment!"
+GPT_BUSY_REPLY = "💭 I'm thinking, one moment..."
+GPT_QUEUE_TIMEOUT_REPLY = "Lots of people are talking to me right now 🙏 Please send that again in a minute!"
 
-Response Style Examples:
-❌ DON'T: "Hey there! When I was trying to quit [habit], I found that..." (fictional personal story + repetitive greeting)
-❌ DON'T: "Hello! I remember when I used to..." (fictional personal memory + repetitive greeting)
-✅ DO: "Your brain has literally rewired itself around [habit]. Every time you do it, you're strengthening neural pathways that make it harder to resist next time. But here's the thing - your brain is also plastic. Every time you choose NOT to [habit], you're weakening those pathways and building new ones. What's one situation where you can practice this rewiring today?"
+# Admission control for advice-chat completions: at most GPT_MAX_CONCURRENCY
+# run at once, each user has at most one request, and waiting requests are
+# admitted round-robin across accountability groups
+GPT_MAX_CONCURRENCY = int(os.getenv("GPT_MAX_CONCURRENCY", str(OPENAI_MAX_CONCURRENCY)))
+GPT_BUSY_QUEUE_DEPTH = int(os.getenv("GPT_BUSY_QUEUE_DEPTH", "8"))
+GPT_QUEUE_TIMEOUT_SECONDS = float(os.getenv("GPT_QUEUE_TIMEOUT_SECONDS", "45"))
 
-❌ DON'T: "Hey there! I've found that starting super small works best..." (fictional personal experience + repetitive greeting)
-✅ DO: "Your nervous system is constantly scanning for threats and rewards. When you're stressed (sympathetic mode), your brain craves quick dopamine hits. But when you're in parasympathetic mode - calm, centered, present - you can make conscious choices instead of reacting. What's one way you can activate your parasympathetic nervous system before making a choice about [habit]?"
+class GptSuperseded(Exception):
+    """A newer message from the same user replaced this request before it started."""
 
-❌ DON'T: "Here are 5 steps to create better habits: 1. Identify triggers 2. Set goals 3. Track progress..."
-✅ DO: "Behind every habit is a shadow - an unconscious pattern, fear, or wound you're trying to soothe. Your [habit] isn't just about the behavior; it's about what you're running from or trying to fill. What emotion or situation usually triggers your [habit]? That's where the real work begins."
+class GptQueueTimeout(Exception):
+    """The request waited longer than GPT_QUEUE_TIMEOUT_SECONDS for a slot."""
 
-Deep Insights to Share:
-- "Your dopamine system is like a muscle - the more you use it for cheap hits, the weaker it gets for real rewards"
-- "Every urge is energy that can be transmuted. That craving for [habit]? That's pure creative energy waiting to be redirected"
-- "Your subconscious mind runs 95% of your behavior. The key isn't willpower - it's reprogramming the deeper patterns"
-- "Stress puts you in fight-or-flight mode, making you crave quick dopamine. Calm puts you in rest-and-digest mode, where conscious choice is possible"
-- "Your shadow - the parts of yourself you reject - often drives your most destructive habits. Integration, not suppression, is the path"
-- "Awareness is the first step. When you can observe your urges without acting on them, you're no longer a slave to them"
-- "Purpose is the ultimate dopamine hack. When you're connected to something bigger than yourself, cheap dopamine loses its power"
-"""
-        greetings = ["hi", "hello", "kamusta", "hey", "yo", "sup", "kumusta", "good morning", "good afternoon", "good evening"]
-        closing_phrases = ["thanks", "thank you", "ty", "thx", "that's all", "im good", "i'm good", "bye", "see you", "talk later", "done", "no more", "that's it", "alright"]
-        user_message = user_question.strip().lower()
-        
-        # Only end conversation if user explicitly uses closing phrases
-        # Don't end just because message is short
-        if any(phrase in user_message for phrase in closing_phrases):
-            return "👍 No problem! If you need anything else, just message me anytime. Have a great day!"
-        
-        # Dynamic response length
-        if len(user_message.split()) <= 4 or any(greet in user_message for greet in greetings):
-            max_tokens = 120  # Short, friendly reply
+class GptAdmission:
+    """Admission controller for advice-chat GPT calls.
+
+    slot() waits until one of `capacity` slots is free. Each user has at
+    most one waiting request: a newer one (or supersede(), called when a
+    newer message arrives) makes the older raise GptSuperseded, so the bot
+    answers what the user said last. Waiting requests sit in one queue per
+    lane (the user's group) and lanes take turns, so a burst from one group
+    post doesn't starve everyone else. A request that waits more than
+    timeout seconds raises GptQueueTimeout instead of piling up.
+    """
+
+    def __init__(self, capacity, busy_depth):
+        self.capacity = capacity
+        self.busy_depth = busy_depth
+        self.running = 0
+        self._lanes = collections.OrderedDict()  # lane -> deque of (user_id, future)
+        self._waiting = {}                       # user_id -> future
+        self.admitted = 0
+        self.superseded = 0
+        self.timed_out = 0
+        self.max_waiting = 0
+
+    def waiting(self):
+        return len(self._waiting)
+
+    def supersede(self, user_id):
+        """Drop the user's waiting request, if any, in favour of a newer message."""
+        future = self._waiting.pop(str(user_id), None)
+        if future is not None and not future.done():
+            future.set_exception(GptSuperseded())
+            self.superseded += 1
+
+    def _enqueue(self, user_id, lane):
+        self.supersede(user_id)
+        future = asyncio.get_running_loop().create_future()
+        if self.running < self.capacity and not self._waiting:
+            self._start(future)
         else:
-            max_tokens = min(500, max(120, len(user_message.split()) * 4))  # More conversational responses
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        print(f"[DEBUG] Sending request to OpenAI API with max_tokens={max_tokens}...")
-        def do_openai_call():
-            return client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_question}
-                ],
-                max_tokens=max_tokens,
-                temperature=0.7
-            )
-        try:
-            response = await asyncio.wait_for(
-                asyncio.to_thread(do_openai_call),
-                timeout=10  # seconds
-            )
-        except asyncio.TimeoutError:
-            print("[ERROR] ChatGPT API timed out")
-            return "I'm having trouble connecting to my advice system right now (timeout). Try asking me again in a moment!"
-        print("[DEBUG] Received response from OpenAI API")
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"[ERROR] ChatGPT API error: {e}")
-        return "I'm having trouble connecting to my advice system right now. Try asking me again in a moment!"
+            self._lanes.setdefault(lane, collections.deque()).append((user_id, future))
+            self._waiting[user_id] = future
+            self.max_waiting = max(self.max_waiting, len(self._waiting))
+        return future
 
-# ✅ Daily check-in sender with 3-day miss check
-async def send_daily_checkins(app):
-    print("[DEBUG] send_daily_checkins called")
+    def _start(self, future):
+        self.running += 1
+        self.admitted += 1
+        future.set_result(None)
+
+    def _release(self):
+        self.running -= 1
+        while self.running < self.capacity and self._lanes:
+            lane, queue = next(iter(self._lanes.items()))
+            user_id, future = queue.popleft()
+            if queue:
+                self._lanes.move_to_end(lane)
+            else:
+                del self._lanes[lane]
+            if future.done():
+                continue  # superseded or given up while waiting
+            if self._waiting.get(user_id) is future:
+                del self._waiting[user_id]
+            self._start(future)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, lane, timeout, on_wait=None):
+        """Hold a GPT slot for the body; on_wait() is awaited first if the request has to queue behind a deep queue."""
+        user_id = str(user_id)
+        future = self._enqueue(user_id, lane)
+        try:
+            if not future.done() and on_wait is not None and len(self._waiting) >= self.busy_depth:
+                try:
+                    await on_wait()
+                except Exception as e:
+                    print(f"[ERROR] Could not send the busy notice: {e}")
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()  # admitted just as we gave up
+            else:
+                future.cancel()
+                if self._waiting.get(user_id) is future:
+                    del self._waiting[user_id]
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise GptQueueTimeout() from None
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'waiting': len(self._waiting),
+            'max_waiting': self.max_waiting,
+            'admitted': self.admitted,
+            'superseded': self.superseded,
+            'timed_out': self.timed_out
+        }
+
+gpt_admission = GptAdmission(GPT_MAX_CONCURRENCY, GPT_BUSY_QUEUE_DEPTH)
+
+def gpt_lane(user_context):
+    return str(user_context.get('group', '') or 'None').strip().lower()
+
+# Conversation memory for the advice chat: recent turns are sent verbatim up to
+# the token budget, older ones are folded into a running summary in the
+# background. Memory is per process, LRU-evicted across users and capped.
+GPT_MEMORY_TOKEN_BUDGET = int(os.getenv("GPT_MEMORY_TOKEN_BUDGET", "800"))
+GPT_MEMORY_MIN_TURNS = int(os.getenv("GPT_MEMORY_MIN_TURNS", "2"))
+GPT_MEMORY_MAX_USERS = int(os.getenv("GPT_MEMORY_MAX_USERS", "5000"))
+GPT_MEMORY_MAX_BYTES = int(float(os.getenv("GPT_MEMORY_MAX_MB", "32")) * 1024 * 1024)
+# A conversation idle this long is forgotten, so the user's next message starts a new one
+GPT_MEMORY_IDLE_SECONDS = float(os.getenv("GPT_MEMORY_IDLE_MINUTES", "30")) * 60
+GPT_MEMORY_SUMMARY_MODEL = os.getenv("GPT_MEMORY_SUMMARY_MODEL", "gpt-4o-mini")
+GPT_MEMORY_SUMMARY_MAX_TOKENS = 200
+GPT_MEMORY_SUMMARY_PROMPT = (
+    "You keep notes on a habit-coaching chat. Merge the earlier notes and the new exchanges into one short "
+    "summary (at most 120 words) of what the user shared about their habit, triggers, struggles, plans and "
+    "what advice they already got. Write in third person, facts only."
+)
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+class Conversation:
+    __slots__ = ('summary', 'turns', 'overflow', 'size', 'summarizing', 'last_active')
+
+    def __init__(self):
+        self.summary = ""
+        self.turns = collections.deque()  # (role, text, tokens), oldest first
+        self.overflow = []                # turns past the budget, waiting to be summarized
+        self.size = 0                     # bytes of text held
+        self.summarizing = False
+        self.last_active = time.monotonic()
+
+class ConversationMemory:
+    """Per-user rolling GPT conversation buffer with a token budget.
+
+    history() returns the running summary plus the most recent turns that fit
+    in token_budget (always at least min_turns exchanges). Turns pushed out
+    of the budget are summarized in the background by a small model and then
+    dropped. A conversation idle for more than idle_seconds is forgotten, so
+    a user coming back later starts fresh (and their standalone questions
+    can be answered from the response cache again). Users are kept in LRU
+    order and the least recently active are evicted when there are more than
+    max_users or the text held exceeds max_bytes.
+    """
+
+    def __init__(self, token_budget, min_turns, max_users, max_bytes, idle_seconds):
+        self.token_budget = token_budget
+        self.min_turns = min_turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._users = collections.OrderedDict()
+        self._bytes = 0
+        self._tasks = set()
+
+    def history(self, user_id):
+        """Return the chat messages to send before the user's new question."""
+        conversation = self._users.get(str(user_id))
+        if conversation is None:
+            return []
+        if time.monotonic() - conversation.last_active > self.idle_seconds:
+            self.forget(user_id)
+            return []
+        self._users.move_to_end(str(user_id))
+        messages = []
+        if conversation.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {conversation.summary}"})
+        messages.extend({"role": role, "content": text} for role, text, _ in conversation.turns)
+        return messages
+
+    def add_exchange(self, user_id, question, answer):
+        """Remember one question and answer, compacting and evicting as needed."""
+        user_id = str(user_id)
+        conversation = self._users.get(user_id)
+        if conversation is None or time.monotonic() - conversation.last_active > self.idle_seconds:
+            self.forget(user_id)
+            conversation = self._users[user_id] = Conversation()
+        conversation.last_active = time.monotonic()
+        self._users.move_to_end(user_id)
+        max_chars = self.token_budget * 4
+        for role, text in (("user", question), ("assistant", answer)):
+            text = text.strip()[:max_chars]
+            conversation.turns.append((role, text, estimate_tokens(text)))
+            self._resize(user_id, conversation, len(text.encode()))
+        tokens = sum(turn[2] for turn in conversation.turns)
+        while tokens > self.token_budget and len(conversation.turns) > 2 * self.min_turns:
+            turn = conversation.turns.popleft()
+            conversation.overflow.append(turn)
+            tokens -= turn[2]
+        if conversation.overflow and not conversation.summarizing:
+            conversation.summarizing = True
+            task = asyncio.create_task(self._summarize(user_id, conversation))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._evict()
+
+    def forget(self, user_id):
+        conversation = self._users.pop(str(user_id), None)
+        if conversation is not None:
+            self._bytes -= conversation.size
+
+    def _resize(self, user_id, conversation, delta):
+        conversation.size += delta
+        if self._users.get(user_id) is conversation:  # an evicted conversation no longer counts
+            self._bytes += delta
+
+    def _evict(self):
+        idle_before = time.monotonic() - self.idle_seconds
+        while len(self._users) > 1:
+            conversation = next(iter(self._users.values()))
+            if conversation.last_active >= idle_before and len(self._users) <= self.max_users and self._bytes <= self.max_bytes:
+                break
+            self._users.popitem(last=False)
+            self._bytes -= conversation.size
+
+    async def _summarize(self, user_id, conversation):
+        try:
+            while conversation.overflow:
+                folded = list(conversation.overflow)
+                transcript = "\n".join(f"{role}: {text}" for role, text, _ in folded)
+                summary = await summarize_conversation(conversation.summary, transcript)
+                del conversation.overflow[:len(folded)]
+                old_size = len(conversation.summary.encode())
+                conversation.summary = summary
+                self._resize(user_id, conversation, len(summary.encode()) - old_size - sum(len(text.encode()) for _, text, _ in folded))
+        except Exception as e:
+            # Without a summary the overflow is simply dropped, as a plain sliding window would
+            print(f"[ERROR] Conversation summary for {user_id} failed: {e}")
+            self._resize(user_id, conversation, -sum(len(text.encode()) for _, text, _ in conversation.overflow))
+            conversation.overflow.clear()
+        finally:
+            conversation.summarizing = False
+
+conversation_memory = ConversationMemory(
+    GPT_MEMORY_TOKEN_BUDGET, GPT_MEMORY_MIN_TURNS, GPT_MEMORY_MAX_USERS, GPT_MEMORY_MAX_BYTES, GPT_MEMORY_IDLE_SECONDS
+)
+
+# Cache of answers to short, common questions ("any tips?", "how do I handle urges"),
+# shared by users with the same habit, streak range and group
+GPT_CACHE_TTL_SECONDS = float(os.getenv("GPT_CACHE_TTL_SECONDS", "86400"))
+GPT_CACHE_MAX_ENTRIES = int(os.getenv("GPT_CACHE_MAX_ENTRIES", "2000"))
+GPT_CACHE_MAX_QUESTION_WORDS = int(os.getenv("GPT_CACHE_MAX_QUESTION_WORDS", "12"))
+GPT_CACHE_VARIANTS = int(os.getenv("GPT_CACHE_VARIANTS", "1"))
+
+def normalize_question(text):
+    """Lowercase, drop punctuation and collapse whitespace: "Any tips??" -> "any tips"."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+def streak_bucket(user_context):
+    """Return (bucket, label) for the user's streak between MILESTONE_DAYS: 9 -> (2, "7-13 days")."""
     try:
-        rows = worksheet.get_all_records()
+        streak = int(user_context.get('current_streak', 0) or 0)
+    except (TypeError, ValueError):
+        streak = 0
+    bucket = bisect.bisect_right(MILESTONE_DAYS, streak)
+    if bucket == 0:
+        return bucket, "0 days"
+    if bucket == len(MILESTONE_DAYS):
+        return bucket, f"{MILESTONE_DAYS[-1]}+ days"
+    return bucket, f"{MILESTONE_DAYS[bucket - 1]}-{MILESTONE_DAYS[bucket] - 1} days"
+
+class ResponseCache:
+    """TTL + LRU cache of GPT answers keyed on (question, habit, streak bucket, group).
+
+    Only standalone questions are cached: short ones asked with no
+    conversation history, so a cached answer never ignores what the user
+    said before. With variants > 1 a key collects that many different
+    answers (misses keep calling GPT until it has them) and hits pick one at
+    random, so regulars don't get the same reply word for word.
+    """
+
+    def __init__(self, ttl, max_entries, max_words, variants):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_words = max_words
+        self.variants = max(1, variants)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, question, user_context):
+        normalized = normalize_question(question)
+        if not normalized or len(normalized.split()) > self.max_words:
+            return None
+        return (
+            normalized,
+            str(user_context.get('fasting_target', '')).strip().lower(),
+            streak_bucket(user_context)[0],
+            str(user_context.get('group', '')).strip().lower()
+        )
+
+    def get(self, key):
+        """Return a cached answer, or None on a miss (or while more variants are wanted)."""
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() >= entry[0]:
+            del self._entries[key]
+            entry = None
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry[1])
+
+    def put(self, key, answer):
+        if key is None or not answer:
+            return
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[0]:
+            entry = self._entries[key] = (time.monotonic() + self.ttl, [])
+        if len(entry[1]) < self.variants and answer not in entry[1]:
+            entry[1].append(answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+response_cache = ResponseCache(GPT_CACHE_TTL_SECONDS, GPT_CACHE_MAX_ENTRIES, GPT_CACHE_MAX_QUESTION_WORDS, GPT_CACHE_VARIANTS)
+
+# Near-duplicate lookup: standalone questions and their GPT answers are logged
+# to bot_state.db, build_answer_index.py turns them into a TF-IDF index file
+# offline, and a new question close enough to a stored one from a user with
+# the same habit, streak range and group is answered from it. The file is
+# reloaded when it changes.
+GPT_ANSWER_INDEX_PATH = os.getenv("GPT_ANSWER_INDEX_PATH", "answer_index.npz")
+GPT_SIMILAR_THRESHOLD = float(os.getenv("GPT_SIMILAR_THRESHOLD", "0.8"))
+GPT_SIMILAR_MAX_QUESTION_WORDS = int(os.getenv("GPT_SIMILAR_MAX_QUESTION_WORDS", "30"))
+ANSWER_INDEX_DIMENSIONS = 1 << 18
+ANSWER_INDEX_NGRAM = 3
+
+def question_features(text):
+    """Hashed character trigram counts of a normalized question: {feature: count}."""
+    padded = f" {normalize_question(text)} "
+    counts = {}
+    for i in range(len(padded) - ANSWER_INDEX_NGRAM + 1):
+        feature = zlib.crc32(padded[i:i + ANSWER_INDEX_NGRAM].encode()) % ANSWER_INDEX_DIMENSIONS
+        counts[feature] = counts.get(feature, 0) + 1
+    return counts
+
+def answer_scope(user_context):
+    """(habit, streak bucket, group) a stored answer is written for, the same fields ResponseCache.key uses."""
+    return (
+        str(user_context.get('fasting_target', '')).strip().lower(),
+        streak_bucket(user_context)[0],
+        str(user_context.get('group', '')).strip().lower()
+    )
+
+def answer_partition(habit, bucket, group):
+    """Answer index partition for a scope: answers are only reused within one."""
+    return f"{habit}|{bucket}|{group}"
+
+class AnswerIndex:
+    """Character n-gram TF-IDF index over past (question, answer) pairs.
+
+    The L2-normalized document vectors are stored column-wise, like a CSC
+    matrix in plain NumPy arrays: for each hashed trigram, the rows that
+    contain it (ascending) and their weights. Rows are grouped by partition
+    (see answer_partition), so a partition's postings are one contiguous run
+    inside each trigram's list. A lookup scatter-adds just that run of each
+    query trigram's postings into a score per row of the partition, which
+    gives the cosine similarity to every stored question in it; other
+    partitions' rows are never read.
+    """
+
+    def __init__(self, pointers, rows, weights, idf, partition_offsets, partitions, answer_blob, answer_offsets):
+        self.pointers = pointers
+        self.rows = rows
+        self.weights = weights
+        self.idf = idf
+        self.partition_offsets = partition_offsets
+        self.partitions = {partition: i for i, partition in enumerate(partitions)}
+        self.answer_blob = answer_blob
+        self.answer_offsets = answer_offsets
+
+    def __len__(self):
+        return int(self.partition_offsets[-1])
+
+    @classmethod
+    def build(cls, pairs):
+        """Build from [(question, partition, answer)]."""
+        pairs = sorted(pairs, key=lambda pair: pair[1])
+        partitions = sorted({partition for _, partition, _ in pairs})
+        partition_counts = collections.Counter(partition for _, partition, _ in pairs)
+        partition_offsets = np.zeros(len(partitions) + 1, dtype=np.int64)
+        np.cumsum([partition_counts[partition] for partition in partitions], out=partition_offsets[1:])
+        documents = [question_features(question) for question, _, _ in pairs]
+        df = np.zeros(ANSWER_INDEX_DIMENSIONS, dtype=np.int32)
+        for counts in documents:
+            df[list(counts)] += 1
+        idf = (np.log((len(documents) + 1) / (df + 1)) + 1).astype(np.float32)
+        features, rows, weights = [], [], []
+        for row, counts in enumerate(documents):
+            keys = np.fromiter(counts, dtype=np.int64, count=len(counts))
+            vector = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * idf[keys]
+            vector /= np.linalg.norm(vector) or 1.0
+            features.append(keys)
+            rows.append(np.full(len(keys), row, dtype=np.int32))
+            weights.append(vector)
+        features = np.concatenate(features) if features else np.zeros(0, dtype=np.int64)
+        order = np.argsort(features, kind="stable")
+        pointers = np.zeros(ANSWER_INDEX_DIMENSIONS + 1, dtype=np.int64)
+        np.cumsum(np.bincount(features, minlength=ANSWER_INDEX_DIMENSIONS), out=pointers[1:])
+        encoded = [answer.encode() for _, _, answer in pairs]
+        answer_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(answer) for answer in encoded], out=answer_offsets[1:])
+        return cls(
+            pointers,
+            np.concatenate(rows)[order] if rows else np.zeros(0, dtype=np.int32),
+            np.concatenate(weights)[order] if weights else np.zeros(0, dtype=np.float32),
+            idf,
+            partition_offsets,
+            partitions,
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            answer_offsets
+        )
+
+    def save(self, path):
+        partitions = sorted(self.partitions, key=self.partitions.get)
+        with open(path, "wb") as f:
+            np.savez(
+                f, pointers=self.pointers, rows=self.rows, weights=self.weights, idf=self.idf,
+                partition_offsets=self.partition_offsets, partitions=np.array(partitions, dtype=str),
+                answer_blob=self.answer_blob, answer_offsets=self.answer_offsets
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data['pointers'], data['rows'], data['weights'], data['idf'],
+                data['partition_offsets'], [str(partition) for partition in data['partitions']],
+                data['answer_blob'], data['answer_offsets']
+            )
+
+    def answer(self, row):
+        return self.answer_blob[self.answer_offsets[row]:self.answer_offsets[row + 1]].tobytes().decode()
+
+    def lookup(self, question, partition, threshold):
+        """Return (answer, similarity) for the closest stored question in the same partition, or None."""
+        partition_id = self.partitions.get(partition)
+        counts = question_features(question)
+        if partition_id is None or not counts:
+            return None
+        keys = np.fromiter(counts, dtype=np.int64, count=len(counts))
+        query = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * self.idf[keys]
+        query /= np.linalg.norm(query) or 1.0
+        first, last = int(self.partition_offsets[partition_id]), int(self.partition_offsets[partition_id + 1])
+        whole = first == 0 and last == len(self)
+        scores = np.zeros(last - first, dtype=np.float32)
+        for start, end, weight in zip(self.pointers[keys].tolist(), self.pointers[keys + 1].tolist(), query.tolist()):
+            if not whole:
+                start, end = start + np.searchsorted(self.rows[start:end], (first, last))
+            if start < end:
+                rows = self.rows[start:end]
+                np.add.at(scores, rows - first if first else rows, self.weights[start:end] * weight)
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        return self.answer(first + best), float(scores[best])
+
+answer_index = None
+_answer_index_mtime = None
+
+def load_answer_index(path=GPT_ANSWER_INDEX_PATH):
+    """Blocking: (re)load the answer index file if it exists and changed since the last load."""
+    global answer_index, _answer_index_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return
+    if mtime == _answer_index_mtime:
+        return
+    started = time.perf_counter()
+    answer_index = AnswerIndex.load(path)
+    _answer_index_mtime = mtime
+    print(f"[DEBUG] Loaded answer index with {len(answer_index)} pairs in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+async def reload_answer_index():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, load_answer_index)
     except Exception as e:
-        print(f"[ERROR] Failed to get worksheet records: {e}")
+        print(f"[ERROR] Could not load the answer index: {e}")
+
+def similar_answer(question, user_context):
+    """Return a stored answer to a near-identical question from a user with the same habit, streak range and group, or None."""
+    if answer_index is None or len(normalize_question(question).split()) > GPT_SIMILAR_MAX_QUESTION_WORDS:
+        return None
+    match = answer_index.lookup(question, answer_partition(*answer_scope(user_context)), GPT_SIMILAR_THRESHOLD)
+    if match is None:
+        return None
+    print(f"[DEBUG] Answered from the answer index (similarity {match[1]:.2f})")
+    return match[0]
+
+async def log_answer(question, user_context, answer):
+    """Keep a standalone question and its GPT answer for the next answer index build."""
+    if len(normalize_question(question).split()) > GPT_SIMILAR_MAX_QUESTION_WORDS:
         return
+    try:
+        await bot_state.run(_insert_answer, question, answer_scope(user_context), answer)
+    except Exception as e:
+        print(f"[ERROR] Could not log GPT answer: {e}")
+
+def stored_answer(user_question, user_context, history):
+    """Return (answer or None, cache key) for a standalone question, from the response cache or the answer index."""
+    if history:
+        return None, None
+    cache_key = response_cache.key(user_question, user_context)
+    answer = response_cache.get(cache_key)
+    if answer is not None:
+        print("[DEBUG] Answered from the response cache")
+        return answer, cache_key
+    return similar_answer(user_question, user_context), cache_key
+
+def _insert_answer(question, scope, answer):
+    habit, bucket, group = scope
+    db = bot_state.db()
+    with db:
+        db.execute(
+            "INSERT INTO gpt_answers (question, habit, bucket, group_name, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (question, habit, bucket, group, answer, utc_now_iso())
+        )
+
+async def summarize_conversation(summary, transcript):
+    """Fold new exchanges into a user's running conversation summary with the small model."""
+    async with openai_slots:
+        response = await asyncio.wait_for(
+            get_openai_client().chat.completions.create(
+                model=GPT_MEMORY_SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": GPT_MEMORY_SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Earlier notes: {summary or '(none)'}\n\nNew exchanges:\n{transcript}"}
+                ],
+                max_tokens=GPT_MEMORY_SUMMARY_MAX_TOKENS,
+                temperature=0.2
+            ),
+            timeout=OPENAI_TIMEOUT_SECONDS
+        )
+    return response.choices[0].message.content.strip()
+
+# The system prompt is one fixed string, built once, so every request starts
+# with the same prefix and OpenAI's automatic prompt caching can reuse it
+# (it applies to identical prefixes of 1024+ tokens). Everything per user
+# (habit, streak, group, conversation) comes after it.
+GPT_SYSTEM_PROMPT = """You are a supportive friend and accountability partner helping with habit transformation. Be warm, conversational, and personal - like talking to a friend, not reading from a textbook. You have deep knowledge of neuroscience, psychology, and consciousness.
+
+Guidelines:
+- Talk like a real person having a conversation, not a chatbot
+- Give specific, actionable advice tailored to their situation
+- Use their name or refer to their specific habit when possible
+- Be encouraging and celebrate their progress
+- Only end conversations when the user explicitly says goodbye, thanks, or indicates they're done
+- If the user asks something outside of habit change, motivation, or wellness, admit it's outside your expertise and do NOT try to answer
+- Avoid generic lists and bullet points unless specifically asked
+- Use natural language and conversational tone
+- Focus on helping with their specific habit, named in the user context below
+- Be conversational and engaging - ask follow-up questions when appropriate
+- NEVER share personal stories, experiences, or anecdotes about yourself
+- NEVER pretend to have personal experiences or memories
+- Use general examples and research-based insights instead of personal stories
+- Ask follow-up questions to keep the conversation flowing
+- AVOID repetitive greetings like "Hey there!", "Hello!", or "Hi!" - jump straight into the conversation
+- Vary your conversation starters - don't use the same greeting patterns repeatedly
+- Be natural and authentic in your responses
+
+Deep Knowledge Areas (use when relevant):
+🧠 **Dopamine Neuroscience**: Explain how dopamine works, reward pathways, tolerance, and how to reset your brain's reward system
+🎯 **Purpose & Meaning**: Help users connect their habit change to deeper purpose, values, and life vision
+🌑 **Shadow Work**: Guide users to explore the unconscious patterns, fears, and wounds driving their habits
+⚡ **Energy & Desire Transmutation**: Teach how to redirect addictive energy into creative, productive, and spiritual pursuits
+🧘 **Awareness & Mindfulness**: Help develop present-moment awareness and conscious choice-making
+🔄 **Subconscious Reprogramming**: Explain how to rewire neural pathways and change limiting beliefs
+😌 **Parasympathetic vs Sympathetic**: Teach nervous system regulation and stress management
+💫 **Consciousness & Higher Self**: Guide users toward their authentic self beyond ego and conditioning
+
+Response Style Examples:
+❌ DON'T: "Hey there! When I was trying to quit [habit], I found that..." (fictional personal story + repetitive greeting)
+❌ DON'T: "Hello! I remember when I used to..." (fictional personal memory + repetitive greeting)
+✅ DO: "Your brain has literally rewired itself around [habit]. Every time you do it, you're strengthening neural pathways that make it harder to resist next time. But here's the thing - your brain is also plastic. Every time you choose NOT to [habit], you're weakening those pathways and building new ones. What's one situation where you can practice this rewiring today?"
+
+❌ DON'T: "Hey there! I've found that starting super small works best..." (fictional personal experience + repetitive greeting)
+✅ DO: "Your nervous system is constantly scanning for threats and rewards. When you're stressed (sympathetic mode), your brain craves quick dopamine hits. But when you're in parasympathetic mode - calm, centered, present - you can make conscious choices instead of reacting. What's one way you can activate your parasympathetic nervous system before making a choice about [habit]?"
+
+❌ DON'T: "Here are 5 steps to create better habits: 1. Identify triggers 2. Set goals 3. Track progress..."
+✅ DO: "Behind every habit is a shadow - an unconscious pattern, fear, or wound you're trying to soothe. Your [habit] isn't just about the behavior; it's about what you're running from or trying to fill. What emotion or situation usually triggers your [habit]? That's where the real work begins."
+
+Deep Insights to Share:
+- "Your dopamine system is like a muscle - the more you use it for cheap hits, the weaker it gets for real rewards"
+- "Every urge is energy that can be transmuted. That craving for [habit]? That's pure creative energy waiting to be redirected"
+- "Your subconscious mind runs 95% of your behavior. The key isn't willpower - it's reprogramming the deeper patterns"
+- "Stress puts you in fight-or-flight mode, making you crave quick dopamine. Calm puts you in rest-and-digest mode, where conscious choice is possible"
+- "Your shadow - the parts of yourself you reject - often drives your most destructive habits. Integration, not suppression, is the path"
+- "Awareness is the first step. When you can observe your urges without acting on them, you're no longer a slave to them"
+- "Purpose is the ultimate dopamine hack. When you're connected to something bigger than yourself, cheap dopamine loses its power"
+"""
+
+GPT_USER_CONTEXT_TEMPLATE = """User Context:
+- They are trying to break the habit of: {habit_target}
+- Current streak: {current_streak}
+- Accountability group: {group}"""
+
+class GptUsageStats:
+    """Running token and latency totals for advice-chat completions.
+
+    cached_tokens is the part of the prompt OpenAI served from its prompt
+    cache (billed at a discount); latency is split by whether the call hit
+    the cache, to show the gain. Latency is time to the first token when
+    streaming, and the whole response otherwise.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._latency = {True: [0, 0.0], False: [0, 0.0]}  # cache hit -> [calls, seconds]
+
+    def record(self, usage, latency):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', 0) or 0
+        self.calls += 1
+        self.prompt_tokens += usage.prompt_tokens
+        self.cached_tokens += cached
+        self.completion_tokens += usage.completion_tokens
+        bucket = self._latency[cached > 0]
+        bucket[0] += 1
+        bucket[1] += latency
+        print(f"[DEBUG] GPT usage: prompt={usage.prompt_tokens} cached={cached} completion={usage.completion_tokens} latency={latency:.2f}s")
+
+    def stats(self):
+        def average(hit):
+            calls, seconds = self._latency[hit]
+            return round(seconds / calls, 3) if calls else None
+        return {
+            'calls': self.calls,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_share': round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            'latency_cached': average(True),
+            'latency_uncached': average(False)
+        }
+
+gpt_usage = GptUsageStats()
+
+def build_chatgpt_request(user_question, user_context, history=()):
+    """Return (canned_reply, None) when no GPT call is needed, else (None, completion kwargs).
+
+    history is the earlier conversation from conversation_memory, sent after
+    the fixed system prompt and the user's context and before the new question.
+    Without history the answer may be cached and served to other users in the
+    same streak range, so only that range is sent, not the exact streak.
+    """
+    user_context_prompt = GPT_USER_CONTEXT_TEMPLATE.format(
+        habit_target=user_context.get('fasting_target', 'their habit'),
+        current_streak=f"{user_context.get('current_streak', 0)} days" if history else streak_bucket(user_context)[1],
+        group=user_context.get('group', 'None')
+    )
+    greetings = ["hi", "hello", "kamusta", "hey", "yo", "sup", "kumusta", "good morning", "good afternoon", "good evening"]
+    closing_phrases = ["thanks", "thank you", "ty", "thx", "that's all", "im good", "i'm good", "bye", "see you", "talk later", "done", "no more", "that's it", "alright"]
+    user_message = user_question.strip().lower()
+    
+    # Only end conversation if user explicitly uses closing phrases
+    # Don't end just because message is short
+    if any(phrase in user_message for phrase in closing_phrases):
+        return "👍 No problem! If you need anything else, just message me anytime. Have a great day!", None
     
-    latest_entries = get_latest_entries_by_user(rows)
+    # Dynamic response length
+    if len(user_message.split()) <= 4 or any(greet in user_message for greet in greetings):
+        max_tokens = 120  # Short, friendly reply
+    else:
+        max_tokens = min(500, max(120, len(user_message.split()) * 4))  # More conversational responses
+    return None, {
+        'model': "gpt-4o",
+        'messages': [
+            {"role": "system", "content": GPT_SYSTEM_PROMPT},
+            {"role": "system", "content": user_context_prompt},
+            *history,
+            {"role": "user", "content": user_question}
+        ],
+        'max_tokens': max_tokens,
+        'temperature': 0.7
+    }
+
+async def get_chatgpt_response(user_question, user_context, user_id=None, on_wait=None):
+    """Answer a user's message with GPT; with user_id the exchange is kept in conversation memory.
+
+    Returns None if a newer message from the same user superseded this one
+    while it waited for a GPT slot. on_wait() is awaited if the request has
+    to queue behind a deep queue.
+    """
+    print(f"[DEBUG] get_chatgpt_response called with question: {user_question} and context: {user_context}")
+    if not OPENAI_API_KEY:
+        print("[DEBUG] OPENAI_API_KEY not set")
+        return GPT_NOT_CONFIGURED_REPLY
+    try:
+        history = conversation_memory.history(user_id) if user_id else []
+        canned_reply, request = build_chatgpt_request(user_question, user_context, history)
+        if canned_reply:
+            return canned_reply
+        answer, cache_key = stored_answer(user_question, user_context, history)
+        if answer is not None:
+            if user_id:
+                conversation_memory.add_exchange(user_id, user_question, answer)
+            return answer
+        client = get_openai_client()
+        print(f"[DEBUG] Sending request to OpenAI API with max_tokens={request['max_tokens']}...")
+        try:
+            async with gpt_admission.slot(user_id or id(request), gpt_lane(user_context), GPT_QUEUE_TIMEOUT_SECONDS, on_wait):
+                async with openai_slots:
+                    started = time.monotonic()
+                    response = await asyncio.wait_for(
+                        client.chat.completions.create(**request),
+                        timeout=OPENAI_TIMEOUT_SECONDS
+                    )
+        except GptSuperseded:
+            print(f"[DEBUG] GPT request from {user_id} superseded by a newer message")
+            return None
+        except GptQueueTimeout:
+            print("[ERROR] GPT request waited too long for a slot")
+            return GPT_QUEUE_TIMEOUT_REPLY
+        except asyncio.TimeoutError:
+            print("[ERROR] ChatGPT API timed out")
+            return GPT_TIMEOUT_REPLY
+        print("[DEBUG] Received response from OpenAI API")
+        gpt_usage.record(response.usage, time.monotonic() - started)
+        answer = response.choices[0].message.content.strip()
+        response_cache.put(cache_key, answer)
+        if not history:
+            await log_answer(user_question, user_context, answer)
+        if user_id:
+            conversation_memory.add_exchange(user_id, user_question, answer)
+        return answer
+    except Exception as e:
+        print(f"[ERROR] ChatGPT API error: {e}")
+        return GPT_ERROR_REPLY
+
+# Streaming replies: the first tokens are sent as a message right away and the
+# message is then edited as more text arrives, throttled to stay inside
+# Telegram's edit limits
+GPT_STREAMING = os.getenv("GPT_STREAMING", "1") == "1"
+GPT_STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("GPT_STREAM_EDIT_INTERVAL_SECONDS", "0.7"))
+GPT_STREAM_EDIT_MIN_CHARS = int(os.getenv("GPT_STREAM_EDIT_MIN_CHARS", "80"))
+
+class StreamingReply:
+    """One Telegram message that grows as streamed text arrives."""
+
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self._edits_paused_until = 0.0
+
+    def add(self, delta):
+        self.text += delta
+
+    def due(self):
+        """True when enough time or text has accumulated since the last edit."""
+        if self.text.strip() == self._shown:
+            return False
+        elapsed = time.monotonic() - self._last_edit
+        return elapsed >= GPT_STREAM_EDIT_INTERVAL_SECONDS or len(self.text) - len(self._shown) >= GPT_STREAM_EDIT_MIN_CHARS
+
+    async def show(self, final=False):
+        text = self.text.strip()
+        if not text or text == self._shown:
+            return
+        if not final and time.monotonic() < self._edits_paused_until:
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply_text(text)
+            else:
+                await self.sent.edit_text(text)
+            self._shown = text
+        except RetryAfter as e:
+            print(f"[DEBUG] Edit rate limited, skipping edits for {e.retry_after}s")
+            self._edits_paused_until = time.monotonic() + float(e.retry_after)
+            if final:
+                await asyncio.sleep(float(e.retry_after))
+                await self.show(final=True)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._last_edit = time.monotonic()
+
+async def stream_chatgpt_reply(message, user_question, user_context, user_id=None):
+    """Answer a user's message with a streamed GPT reply edited into place as tokens arrive."""
+    print(f"[DEBUG] stream_chatgpt_reply called with question: {user_question} and context: {user_context}")
+    if not OPENAI_API_KEY:
+        print("[DEBUG] OPENAI_API_KEY not set")
+        await message.reply_text(GPT_NOT_CONFIGURED_REPLY)
+        return
+    reply = StreamingReply(message)
+    try:
+        history = conversation_memory.history(user_id) if user_id else []
+        canned_reply, request = build_chatgpt_request(user_question, user_context, history)
+        if canned_reply:
+            await message.reply_text(canned_reply)
+            return
+        answer, cache_key = stored_answer(user_question, user_context, history)
+        if answer is not None:
+            await message.reply_text(answer)
+            if user_id:
+                conversation_memory.add_exchange(user_id, user_question, answer)
+            return
+        client = get_openai_client()
+        print(f"[DEBUG] Streaming request to OpenAI API with max_tokens={request['max_tokens']}...")
+        async with gpt_admission.slot(
+            user_id or id(request), gpt_lane(user_context), GPT_QUEUE_TIMEOUT_SECONDS,
+            on_wait=lambda: message.reply_text(GPT_BUSY_REPLY)
+        ), openai_slots:
+            started = time.monotonic()
+            first_token = None
+            usage = None
+            stream = await asyncio.wait_for(
+                client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request),
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+            try:
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        # The timeout applies to the gap between chunks, not to the whole answer
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=OPENAI_TIMEOUT_SECONDS)
+                    except StopAsyncIteration:
+                        break
+                    if chunk.usage is not None:
+                        usage = chunk.usage  # sent in a last chunk with no choices
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token is None:
+                            first_token = time.monotonic() - started
+                        reply.add(chunk.choices[0].delta.content)
+                        if reply.sent is None or reply.due():
+                            await reply.show()
+            finally:
+                # Release the HTTP response even when the reply is cut short
+                await stream.close()
+        await reply.show(final=True)
+        print(f"[DEBUG] Streamed reply of {len(reply.text)} chars")
+        gpt_usage.record(usage, first_token if first_token is not None else time.monotonic() - started)
+        response_cache.put(cache_key, reply.text.strip())
+        if not history and reply.text.strip():
+            await log_answer(user_question, user_context, reply.text.strip())
+        if user_id and reply.text.strip():
+            conversation_memory.add_exchange(user_id, user_question, reply.text)
+    except GptSuperseded:
+        print(f"[DEBUG] GPT request from {user_id} superseded by a newer message")
+    except GptQueueTimeout:
+        print("[ERROR] GPT request waited too long for a slot")
+        await message.reply_text(GPT_QUEUE_TIMEOUT_REPLY)
+    except asyncio.TimeoutError:
+        print("[ERROR] ChatGPT API timed out")
+        await finish_failed_stream(reply, GPT_TIMEOUT_REPLY)
+    except Exception as e:
+        print(f"[ERROR] ChatGPT API error: {e}")
+        await finish_failed_stream(reply, GPT_ERROR_REPLY)
+
+async def finish_failed_stream(reply, error_text):
+    """Keep any partial answer on screen; only send the error text if nothing was shown."""
+    if reply.text.strip():
+        await reply.show(final=True)
+    else:
+        await reply.message.reply_text(error_text)
+
+# --- Broadcast engine ---
+# Telegram allows roughly 30 messages/second overall, one message/second per
+# private chat and about 20 messages/minute per group
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "28"))
+TELEGRAM_PRIVATE_CHAT_INTERVAL_SECONDS = 1.0
+TELEGRAM_GROUP_CHAT_INTERVAL_SECONDS = 3.0
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+
+class TokenBucket:
+    """Async token bucket: acquire() waits until a send is allowed under the rate."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    def pause(self, seconds):
+        """Stop handing out tokens for seconds (used when Telegram answers RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class ChatRateLimiter:
+    """Spaces out messages to the same chat (private chats and groups have different limits)."""
+
+    def __init__(self, private_interval, group_interval):
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self._next_allowed = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        interval = self.group_interval if int(chat_id) < 0 else self.private_interval
+        ready_at = max(now, self._next_allowed.get(chat_id, 0.0))
+        self._next_allowed[chat_id] = ready_at + interval
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {chat: t for chat, t in self._next_allowed.items() if t > now}
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+telegram_rate_limit = TokenBucket(TELEGRAM_GLOBAL_RATE)
+chat_rate_limit = ChatRateLimiter(TELEGRAM_PRIVATE_CHAT_INTERVAL_SECONDS, TELEGRAM_GROUP_CHAT_INTERVAL_SECONDS)
+
+async def send_rate_limited(bot, message, max_attempts=BROADCAST_MAX_ATTEMPTS):
+    """Send one message dict via bot.send_message within Telegram's limits.
+
+    Returns 'sent', 'blocked' (the user blocked the bot or left the chat) or 'failed'.
+    """
+    chat_id = message['chat_id']
+    for attempt in range(1, max_attempts + 1):
+        await chat_rate_limit.acquire(chat_id)
+        await telegram_rate_limit.acquire()
+        try:
+            await bot.send_message(**message)
+            return 'sent'
+        except RetryAfter as e:
+            print(f"[DEBUG] Flood control hit sending to {chat_id}, pausing {e.retry_after}s")
+            telegram_rate_limit.pause(float(e.retry_after))
+        except Forbidden as e:
+            print(f"[DEBUG] Chat {chat_id} is unreachable: {e}")
+            return 'blocked'
+        except (BadRequest, TimedOut) as e:
+            # Not retried: a bad request will fail again, and a timed out send may already have been delivered
+            print(f"❌ Could not message {chat_id}: {e}")
+            return 'failed'
+        except NetworkError as e:
+            print(f"[DEBUG] Network error sending to {chat_id} (attempt {attempt}/{max_attempts}): {e}")
+            await asyncio.sleep(min(10, 2 ** attempt))
+        except Exception as e:
+            print(f"❌ Could not message {chat_id}: {e}")
+            return 'failed'
+    return 'failed'
+
+async def broadcast(bot, messages, concurrency=BROADCAST_CONCURRENCY, spread_seconds=None, on_result=None):
+    """Send many messages concurrently under the global and per-chat rate limits.
+
+    messages is a list of send_message keyword dicts. With spread_seconds the
+    sends are paced evenly over that many seconds instead of going out as one
+    burst; on_result(message, outcome) is awaited after each send. Returns a
+    delivery report: {'sent', 'blocked', 'failed', 'duration'}.
+    """
+    report = {'sent': 0, 'blocked': 0, 'failed': 0}
+    started = time.monotonic()
+    pending = iter(messages)
+    pace = None
+    if spread_seconds and len(messages) > 1:
+        pace = TokenBucket(max(len(messages) / spread_seconds, 1.0), capacity=1)
+
+    async def worker():
+        for message in pending:
+            if pace is not None:
+                await pace.acquire()
+            outcome = await send_rate_limited(bot, message)
+            report[outcome] += 1
+            if on_result is not None:
+                await on_result(message, outcome)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    report['duration'] = round(time.monotonic() - started, 2)
+    return report
+
+# --- Check-in delivery windows ---
+# Each user gets their daily check-in at CHECKIN_TIME in their TIMEZONE. Users
+# without a time are spread over CHECKIN_DEFAULT_WINDOW_MINUTES starting at the
+# default time, so the morning send is a series of small minute slots instead
+# of one burst.
+CHECKIN_DEFAULT_TIMEZONE = os.getenv("CHECKIN_DEFAULT_TIMEZONE", "Asia/Manila")
+CHECKIN_DEFAULT_TIME = os.getenv("CHECKIN_DEFAULT_TIME", "09:00")
+CHECKIN_DEFAULT_WINDOW_MINUTES = int(os.getenv("CHECKIN_DEFAULT_WINDOW_MINUTES", "30"))
+CHECKIN_SLOT_SPREAD_SECONDS = float(os.getenv("CHECKIN_SLOT_SPREAD_SECONDS", "45"))
+# Slots missed while the bot was down (deploy, crash) are sent on the next run if they are at most this old
+CHECKIN_CATCHUP_MINUTES = int(os.getenv("CHECKIN_CATCHUP_MINUTES", "180"))
+
+def parse_checkin_time(value):
+    """Parse "HH:MM" into minutes after midnight, or None if it isn't a valid time."""
+    try:
+        hour, minute = (int(part) for part in str(value).strip().split(":"))
+    except ValueError:
+        return None
+    if 0 <= hour < 24 and 0 <= minute < 60:
+        return hour * 60 + minute
+    return None
+
+def get_timezone(name):
+    """Return the ZoneInfo for name, or None if it isn't a known timezone."""
+    try:
+        return ZoneInfo(str(name).strip())
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+DEFAULT_CHECKIN_ZONE = get_timezone(CHECKIN_DEFAULT_TIMEZONE)
+DEFAULT_CHECKIN_MINUTE = parse_checkin_time(CHECKIN_DEFAULT_TIME)
+
+def checkin_slot(row):
+    """Return (timezone, minute of the local day) when this user's check-in is due."""
+    zone = get_timezone(row.get('timezone')) if row.get('timezone') else None
+    minute = parse_checkin_time(row.get('checkin_time')) if row.get('checkin_time') else None
+    if minute is None:
+        # Stable per-user offset inside the default window
+        offset = zlib.crc32(str(row.get('user_id', '')).encode()) % max(1, CHECKIN_DEFAULT_WINDOW_MINUTES)
+        minute = (DEFAULT_CHECKIN_MINUTE + offset) % (24 * 60)
+    return zone or DEFAULT_CHECKIN_ZONE, minute
+
+class CheckinSlots:
+    """Works out which users' check-in slots fell in the minutes since the last run.
+
+    A run covers every slot after the previous run up to now (at most
+    CHECKIN_CATCHUP_MINUTES back), so a delayed or skipped run is caught up by
+    the next one. The last run time is kept in bot_state, so slots that fell
+    while the bot was restarting are sent by the first run after it comes
+    back. Each user gets at most one check-in per local day.
+    """
+
+    def __init__(self):
+        self._last_run = None
+        self._loaded = False
+        self._sent_on = {}  # user_id -> local date of the last check-in sent
+
+    def _read_last_run(self):
+        row = bot_state.db().execute(
+            "SELECT value FROM scheduler_state WHERE name = 'checkin_last_run'"
+        ).fetchone()
+        return datetime.datetime.fromisoformat(row[0]) if row else None
+
+    def _write_last_run(self, when):
+        db = bot_state.db()
+        with db:
+            db.execute(
+                "INSERT INTO scheduler_state (name, value, updated_at) VALUES ('checkin_last_run', ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (when.isoformat(), datetime.datetime.now(datetime.timezone.utc).isoformat())
+            )
+
+    async def load(self):
+        """Pick up the last run time saved by the previous process, once."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            last_run = await bot_state.run(self._read_last_run)
+        except Exception as e:
+            print(f"[ERROR] Could not read the last check-in run time: {e}")
+            return
+        if last_run is not None and self._last_run is None:
+            print(f"[DEBUG] Last check-in run was at {last_run.isoformat()}, catching up from there")
+            self._last_run = last_run
+
+    async def save(self):
+        if self._last_run is not None:
+            await bot_state.run(self._write_last_run, self._last_run)
+
+    def due(self, rows, now=None):
+        """Return [(row, local_date)] for users whose slot is in (last run, now]."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        window_start = self._last_run or now - datetime.timedelta(minutes=1)
+        window_start = max(window_start, now - datetime.timedelta(minutes=CHECKIN_CATCHUP_MINUTES))
+        self._last_run = now
+        local_days = {}
+        slot_times = {}
+        due = []
+        for row in rows:
+            zone, minute = checkin_slot(row)
+            if zone not in local_days:
+                local_today = now.astimezone(zone).date()
+                local_days[zone] = (local_today, local_today - datetime.timedelta(days=1))
+            for local_date in local_days[zone]:
+                key = (zone, minute, local_date)
+                if key not in slot_times:
+                    slot = datetime.datetime.combine(local_date, datetime.time(minute // 60, minute % 60), tzinfo=zone)
+                    slot_times[key] = window_start < slot <= now
+                if slot_times[key] and self._sent_on.get(str(row.get('user_id'))) != local_date:
+                    due.append((row, local_date))
+                    break
+        return due
+
+    def mark_sent(self, user_id, local_date):
+        self._sent_on[str(user_id)] = local_date
+
+checkin_slots = CheckinSlots()
+
+async def send_due_checkins(app):
+    """Every minute: send the check-in to users whose delivery slot has come up."""
+    try:
+        rows = await storage.list_users()
+    except Exception as e:
+        print(f"[ERROR] Failed to get worksheet records: {e}")
+        return
+    latest_entries = [row for row in get_latest_entries_by_user(rows) if row.get("status", "").lower() != "stopped"]
+    await checkin_slots.load()
+    due = checkin_slots.due(latest_entries)
+    try:
+        await checkin_slots.save()
+    except Exception as e:
+        print(f"[ERROR] Could not save the check-in run time: {e}")
+    if not due:
+        return
+    print(f"[DEBUG] {len(due)} users due for their check-in this slot")
+    local_dates = {}
+    for row, local_date in due:
+        checkin_slots.mark_sent(row.get('user_id'), local_date)
+        local_dates[str(row.get('user_id'))] = local_date
+    return await send_daily_checkins(
+        app, [row for row, _ in due], spread_seconds=CHECKIN_SLOT_SPREAD_SECONDS, local_dates=local_dates
+    )
+
+# ✅ Daily check-in sender with 3-day miss check
+async def send_daily_checkins(app, latest_entries=None, spread_seconds=None, local_dates=None):
+    """Send the daily check-in to the given user rows (all users if None).
+
+    Each user's check-in belongs to the run "checkins:<their local date>" in the
+    delivery ledger, so running this again the same day (by hand, or after a
+    restart) skips everyone who already got theirs.
+    """
+    print("[DEBUG] send_daily_checkins called")
+    if latest_entries is None:
+        try:
+            rows = await storage.list_users()
+        except Exception as e:
+            print(f"[ERROR] Failed to get worksheet records: {e}")
+            return
+        latest_entries = get_latest_entries_by_user(rows)
     print(f"[DEBUG] Found {len(latest_entries)} active users")
 
+    # Streak counters are loaded once (cold start) and then kept current by check-in writes
+    streaks_loaded = True
+    try:
+        await storage.load_streaks()
+    except Exception as e:
+        print(f"[DEBUG] Error getting check-in history: {e}")
+        streaks_loaded = False
+    today = get_pht_date()
+
+    items = []
     for row in latest_entries:
         try:
             if row.get("status", "").lower() == "stopped":
@@ -604,54 +2759,18 @@ async def send_daily_checkins(app):
             username_display = f"@{row.get('username', '')}" if row.get('username') else "there"
             print(f"[DEBUG] Processing user {user_id} ({username_display})")
 
-            # Check last 3 check-ins
-            try:
-                checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-                history = checkin_sheet.get_all_records()
-            except Exception as e:
-                print(f"[DEBUG] Error getting check-in history: {e}")
-                history = []
+            streak_state = await storage.get_streak(user_id) if streaks_loaded else StreakEngine.empty_state()
+            print(f"[DEBUG] User {user_id} streak state: {streak_state}")
 
-            # Get all check-ins for the user, most recent first
-            user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-            print(f"[DEBUG] User {user_id} has {len(user_history)} check-ins")
-            
-            # Check if user has at least one 'yes' check-in
-            has_yes_checkin = any(r.get("status") == "yes" for r in user_history)
-            print(f"[DEBUG] User {user_id} has_yes_checkin: {has_yes_checkin}")
-            if has_yes_checkin:
-                yes_checkins = [r for r in user_history if r.get("status") == "yes"]
-                print(f"[DEBUG] User {user_id} has {len(yes_checkins)} 'yes' check-ins")
-            
-            # Get the last 3 check-ins (most recent first)
-            last_3 = [r.get("status", "") for r in user_history[:3]]
-            print(f"[DEBUG] Last 3 check-ins for user {user_id}: {last_3}")
-            
             # Check if user has already checked in today (to avoid sending reminders right after they check in)
-            today = get_pht_date()
-            checked_in_today = False
-            if user_history:
-                latest_checkin = user_history[0]  # Most recent check-in
-                latest_timestamp = latest_checkin.get("timestamp", "")
-                if isinstance(latest_timestamp, str) and latest_timestamp.startswith(today):
-                    checked_in_today = True
+            checked_in_today = streak_state['last_checkin_date'] == today
             print(f"[DEBUG] User {user_id} checked in today: {checked_in_today}")
             
             reminder_sent = row.get("reminder_sent", "")
             media_type = row.get("media_type", "video")  # default to video for backward compatibility
             print(f"[DEBUG] User {user_id} reminder_sent: '{reminder_sent}', media_type: '{media_type}'")
             
-            # Calculate current streak
-            current_streak = 0
-            for entry in user_history:
-                if entry.get("status") == "yes":
-                    current_streak += 1
-                elif entry.get("status") == "reset":
-                    # Stop counting when we hit a reset (user stopped and resumed)
-                    break
-                else:
-                    # Stop counting on any "no" or other status
-                    break
+            current_streak = streak_state['current_streak']
             
             # Always send the daily check-in with streak count
             if current_streak > 0:
@@ -659,21 +2778,20 @@ async def send_daily_checkins(app):
             else:
                 text = f"🔁 Daily Check-In\n\nHey {username_display}! Were you able to stick to your detox from *{target}* today?"
             
-            try:
-                await app.bot.send_message(
-                    chat_id=int(user_id),
-                    text=text,
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([
-                        [
-                            InlineKeyboardButton("\u2705 Yes", callback_data=f"checkin_yes_{user_id}"),
-                            InlineKeyboardButton("\u274C No", callback_data=f"checkin_no_{user_id}")
-                        ]
-                    ])
-                )
-                print(f"[DEBUG] Sent daily check-in to user {user_id}")
-            except Exception as e:
-                print(f"❌ Could not message {user_id}: {e}")
+            local_date = (local_dates or {}).get(str(user_id))
+            if local_date is None:
+                local_date = datetime.datetime.now(checkin_slot(row)[0]).date()
+            items.append((f"checkins:{local_date}", user_id, {
+                'chat_id': int(user_id),
+                'text': text,
+                'parse_mode': "Markdown",
+                'reply_markup': InlineKeyboardMarkup([
+                    [
+                        InlineKeyboardButton("\u2705 Yes", callback_data=f"checkin_yes_{user_id}"),
+                        InlineKeyboardButton("\u274C No", callback_data=f"checkin_no_{user_id}")
+                    ]
+                ])
+            }))
                 
         except Exception as e:
             print(f"[ERROR] Error processing user {row.get('user_id', 'unknown')}: {e}")
@@ -681,6 +2799,10 @@ async def send_daily_checkins(app):
         
         # Reminder logic moved to handle_checkin_response for immediate delivery
 
+    report = await deliver(app.bot, items, "checkins", spread_seconds=spread_seconds)
+    print(f"[DEBUG] Daily check-in broadcast report: {report}")
+    return report
+
 # Google Sheet columns (expected order):
 # user_id | username | detox_days | fasting_target | group | status | reminder | media_id | reminder_sent | media_type
 
@@ -699,12 +2821,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not hasattr(context, 'user_data') or not isinstance(context.user_data, dict):
             context.user_data = {}
         user_id = str(update.effective_user.id)
-        rows = worksheet.get_all_records()
-        user_row = None
-        for i, row in enumerate(rows):
-            if str(row.get('user_id', '')) == user_id:
-                user_row = row
-                break
+        user_row = await storage.get_user(user_id)
         if user_row:
             # User exists, offer choice
             await update.message.reply_text(
@@ -751,13 +2868,7 @@ async def handle_onboarding_choice(update: Update, context: ContextTypes.DEFAULT
         
         # Add a "reset" entry to break the streak when they restart
         user_id = str(query.from_user.id)
-        timestamp = get_pht_timestamp()
-        try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-        except Exception as e:
-            checkin_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Daily Check-ins", rows=1000, cols=5)
-            checkin_sheet.append_row(["user_id", "status", "timestamp"])
-        checkin_sheet.append_row([user_id, "reset", timestamp])
+        await storage.append_checkin(user_id, "reset")
         print(f"[DEBUG] Added reset entry for user {user_id} when they restarted onboarding")
         print(f"[DEBUG] Cleared all old onboarding data for user {user_id}")
         
@@ -768,11 +2879,7 @@ async def handle_onboarding_choice(update: Update, context: ContextTypes.DEFAULT
     elif query.data == "onboarding_resume":
         # Set user as active and send confirmation
         user_id = str(query.from_user.id)
-        rows = worksheet.get_all_records()
-        for i, row in enumerate(rows):
-            if str(row.get('user_id', '')) == user_id:
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['STATUS'], "active")
-                break
+        await storage.update_user_fields(user_id, {'STATUS': "active"})
         if query.message and hasattr(query.message, 'reply_text'):
             await query.message.reply_text("✅ You're all set! I'll resume your daily check-ins. If you want to change your habit or group, just type /start again.")
 
@@ -1066,47 +3173,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop('pause_timestamp', None)
     
     try:
-        rows = worksheet.get_all_records()
-        user_data = None
-        for row in rows:
-            if str(row.get('user_id', '')) == user_id:
-                user_data = row
-                break
-        if not user_data:
-            print("[DEBUG] User not found in system, using default context")
-            user_context = {
-                'fasting_target': 'Unknown',
-                'current_streak': 0,
-                'group': 'None'
-            }
-        else:
-            # Get current streak
-            try:
-                checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-                history = checkin_sheet.get_all_records()
-            except Exception as e:
-                print(f"[DEBUG] Error getting check-in history: {e}")
-                history = []
-            user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-            current_streak = 0
-            for entry in user_history:
-                if entry.get("status") == "yes":
-                    current_streak += 1
-                elif entry.get("status") == "reset":
-                    # Stop counting when we hit a reset (user stopped and resumed)
-                    break
-                else:
-                    # Stop counting on any "no" or other status
-                    break
-            user_context = {
-                'fasting_target': user_data.get('fasting_target', 'Unknown'),
-                'current_streak': current_streak,
-                'group': user_data.get('group', 'None')
-            }
+        user_context = await get_user_context(user_id)
         print(f"[DEBUG] Received message: {update.message.text}")
         if update.effective_chat:
             await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        response = await get_chatgpt_response(update.message.text, user_context)
+        # Waiting for GPT shouldn't tie up a handler slot other users' updates could use
+        processor = context.application.update_processor
+        gpt_wait = processor.released_slot() if isinstance(processor, PerUserUpdateProcessor) else contextlib.nullcontext()
+        async with gpt_wait:
+            if GPT_STREAMING:
+                await stream_chatgpt_reply(update.message, update.message.text, user_context, user_id)
+                return
+            response = await get_chatgpt_response(
+                update.message.text, user_context, user_id,
+                on_wait=lambda: update.message.reply_text(GPT_BUSY_REPLY)
+            )
+        if response is None:
+            return
         print(f"[DEBUG] Replying to user with: {response}")
         await update.message.reply_text(response)
     except Exception as e:
@@ -1124,6 +3207,7 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message:
             await update.message.reply_text("❌ Please send a *voice* or *video note*.", parse_mode="Markdown")
         return
+    os.makedirs(MEDIA_DIR, exist_ok=True)
     file_path = os.path.join(MEDIA_DIR, f"{user_id}.ogg")
     new_file = await file.get_file()
     await new_file.download_to_drive(file_path)
@@ -1145,20 +3229,14 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
         print(f"[DEBUG] Parsed status: {status}, user_id: {user_id}")
         
         # Check if user is stopped - if so, ignore the check-in response
-        all_rows = worksheet.get_all_records()
-        user_row = next((r for r in all_rows if str(r.get('user_id', '')) == str(user_id)), None)
+        user_row = await storage.get_user(user_id)
         if user_row and user_row.get("status", "active") == "stopped":
             print(f"[DEBUG] User {user_id} is stopped, ignoring check-in response")
             await query.edit_message_text("🛑 You're unsubscribed from check-ins. Use /start to resubscribe.")
             return
         
-        timestamp = get_pht_timestamp()
-        try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-        except Exception as e:
-            checkin_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Daily Check-ins", rows=1000, cols=5)
-            checkin_sheet.append_row(["user_id", "status", "timestamp"])
-        checkin_sheet.append_row([user_id, status, timestamp])
+        await storage.append_checkin(user_id, status)
+        streak_state = await storage.get_streak(user_id)
         
         # Different response messages based on their choice
         if status == "yes":
@@ -1169,25 +3247,10 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
         # Check if this was the 3rd 'no' in a row and send reminder immediately
         if status == "no":
             print(f"[DEBUG] User {user_id} responded 'no', checking for 3-day reminder logic")
-            # Get all check-ins for this user, most recent first
-            try:
-                history = checkin_sheet.get_all_records()
-            except Exception as e:
-                history = []
-            user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-            print(f"[DEBUG] User {user_id} has {len(user_history)} total check-ins")
-            
-            # Check if user has at least one 'yes' check-in
-            has_yes_checkin = any(r.get("status") == "yes" for r in user_history)
-            print(f"[DEBUG] User {user_id} has_yes_checkin: {has_yes_checkin}")
-            
-            # Get the last 3 check-ins (most recent first)
-            last_3 = [r.get("status", "") for r in user_history[:3]]
-            print(f"[DEBUG] After 'no' check-in - User {user_id} last_3: {last_3}")
+            consecutive_no = streak_state['consecutive_no']
+            print(f"[DEBUG] After 'no' check-in - User {user_id} consecutive_no: {consecutive_no}")
             
             # Get user's reminder settings
-            all_rows = worksheet.get_all_records()
-            user_row = next((r for r in all_rows if str(r.get('user_id', '')) == str(user_id)), None)
             reminder_sent = user_row.get("reminder_sent", "") if user_row else ""
             media_id = str(user_row.get("media_id", "")) if user_row else ""
             media_type = user_row.get("media_type", "video") if user_row else "video"
@@ -1195,21 +3258,19 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
             print(f"[DEBUG] User {user_id} reminder_sent: '{reminder_sent}', media_id: '{media_id}', media_type: '{media_type}'")
             
             # Check each condition separately
-            condition1 = len(last_3) == 3  # Must have exactly 3 check-ins
-            condition2 = last_3 == ["no", "no", "no"]  # Last 3 must all be "no"
+            condition1 = consecutive_no >= 3  # Last 3 check-ins must all be "no"
             condition3 = reminder_sent != "yes"  # Haven't already sent a reminder for this streak
             condition4 = media_id and media_id != ""  # User must have uploaded a media file
             condition5 = media_type in ["voice", "video_note", "audio", "document", "video"]  # Media type must be valid
             
             print(f"[DEBUG] Reminder conditions for user {user_id}:")
-            print(f"  - len(last_3) == 3: {condition1}")
-            print(f"  - last_3 == ['no', 'no', 'no']: {condition2}")
+            print(f"  - consecutive_no >= 3: {condition1}")
             print(f"  - reminder_sent != 'yes': {condition3}")
             print(f"  - media_id exists: {condition4}")
             print(f"  - media_type valid: {condition5}")
             
             # Send reminder if this was the 3rd 'no' in a row
-            if (condition1 and condition2 and condition3 and condition4 and condition5):
+            if (condition1 and condition3 and condition4 and condition5):
                 print(f"[DEBUG] ALL CONDITIONS MET - Sending immediate reminder to user {user_id} after 3rd 'no'")
                 try:
                     await context.bot.send_message(int(user_id), text="📼 Here's a message you recorded for yourself. Remember why you started.")
@@ -1226,11 +3287,8 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
                     print(f"[DEBUG] Successfully sent immediate reminder to user {user_id}")
                     
                     # Set reminder_sent to 'yes' in the sheet
-                    for i, r in enumerate(all_rows):
-                        if str(r.get('user_id', '')) == str(user_id):
-                            worksheet.update_cell(i + 2, SHEET_COLUMNS['REMINDER_SENT'], "yes")
-                            print(f"[DEBUG] Set reminder_sent to 'yes' for user {user_id}")
-                            break
+                    if await storage.update_user_fields(user_id, {'REMINDER_SENT': "yes"}):
+                        print(f"[DEBUG] Set reminder_sent to 'yes' for user {user_id}")
                 except Exception as e:
                     print(f"⚠️ Could not send immediate reminder to {user_id}: {e}")
             else:
@@ -1238,33 +3296,13 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
         
         # Reset reminder_sent if user checks in with 'yes'
         if status == "yes":
-            all_rows = worksheet.get_all_records()
-            for i, r in enumerate(all_rows):
-                if str(r.get('user_id', '')) == str(user_id):
-                    worksheet.update_cell(i + 2, SHEET_COLUMNS['REMINDER_SENT'], "")
-                    break
+            await storage.update_user_fields(user_id, {'REMINDER_SENT': ""})
             # --- Milestone streak logic ---
-            # Get all check-ins for this user, most recent first
-            try:
-                history = checkin_sheet.get_all_records()
-            except Exception as e:
-                history = []
-            user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-            streak = 0
-            for entry in user_history:
-                if entry.get("status") == "yes":
-                    streak += 1
-                elif entry.get("status") == "reset":
-                    # Stop counting when we hit a reset (user stopped and resumed)
-                    break
-                else:
-                    # Stop counting on any "no" or other status
-                    break
+            streak = streak_state['current_streak']
             print(f"[DEBUG] User {user_id} has a streak of {streak} days")
             milestones = [3, 7, 14, 30, 60, 90]
             if streak in milestones:
                 # Check if user has already been asked about this milestone
-                user_row = next((r for r in all_rows if str(r.get('user_id', '')) == str(user_id)), None)
                 shared_milestones = str(user_row.get("shared_milestones", "")) if user_row else ""
                 shared_list = shared_milestones.split(",") if shared_milestones else []
                 shared_list = [int(x.strip()) for x in shared_list if x.strip().isdigit()]
@@ -1281,11 +3319,8 @@ async def handle_checkin_response(update: Update, context: ContextTypes.DEFAULT_
                         # Still record this milestone as "shared" so they don't get asked again
                         shared_list.append(streak)
                         new_shared_milestones = ",".join(map(str, shared_list))
-                        for i, r in enumerate(all_rows):
-                            if str(r.get('user_id', '')) == str(user_id):
-                                worksheet.update_cell(i + 2, SHEET_COLUMNS['SHARED_MILESTONES'], new_shared_milestones)
-                                print(f"[DEBUG] Updated shared_milestones for user {user_id}: {new_shared_milestones}")
-                                break
+                        if await storage.update_user_fields(user_id, {'SHARED_MILESTONES': new_shared_milestones}):
+                            print(f"[DEBUG] Updated shared_milestones for user {user_id}: {new_shared_milestones}")
                         return  # Don't continue with the rest of the function after feedback trigger
                 # Send share prompt if user is in a group
                 try:
@@ -1348,24 +3383,15 @@ async def stop_tracking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.effective_chat:
             return
         user_id = str(update.effective_user.id)
-        rows = worksheet.get_all_records()
-        for i, row in enumerate(rows):
-            if str(row.get("user_id", "")) == user_id:
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['STATUS'], "stopped")
-                
-                # Add a "reset" entry to break the streak when they resume
-                timestamp = get_pht_timestamp()
-                try:
-                    checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-                except Exception as e:
-                    checkin_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Daily Check-ins", rows=1000, cols=5)
-                    checkin_sheet.append_row(["user_id", "status", "timestamp"])
-                checkin_sheet.append_row([user_id, "reset", timestamp])
-                print(f"[DEBUG] Added reset entry for user {user_id} when they stopped")
-                
-                if update.message:
-                    await update.message.reply_text("🛑 You've been unsubscribed from daily check-ins.")
-                return
+        if await storage.update_user_fields(user_id, {'STATUS': "stopped"}):
+
+            # Add a "reset" entry to break the streak when they resume
+            await storage.append_checkin(user_id, "reset")
+            print(f"[DEBUG] Added reset entry for user {user_id} when they stopped")
+            
+            if update.message:
+                await update.message.reply_text("🛑 You've been unsubscribed from daily check-ins.")
+            return
         if update.message:
             await update.message.reply_text(ERROR_MESSAGES['NOT_SUBSCRIBED'])
     except Exception as e:
@@ -1385,29 +3411,51 @@ async def reset_streak(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if not update.effective_chat:
             return
-        user_id = str(update.effective_user.id)
-        timestamp = get_pht_timestamp()
-
-        try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-        except Exception as e:
-            checkin_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Daily Check-ins", rows=1000, cols=5)
-            checkin_sheet.append_row(["user_id", "status", "timestamp"])
-
-        checkin_sheet.append_row([user_id, "reset", timestamp])
-        
-        # Clear reminder_sent field so user can get reminders again
-        all_rows = worksheet.get_all_records()
-        for i, r in enumerate(all_rows):
-            if str(r.get('user_id', '')) == str(user_id):
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['REMINDER_SENT'], "")
-                print(f"[DEBUG] Reset reminder_sent for user {user_id} after streak reset")
-                break
-        
-        if update.message:
-            await update.message.reply_text("🔄 Your streak has been reset to Day 1!")
+        user_id = str(update.effective_user.id)
+        await storage.append_checkin(user_id, "reset")
+        
+        # Clear reminder_sent field so user can get reminders again
+        if await storage.update_user_fields(user_id, {'REMINDER_SENT': ""}):
+            print(f"[DEBUG] Reset reminder_sent for user {user_id} after streak reset")
+        
+        if update.message:
+            await update.message.reply_text("🔄 Your streak has been reset to Day 1!")
+    except Exception as e:
+        print(f"[ERROR] Error in reset_streak: {e}")
+        if update.message:
+            await update.message.reply_text(ERROR_MESSAGES['NETWORK_ERROR'])
+
+# ✅ /checkintime command - choose when the daily check-in arrives
+async def set_checkin_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if update.effective_chat and update.effective_chat.type != "private":
+            if update.message:
+                await update.message.reply_text("Please message me privately to use /checkintime.")
+            return
+        if not update.effective_user or not update.message:
+            return
+        user_id = str(update.effective_user.id)
+        args = context.args or []
+        minute = parse_checkin_time(args[0]) if args else None
+        zone_name = args[1] if len(args) > 1 else None
+        if minute is None or (zone_name and get_timezone(zone_name) is None):
+            await update.message.reply_text(
+                "Usage: /checkintime HH:MM [timezone]\n"
+                f"Example: /checkintime 07:30 or /checkintime 21:00 Europe/London (default timezone: {CHECKIN_DEFAULT_TIMEZONE})"
+            )
+            return
+        fields = {'CHECKIN_TIME': f"{minute // 60:02d}:{minute % 60:02d}"}
+        if zone_name:
+            fields['TIMEZONE'] = zone_name
+        if not await storage.update_user_fields(user_id, fields):
+            await update.message.reply_text(ERROR_MESSAGES['NOT_SUBSCRIBED'])
+            return
+        user_row = await storage.get_user(user_id) or {}
+        await update.message.reply_text(
+            f"⏰ Got it! Your daily check-in will arrive at {fields['CHECKIN_TIME']} ({user_row.get('timezone') or CHECKIN_DEFAULT_TIMEZONE})."
+        )
     except Exception as e:
-        print(f"[ERROR] Error in reset_streak: {e}")
+        print(f"[ERROR] Error in set_checkin_time: {e}")
         if update.message:
             await update.message.reply_text(ERROR_MESSAGES['NETWORK_ERROR'])
 
@@ -1418,13 +3466,7 @@ async def check_milestones(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         user_id = str(update.effective_user.id)
-        rows = worksheet.get_all_records()
-        user_row = None
-        
-        for row in rows:
-            if str(row.get('user_id', '')) == str(user_id):
-                user_row = row
-                break
+        user_row = await storage.get_user(user_id)
         
         if not user_row:
             if update.message:
@@ -1438,21 +3480,10 @@ async def check_milestones(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Get current streak
         try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-            history = checkin_sheet.get_all_records()
+            current_streak = (await storage.get_streak(user_id))['current_streak']
         except Exception as e:
             print(f"[DEBUG] Error getting check-in history: {e}")
-            history = []
-        
-        user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-        current_streak = 0
-        for entry in user_history:
-            if entry.get("status") == "yes":
-                current_streak += 1
-            elif entry.get("status") == "reset":
-                break
-            else:
-                break
+            current_streak = 0
         
         # Get available milestones
         available_milestones = list(MILESTONE_QUESTIONS.keys())
@@ -1501,12 +3532,7 @@ async def handle_share_streak(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Get user's latest data
-        rows = worksheet.get_all_records()
-        user_data = None
-        for row in rows:
-            if str(row.get('user_id', '')) == user_id:
-                user_data = row
-                break
+        user_data = await storage.get_user(user_id)
         
         if not user_data:
             await query.edit_message_text("❌ Could not find your data. Please try again.")
@@ -1514,25 +3540,12 @@ async def handle_share_streak(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # Get current streak
         try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-            history = checkin_sheet.get_all_records()
+            current_streak = (await storage.get_streak(user_id))['current_streak']
         except Exception as e:
             print(f"[DEBUG] Error getting check-in history: {e}")
             await query.edit_message_text("❌ Could not get your streak data. Please try again.")
             return
         
-        user_history = [r for r in reversed(history) if str(r.get("user_id", "")) == str(user_id)]
-        current_streak = 0
-        for entry in user_history:
-            if entry.get("status") == "yes":
-                current_streak += 1
-            elif entry.get("status") == "reset":
-                # Stop counting when we hit a reset (user stopped and resumed)
-                break
-            else:
-                # Stop counting on any "no" or other status
-                break
-        
         if current_streak < 3:
             await query.edit_message_text("🎉 You need at least 3 days to share a milestone! Keep going!")
             return
@@ -1556,10 +3569,7 @@ async def handle_share_streak(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await query.edit_message_text(f"✅ Shared your {current_streak}-day milestone in {group}! 🎉")
                 
                 # Mark this milestone as shared
-                for i, row in enumerate(rows):
-                    if str(row.get('user_id', '')) == user_id:
-                        worksheet.update_cell(i + 2, SHEET_COLUMNS['SHARED_MILESTONES'], f"{current_streak}")
-                        break
+                await storage.update_user_fields(user_id, {'SHARED_MILESTONES': f"{current_streak}"})
                         
             except Exception as e:
                 print(f"[ERROR] Could not share in group: {e}")
@@ -1672,35 +3682,20 @@ async def finalize_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE
         reminder = "yes" if context.user_data.get("reminder_consent") else "no"
         media_id = context.user_data.get("reminder_media_id", "")
         media_type = context.user_data.get("reminder_media_type", "")
-        # Check if user already exists
-        rows = worksheet.get_all_records()
-        found = False
-        for i, row in enumerate(rows):
-            if str(row.get('user_id', '')) == str(user_id):
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['USERNAME'], str(username))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['DETOX_DAYS'], str(detox_days))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['FASTING_TARGET'], str(target))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['GROUP'], str(group))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['STATUS'], "active")
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['REMINDER'], str(reminder))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['MEDIA_ID'], str(media_id))
-                worksheet.update_cell(i + 2, SHEET_COLUMNS['MEDIA_TYPE'], str(media_type))
-                found = True
-                break
-        if not found:
-            worksheet.append_row([
-                str(user_id), str(username), str(detox_days), str(target),
-                str(group), "active", str(reminder), str(media_id), str(media_type), "", ""
-            ])
+        # Update the user's row if they already exist, otherwise add one
+        await storage.upsert_user(user_id, {
+            'USERNAME': str(username),
+            'DETOX_DAYS': str(detox_days),
+            'FASTING_TARGET': str(target),
+            'GROUP': str(group),
+            'STATUS': "active",
+            'REMINDER': str(reminder),
+            'MEDIA_ID': str(media_id),
+            'MEDIA_TYPE': str(media_type)
+        })
         
         # Add a "reset" entry for new users to ensure clean streak start
-        timestamp = get_pht_timestamp()
-        try:
-            checkin_sheet = gc.open_by_key(SHEET_ID).worksheet("Daily Check-ins")
-        except Exception as e:
-            checkin_sheet = gc.open_by_key(SHEET_ID).add_worksheet(title="Daily Check-ins", rows=1000, cols=5)
-            checkin_sheet.append_row(["user_id", "status", "timestamp"])
-        checkin_sheet.append_row([user_id, "reset", timestamp])
+        await storage.append_checkin(user_id, "reset")
         print(f"[DEBUG] Added reset entry for new user {user_id} during onboarding")
         
         # Always send the final onboarding message
@@ -1723,7 +3718,7 @@ async def finalize_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE
             permission = ''
             if idx == 3:
                 permission = a
-            feedback_sheet.append_row([
+            await storage.append_feedback([
                 str(user_id), str(username), 'Onboarding', q, a, get_pht_timestamp(), str(permission)
             ])
     except Exception as e:
@@ -1797,105 +3792,89 @@ async def skip_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 # Scheduler functions for each group
-async def send_group_text_prompt(app, group_key):
+def _prompt_position(db, group_key, kind, advance):
+    # The insert opens the write transaction, so reading and bumping the cursor is atomic
+    with db:
+        db.execute("INSERT OR IGNORE INTO prompt_cursors (group_key, kind, position) VALUES (?, ?, 0)", (group_key, kind))
+        position = db.execute(
+            "SELECT position FROM prompt_cursors WHERE group_key = ? AND kind = ?", (group_key, kind)
+        ).fetchone()[0]
+        if advance:
+            db.execute("UPDATE prompt_cursors SET position = position + 1 WHERE group_key = ? AND kind = ?", (group_key, kind))
+    return position
+
+async def next_group_prompt(group_key, kind, advance=True):
+    """Return (number, prompt) for the group's next prompt of this kind, moving the cursor past it if advance."""
+    prompts, count = GROUP_PROMPT_ROTATION[group_key][kind]
+    position = await bot_state.run(lambda: _prompt_position(bot_state.db(), group_key, kind, advance))
+    index = position % count
+    return index + 1, prompts[index]
+
+async def send_group_text_prompt(app, group_key, advance=False):
     """Send the next text prompt for a specific group."""
     try:
         chat_id = GROUP_CHAT_IDS[group_key]
-        current_index = GROUP_PROMPT_INDEX[group_key]
-        
-        # Get the text prompt at current index
-        text_prompts = GROUP_PROMPTS[group_key]["text"]
-        if current_index < len(text_prompts):
-            prompt = text_prompts[current_index]
-            await app.bot.send_message(chat_id=chat_id, text=prompt)
-            print(f"[DEBUG] Sent text prompt #{current_index + 1} to {group_key}")
-        else:
-            print(f"[DEBUG] No more text prompts for {group_key}")
-            
+        number, prompt = await next_group_prompt(group_key, "text", advance)
+        await app.bot.send_message(chat_id=chat_id, text=prompt)
+        print(f"[DEBUG] Sent text prompt #{number} to {group_key}")
     except Exception as e:
         print(f"[ERROR] Error sending text prompt to {group_key}: {e}")
 
-async def send_group_poll_prompt(app, group_key):
+async def send_group_poll_prompt(app, group_key, advance=False):
     """Send the next poll prompt for a specific group."""
     try:
         chat_id = GROUP_CHAT_IDS[group_key]
-        current_index = GROUP_PROMPT_INDEX[group_key]
-        
-        # Get the poll prompt at current index
-        poll_prompts = GROUP_PROMPTS[group_key]["polls"]
-        if current_index < len(poll_prompts):
-            poll = poll_prompts[current_index]
-            await app.bot.send_poll(
-                chat_id=chat_id, 
-                question=poll["question"], 
-                options=poll["options"], 
-                is_anonymous=False
-            )
-            print(f"[DEBUG] Sent poll prompt #{current_index + 1} to {group_key}")
-        else:
-            print(f"[DEBUG] No more poll prompts for {group_key}")
-            
+        number, poll = await next_group_prompt(group_key, "polls", advance)
+        await app.bot.send_poll(
+            chat_id=chat_id, 
+            question=poll["question"], 
+            options=poll["options"], 
+            is_anonymous=False
+        )
+        print(f"[DEBUG] Sent poll prompt #{number} to {group_key}")
     except Exception as e:
         print(f"[ERROR] Error sending poll prompt to {group_key}: {e}")
 
-def advance_group_prompt_index(group_key):
-    """Advance the prompt index for a group and reset if needed."""
-    GROUP_PROMPT_INDEX[group_key] += 1
-    # Reset to 0 if we've gone through all prompts (24 total: 12 text + 12 polls)
-    if GROUP_PROMPT_INDEX[group_key] >= 24:
-        GROUP_PROMPT_INDEX[group_key] = 0
-        print(f"[DEBUG] Reset prompt index for {group_key} to 0")
-
 # Scheduler functions for each group
 async def send_general_monday_prompt(app):
     """Send text prompt to General group on Monday."""
-    await send_group_text_prompt(app, "General")
-    advance_group_prompt_index("General")
+    await send_group_text_prompt(app, "General", advance=True)
 
 async def send_general_friday_prompt(app):
     """Send poll prompt to General group on Friday."""
-    await send_group_poll_prompt(app, "General")
-    advance_group_prompt_index("General")
+    await send_group_poll_prompt(app, "General", advance=True)
 
 async def send_nofap_tuesday_prompt(app):
     """Send text prompt to NoFap group on Tuesday."""
-    await send_group_text_prompt(app, "NoFap")
-    advance_group_prompt_index("NoFap")
+    await send_group_text_prompt(app, "NoFap", advance=True)
 
 async def send_nofap_thursday_prompt(app):
     """Send poll prompt to NoFap group on Thursday."""
-    await send_group_poll_prompt(app, "NoFap")
-    advance_group_prompt_index("NoFap")
+    await send_group_poll_prompt(app, "NoFap", advance=True)
 
 async def send_screenbreak_tuesday_prompt(app):
     """Send text prompt to ScreenBreak group on Tuesday."""
-    await send_group_text_prompt(app, "ScreenBreak")
-    advance_group_prompt_index("ScreenBreak")
+    await send_group_text_prompt(app, "ScreenBreak", advance=True)
 
 async def send_screenbreak_thursday_prompt(app):
     """Send poll prompt to ScreenBreak group on Thursday."""
-    await send_group_poll_prompt(app, "ScreenBreak")
-    advance_group_prompt_index("ScreenBreak")
+    await send_group_poll_prompt(app, "ScreenBreak", advance=True)
 
 async def send_gamebreak_tuesday_prompt(app):
     """Send text prompt to GameBreak group on Tuesday."""
-    await send_group_text_prompt(app, "GameBreak")
-    advance_group_prompt_index("GameBreak")
+    await send_group_text_prompt(app, "GameBreak", advance=True)
 
 async def send_gamebreak_thursday_prompt(app):
     """Send poll prompt to GameBreak group on Thursday."""
-    await send_group_poll_prompt(app, "GameBreak")
-    advance_group_prompt_index("GameBreak")
+    await send_group_poll_prompt(app, "GameBreak", advance=True)
 
 async def send_moneytalk_wednesday_prompt(app):
     """Send text prompt to Moneytalk group on Wednesday."""
-    await send_group_text_prompt(app, "Moneytalk")
-    advance_group_prompt_index("Moneytalk")
+    await send_group_text_prompt(app, "Moneytalk", advance=True)
 
 async def send_moneytalk_saturday_prompt(app):
     """Send poll prompt to Moneytalk group on Saturday."""
-    await send_group_poll_prompt(app, "Moneytalk")
-    advance_group_prompt_index("Moneytalk")
+    await send_group_poll_prompt(app, "Moneytalk", advance=True)
 
 async def test_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test command to manually trigger group prompts."""
@@ -1932,6 +3911,25 @@ async def test_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Error testing prompts: {e}")
 
+async def mark_feedback_completed(user_id, milestone):
+    """Add a milestone to the user's feedback_completed list in the sheet."""
+    row = await storage.get_user(user_id)
+    if not row:
+        return
+    # Get current completed milestones
+    feedback_completed = str(row.get("feedback_completed", ""))
+    completed_list = feedback_completed.split(",") if feedback_completed else []
+    completed_list = [x.strip() for x in completed_list if x.strip()]
+
+    # Add this milestone if not already present
+    if str(milestone) not in completed_list:
+        completed_list.append(str(milestone))
+
+    # Update the sheet
+    new_feedback_completed = ",".join(completed_list)
+    await storage.update_user_fields(user_id, {'FEEDBACK_COMPLETED': new_feedback_completed})
+    print(f"[DEBUG] Marked milestone {milestone} as completed for user {user_id}. Updated list: {new_feedback_completed}")
+
 # --- Feedback Question Sending Stub ---
 async def send_next_feedback_question(update, context):
     pending = context.user_data.get('pending_feedback')
@@ -1955,23 +3953,7 @@ async def send_next_feedback_question(update, context):
         user_id = pending.get('user_id')
         if user_id:
             try:
-                rows = worksheet.get_all_records()
-                for i, row in enumerate(rows):
-                    if str(row.get('user_id', '')) == str(user_id):
-                        # Get current completed milestones
-                        feedback_completed = str(row.get("feedback_completed", ""))
-                        completed_list = feedback_completed.split(",") if feedback_completed else []
-                        completed_list = [x.strip() for x in completed_list if x.strip()]
-                        
-                        # Add this milestone if not already present
-                        if str(milestone) not in completed_list:
-                            completed_list.append(str(milestone))
-                        
-                        # Update the sheet
-                        new_feedback_completed = ",".join(completed_list)
-                        worksheet.update_cell(i + 2, SHEET_COLUMNS['FEEDBACK_COMPLETED'], new_feedback_completed)
-                        print(f"[DEBUG] Marked milestone {milestone} as completed for user {user_id}. Updated list: {new_feedback_completed}")
-                        break
+                await mark_feedback_completed(user_id, milestone)
             except Exception as e:
                 print(f"[ERROR] Failed to mark milestone {milestone} as completed for user {user_id}: {e}")
         
@@ -2003,23 +3985,7 @@ async def send_next_feedback_question(update, context):
             user_id = pending.get('user_id')
             if user_id:
                 try:
-                    rows = worksheet.get_all_records()
-                    for i, row in enumerate(rows):
-                        if str(row.get('user_id', '')) == str(user_id):
-                            # Get current completed milestones
-                            feedback_completed = str(row.get("feedback_completed", ""))
-                            completed_list = feedback_completed.split(",") if feedback_completed else []
-                            completed_list = [x.strip() for x in completed_list if x.strip()]
-                            
-                            # Add this milestone if not already present
-                            if str(milestone) not in completed_list:
-                                completed_list.append(str(milestone))
-                            
-                            # Update the sheet
-                            new_feedback_completed = ",".join(completed_list)
-                            worksheet.update_cell(i + 2, SHEET_COLUMNS['FEEDBACK_COMPLETED'], new_feedback_completed)
-                            print(f"[DEBUG] Marked milestone {milestone} as completed for user {user_id}. Updated list: {new_feedback_completed}")
-                            break
+                    await mark_feedback_completed(user_id, milestone)
                 except Exception as e:
                     print(f"[ERROR] Failed to mark milestone {milestone} as completed for user {user_id}: {e}")
             
@@ -2085,7 +4051,7 @@ async def handle_feedback_response(update: Update, context: ContextTypes.DEFAULT
     field = questions[q_idx].get('field', '')
     if field in ['permission', 'marketing_permission']:
         permission = answer
-    feedback_sheet.append_row([
+    await storage.append_feedback([
         str(pending['user_id']) if pending['user_id'] is not None else '',
         str(pending['username']) if pending['username'] is not None else '',
         f"Day {milestone}",
@@ -2131,23 +4097,7 @@ async def handle_feedback_response(update: Update, context: ContextTypes.DEFAULT
         user_id = pending.get('user_id')
         if user_id:
             try:
-                rows = worksheet.get_all_records()
-                for i, row in enumerate(rows):
-                    if str(row.get('user_id', '')) == str(user_id):
-                        # Get current completed milestones
-                        feedback_completed = str(row.get("feedback_completed", ""))
-                        completed_list = feedback_completed.split(",") if feedback_completed else []
-                        completed_list = [x.strip() for x in completed_list if x.strip()]
-                        
-                        # Add this milestone if not already present
-                        if str(milestone) not in completed_list:
-                            completed_list.append(str(milestone))
-                        
-                        # Update the sheet
-                        new_feedback_completed = ",".join(completed_list)
-                        worksheet.update_cell(i + 2, SHEET_COLUMNS['FEEDBACK_COMPLETED'], new_feedback_completed)
-                        print(f"[DEBUG] Marked milestone {milestone} as completed for user {user_id}. Updated list: {new_feedback_completed}")
-                        break
+                await mark_feedback_completed(user_id, milestone)
             except Exception as e:
                 print(f"[ERROR] Failed to mark milestone {milestone} as completed for user {user_id}: {e}")
         
@@ -2195,136 +4145,921 @@ async def handle_testimonial_response(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text(
             "Can we use your testimonial for marketing (anonymously)?", reply_markup=reply_markup
         )
-        return True
-    elif pending['step'] == 'ask_permission' and update.callback_query:
-        data = update.callback_query.data
-        await update.callback_query.answer()
-        permission = 'Yes' if data == 'testimonial_permission_yes' else 'No'
-        feedback_sheet.append_row([
-            pending['user_id'],
-            pending['username'],
-            'Testimonial',
-            'Testimonial',
-            pending['testimonial'],
-            pending['timestamp'],
-            permission
-        ])
-        context.user_data.pop('pending_testimonial', None)
-        await update.callback_query.edit_message_text(
-            "Thank you for sharing your story! Keep inspiring others."
+        return True
+    elif pending['step'] == 'ask_permission' and update.callback_query:
+        data = update.callback_query.data
+        await update.callback_query.answer()
+        permission = 'Yes' if data == 'testimonial_permission_yes' else 'No'
+        await storage.append_feedback([
+            pending['user_id'],
+            pending['username'],
+            'Testimonial',
+            'Testimonial',
+            pending['testimonial'],
+            pending['timestamp'],
+            permission
+        ])
+        context.user_data.pop('pending_testimonial', None)
+        await update.callback_query.edit_message_text(
+            "Thank you for sharing your story! Keep inspiring others."
+        )
+        return True
+    return False  # Not handled
+
+# --- Handler for milestone testimonial prompt ---
+async def handle_milestone_testimonial_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    print("[DEBUG] handle_milestone_testimonial_response called")
+    if not hasattr(context, 'user_data') or not isinstance(context.user_data, dict):
+        context.user_data = {}
+    pending = context.user_data.get('pending_milestone_testimonial')
+    if not pending:
+        print("[DEBUG] No pending milestone testimonial, allowing fallthrough")
+        return False  # Allow fallthrough to main handler
+    if update.callback_query:
+        data = update.callback_query.data
+        await update.callback_query.answer()
+        if data == 'milestone_testimonial_yes':
+            pending['step'] = 'write_testimonial'
+            context.user_data['pending_milestone_testimonial'] = pending
+            await update.callback_query.edit_message_text(
+                "Awesome! Please write your testimonial below."
+            )
+            return True
+        elif data == 'milestone_testimonial_no':
+            context.user_data.pop('pending_milestone_testimonial', None)
+            await update.callback_query.edit_message_text(
+                "Ok, keep up the great work!"
+            )
+            return True
+    elif pending['step'] == 'write_testimonial' and update.message and update.message.text:
+        pending['testimonial'] = update.message.text.strip()
+        pending['step'] = 'ask_permission'
+        context.user_data['pending_milestone_testimonial'] = pending
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Yes", callback_data="milestone_testimonial_permission_yes"), InlineKeyboardButton("No", callback_data="milestone_testimonial_permission_no")]
+        ])
+        await update.message.reply_text(
+            "Can we use your testimonial for marketing (anonymously)?", reply_markup=reply_markup
+        )
+        return True
+    elif pending['step'] == 'ask_permission' and update.callback_query:
+        data = update.callback_query.data
+        await update.callback_query.answer()
+        permission = 'Yes' if data == 'milestone_testimonial_permission_yes' else 'No'
+        await storage.append_feedback([
+            pending['user_id'],
+            pending['username'],
+            f"Day {pending['milestone']} Testimonial",
+            'Testimonial',
+            pending['testimonial'],
+            pending['timestamp'],
+            permission
+        ])
+        context.user_data.pop('pending_milestone_testimonial', None)
+        await update.callback_query.edit_message_text(
+            "Thank you for sharing your story! Keep inspiring others."
+        )
+        return True
+    return False  # Not handled
+
+# Add this handler function
+async def handle_baseline_permission_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not hasattr(context, 'user_data') or not isinstance(context.user_data, dict):
+        context.user_data = {}
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    await query.answer()
+    try:
+        await query.edit_message_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    if query.data == 'baseline_permission_yes':
+        context.user_data['onboarding_baseline_permission'] = 'yes'
+        await ask_onboarding_baseline(update, context)
+    else:
+        context.user_data['onboarding_baseline_permission'] = 'no'
+        # Provide a proper response when user declines baseline questions
+        if query.message:
+            await query.message.reply_text("👍 No problem! We'll skip the baseline questions and get you set up right away.")
+        await finalize_onboarding(update, context)
+
+# --- Release announcements ---
+# Each release is announced once, in the background after startup. The run id comes from
+# RELEASE_ID (or Railway's commit SHA); without one, the announcement text itself identifies
+# the release, so restarts never repeat an announcement that already went out.
+ANNOUNCE_ON_DEPLOY = os.getenv("ANNOUNCE_ON_DEPLOY", "1") == "1"
+UPDATE_ANNOUNCEMENT = os.getenv(
+    "UPDATE_ANNOUNCEMENT", "🚀 Kaka-install lang ng update sakin! Check out what's new or DM me for help. 💡"
+)
+RELEASE_ID = os.getenv("RELEASE_ID") or os.getenv("RAILWAY_GIT_COMMIT_SHA") or f"{zlib.crc32(UPDATE_ANNOUNCEMENT.encode()):08x}"
+ANNOUNCE_CONCURRENCY = int(os.getenv("ANNOUNCE_CONCURRENCY", "4"))
+ANNOUNCE_PROGRESS_INTERVAL_SECONDS = float(os.getenv("ANNOUNCE_PROGRESS_INTERVAL_SECONDS", "30"))
+
+def announcement_run_id(release_id=RELEASE_ID):
+    return f"announcement:{release_id}"
+
+async def log_delivery_progress(run_id, interval=ANNOUNCE_PROGRESS_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(interval)
+        print(f"[DEBUG] Delivery {run_id} progress: {await delivery_ledger.progress(run_id)}")
+
+async def announce_update(app):
+    """Announce this release to all groups and active users, once per release.
+
+    Runs as a background job: it sends at ANNOUNCE_CONCURRENCY so replies to
+    users keep most of the send rate, and logs progress while it drains.
+    """
+    run_id = announcement_run_id()
+    items = [
+        (run_id, f"group:{group_name}", {'chat_id': chat_id, 'text': UPDATE_ANNOUNCEMENT})
+        for group_name, chat_id in GROUP_CHAT_IDS.items()
+    ]
+    try:
+        rows = await storage.list_users()
+    except Exception as e:
+        print(f"[ERROR] Could not load users for the update announcement: {e}")
+        rows = []
+    items += [
+        (run_id, str(row.get("user_id")), {'chat_id': int(row.get("user_id")), 'text': UPDATE_ANNOUNCEMENT})
+        for row in rows
+        if str(row.get("status", "")).lower() == "active" and row.get("user_id")
+    ]
+    progress = asyncio.create_task(log_delivery_progress(run_id))
+    try:
+        report = await deliver(app.bot, items, "announcement", concurrency=ANNOUNCE_CONCURRENCY)
+    finally:
+        progress.cancel()
+    print(f"[DEBUG] Update announcement {run_id} report: {report}")
+
+# --- Scheduled jobs ---
+# A run that starts late (slow restart, event loop busy) still fires within this many seconds;
+# missed runs are coalesced into one and a job never overlaps with its own previous run
+SCHEDULER_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHEDULER_MISFIRE_GRACE_SECONDS", "3600"))
+scheduler = None
+
+def log_job_event(event):
+    """Report scheduled jobs that failed, were missed, or were skipped because the previous run is still going."""
+    if event.code == EVENT_JOB_ERROR:
+        print(f"[ERROR] Scheduled job {event.job_id} failed: {event.exception!r}")
+    elif event.code == EVENT_JOB_MISSED:
+        print(f"[ERROR] Scheduled job {event.job_id} missed its run time {event.scheduled_run_time}")
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        print(f"[ERROR] Scheduled job {event.job_id} skipped: previous run is still in progress")
+
+def start_scheduler(app):
+    """Schedule the daily check-in and group prompt jobs on the running event loop."""
+    global scheduler
+    scheduler = AsyncIOScheduler(job_defaults={
+        'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_SECONDS,
+        'coalesce': True,
+        'max_instances': 1
+    })
+    scheduler.add_listener(log_job_event, EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    
+    # Daily check-ins go out in per-user minute slots (default 9AM PHT, spread over a window)
+    scheduler.add_job(
+        send_due_checkins,
+        CronTrigger(second=0),
+        args=[app],
+        id="daily_checkins",
+        misfire_grace_time=50
+    )
+    
+    # Pick up a rebuilt answer index (build_answer_index.py) without a restart
+    scheduler.add_job(
+        reload_answer_index,
+        CronTrigger(minute='*/30'),
+        id="reload_answer_index"
+    )
+    
+    # Schedule group prompts - all at 9AM PHT (UTC+8)
+    # General: Monday (text) + Friday (poll)
+    scheduler.add_job(
+        send_general_monday_prompt,
+        CronTrigger(day_of_week='mon', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="general_monday_prompt"
+    )
+    scheduler.add_job(
+        send_general_friday_prompt,
+        CronTrigger(day_of_week='fri', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="general_friday_prompt"
+    )
+    
+    # NoFap: Tuesday (text) + Thursday (poll)
+    scheduler.add_job(
+        send_nofap_tuesday_prompt,
+        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="nofap_tuesday_prompt"
+    )
+    scheduler.add_job(
+        send_nofap_thursday_prompt,
+        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="nofap_thursday_prompt"
+    )
+    
+    # ScreenBreak: Tuesday (text) + Thursday (poll)
+    scheduler.add_job(
+        send_screenbreak_tuesday_prompt,
+        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="screenbreak_tuesday_prompt"
+    )
+    scheduler.add_job(
+        send_screenbreak_thursday_prompt,
+        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="screenbreak_thursday_prompt"
+    )
+    
+    # GameBreak: Tuesday (text) + Thursday (poll)
+    scheduler.add_job(
+        send_gamebreak_tuesday_prompt,
+        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="gamebreak_tuesday_prompt"
+    )
+    scheduler.add_job(
+        send_gamebreak_thursday_prompt,
+        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="gamebreak_thursday_prompt"
+    )
+    
+    # Moneytalk: Wednesday (text) + Saturday (poll)
+    scheduler.add_job(
+        send_moneytalk_wednesday_prompt,
+        CronTrigger(day_of_week='wed', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="moneytalk_wednesday_prompt"
+    )
+    scheduler.add_job(
+        send_moneytalk_saturday_prompt,
+        CronTrigger(day_of_week='sat', hour=9, minute=0, timezone='Asia/Manila'),
+        args=[app],
+        id="moneytalk_saturday_prompt"
+    )
+    
+    scheduler.start()
+    print("📅 Group prompts scheduled:")
+    print("   - General: Monday 9AM (text) + Friday 9AM (poll)")
+    print("   - NoFap: Tuesday 9AM (text) + Thursday 9AM (poll)")
+    print("   - ScreenBreak: Tuesday 9AM (text) + Thursday 9AM (poll)")
+    print("   - GameBreak: Tuesday 9AM (text) + Thursday 9AM (poll)")
+    print("   - Moneytalk: Wednesday 9AM (text) + Saturday 9AM (poll)")
+    return scheduler
+
+# --- Startup ---
+# Each startup phase is timed; the timings are logged once the bot is ready to
+# take updates and reported under "boot" in /healthz.
+boot_timings = {}
+
+@contextlib.contextmanager
+def boot_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        boot_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+async def warm_up_storage():
+    """Preload the Sheets data handlers need, in the background, so startup never waits on Google."""
+    with boot_phase("storage_warm_up"):
+        try:
+            await storage.warm_up()
+        except Exception as e:
+            print(f"[ERROR] Storage warm-up failed, data will load on first use: {e}")
+    print(f"[DEBUG] Storage warm-up took {boot_timings['storage_warm_up']}ms")
+
+async def warm_up_openai():
+    """Import the OpenAI SDK on a worker thread so the first GPT reply doesn't pay for it."""
+    with boot_phase("openai_import"):
+        await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "openai")
+
+async def post_init(application):
+    """Start background workers once the Application's event loop is running."""
+    with boot_phase("storage_start"):
+        await storage.start()
+    with boot_phase("scheduler"):
+        start_scheduler(application)
+    asyncio.create_task(warm_up_storage())
+    asyncio.create_task(warm_up_openai())
+    asyncio.create_task(reload_answer_index())
+    asyncio.create_task(background_deliveries(application))
+    boot_timings['ready'] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+    print(f"[DEBUG] Boot timings (ms): {boot_timings}")
+
+async def post_stop(application):
+    """Stop scheduled jobs and in-flight broadcasts while the bot can still reach Telegram."""
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    await delivery_ledger.stop()
+
+async def post_shutdown(application):
+    """Flush queued Sheets writes and close shared clients before the process exits."""
+    await storage.stop()
+    await close_openai_client()
+    await bot_state.close()
+
+# --- Bot state persistence ---
+# Local SQLite file for state that must survive a redeploy (in-flight conversations, prompt rotation,
+# delivery ledger) and the GPT answers the answer index is built from
+BOT_STATE_DB_PATH = os.getenv("BOT_STATE_DB_PATH", "bot_state.db")
+USER_DATA_FLUSH_INTERVAL_SECONDS = float(os.getenv("USER_DATA_FLUSH_INTERVAL_SECONDS", "10"))
+
+BOT_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prompt_cursors (
+    group_key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_key, kind)
+);
+CREATE TABLE IF NOT EXISTS scheduler_state (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS delivery_runs (
+    run_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS delivery_ledger (
+    run_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    message TEXT,
+    PRIMARY KEY (run_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_delivery_ledger_state ON delivery_ledger (state, run_id);
+CREATE TABLE IF NOT EXISTS unsent_sheet_writes (
+    id INTEGER PRIMARY KEY,
+    sheet TEXT NOT NULL,
+    op TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS gpt_answers (
+    id INTEGER PRIMARY KEY,
+    question TEXT NOT NULL,
+    habit TEXT NOT NULL,
+    bucket INTEGER,
+    group_name TEXT,
+    answer TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+class BotStateStore:
+    """SQLite file for bot state, accessed from one worker thread so calls never block the event loop."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-state")
+
+    def db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(BOT_STATE_SCHEMA)
+            # Answers logged before the streak bucket and group were kept have NULL there
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(gpt_answers)")}
+            for column, kind in (("bucket", "INTEGER"), ("group_name", "TEXT")):
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE gpt_answers ADD COLUMN {column} {kind}")
+        return self._conn
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def close(self):
+        if self._conn is not None:
+            await self.run(self._conn.close)
+            self._conn = None
+
+bot_state = BotStateStore(BOT_STATE_DB_PATH)
+
+def save_unsent_sheet_writes(db, dropped):
+    """Keep [(op, reason)] sheet writes that could not be sent; reason "shutdown" ones are re-queued on the next start."""
+    now = utc_now_iso()
+    with db:
+        db.executemany(
+            "INSERT INTO unsent_sheet_writes (sheet, op, reason, created_at) VALUES (?, ?, ?, ?)",
+            [(op['sheet'], json.dumps(op), reason, now) for op, reason in dropped]
+        )
+
+def take_shutdown_sheet_writes(db):
+    """Remove and return the sheet writes saved at the last shutdown, oldest first."""
+    with db:
+        rows = db.execute("SELECT id, op FROM unsent_sheet_writes WHERE reason = 'shutdown' ORDER BY id").fetchall()
+        db.execute("DELETE FROM unsent_sheet_writes WHERE reason = 'shutdown'")
+    ops = []
+    for _, data in rows:
+        op = json.loads(data)
+        if 'cell' in op:
+            op['cell'] = tuple(op['cell'])
+        ops.append(op)
+    return ops
+
+# Delivery ledger: outcomes are written in batches of this size; pending sends older than the
+# max age are not resumed after a restart (a check-in from the morning is stale by evening)
+DELIVERY_LEDGER_BATCH_SIZE = int(os.getenv("DELIVERY_LEDGER_BATCH_SIZE", "200"))
+DELIVERY_RESUME_MAX_AGE_HOURS = float(os.getenv("DELIVERY_RESUME_MAX_AGE_HOURS", "6"))
+
+def utc_now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+def run_may_grow(run_id, kind, utc_today):
+    """True while a day-keyed check-in run can still gain users.
+
+    "checkins:<local date>" is shared by everyone on that local date, so it
+    stays open until the date has passed in every timezone (UTC-12 to UTC+14),
+    including a catch-up run just after midnight.
+    """
+    if kind != "checkins":
+        return False
+    try:
+        local_date = datetime.date.fromisoformat(run_id.split(":", 1)[1])
+    except (IndexError, ValueError):
+        return False
+    return local_date >= utc_today - datetime.timedelta(days=2)
+
+def encode_message(message):
+    message = dict(message)
+    if message.get('reply_markup') is not None:
+        message['reply_markup'] = message['reply_markup'].to_dict()
+    return json.dumps(message)
+
+def decode_message(data):
+    message = json.loads(data)
+    if message.get('reply_markup') is not None:
+        message['reply_markup'] = InlineKeyboardMarkup.de_json(message['reply_markup'], None)
+    return message
+
+class DeliveryLedger:
+    """Durable per-user record of broadcast deliveries, for resumable, idempotent runs.
+
+    Every broadcast belongs to a run id. Before sending, each (run, user) is
+    recorded as pending together with its message; a user already in the run
+    is skipped, so a run can be started again without double sends. Outcomes
+    (sent/blocked/failed) are written in batches. After a restart, pending
+    rows are sent from the stored messages without re-reading the Sheet.
+
+    Once a finished run is older than the resume window its per-user rows
+    are deleted and the run is marked compacted; the run row itself stays,
+    so the whole run is still skipped if it is ever started again. Check-in
+    runs are only compacted once their local date is over everywhere, since
+    users with a later check-in time join the same run during that day.
+    """
+
+    def __init__(self, store, batch_size=DELIVERY_LEDGER_BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        self._results = []
+        self._tasks = set()
+
+    def _plan(self, items, kind):
+        db = self.store.db()
+        now = utc_now_iso()
+        planned = []
+        with db:
+            compacted = {row[0] for row in db.execute("SELECT run_id FROM delivery_runs WHERE status = 'compacted'")}
+            items = [item for item in items if item[0] not in compacted]
+            for run_id in {run_id for run_id, _, _ in items}:
+                db.execute(
+                    "INSERT INTO delivery_runs (run_id, kind, status, created_at, updated_at) VALUES (?, ?, 'running', ?, ?) "
+                    "ON CONFLICT(run_id) DO UPDATE SET status = 'running', updated_at = excluded.updated_at",
+                    (run_id, kind, now, now)
+                )
+            for run_id, user_id, message in items:
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO delivery_ledger (run_id, user_id, state, message) VALUES (?, ?, 'pending', ?)",
+                    (run_id, str(user_id), encode_message(message))
+                )
+                if cursor.rowcount:
+                    planned.append((run_id, str(user_id), message))
+        return planned
+
+    def _save_results(self, results):
+        db = self.store.db()
+        with db:
+            db.executemany(
+                "UPDATE delivery_ledger SET state = ?, message = NULL WHERE run_id = ? AND user_id = ?", results
+            )
+
+    def _finish(self, run_ids, max_age_hours):
+        db = self.store.db()
+        now = utc_now_iso()
+        with db:
+            for run_id in run_ids:
+                db.execute(
+                    "UPDATE delivery_runs SET status = 'done', updated_at = ? WHERE run_id = ? AND NOT EXISTS "
+                    "(SELECT 1 FROM delivery_ledger WHERE run_id = ? AND state = 'pending')",
+                    (now, run_id, run_id)
+                )
+        self._compact(max_age_hours)
+
+    def _compact(self, max_age_hours):
+        # Finished runs past the resume window only need their run row to stay idempotent
+        db = self.store.db()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = (now - datetime.timedelta(hours=max_age_hours)).isoformat(timespec="seconds")
+        with db:
+            old = [run_id for run_id, kind in db.execute(
+                "SELECT run_id, kind FROM delivery_runs WHERE status = 'done' AND updated_at < ?", (cutoff,)
+            ) if not run_may_grow(run_id, kind, now.date())]
+            for run_id in old:
+                db.execute("DELETE FROM delivery_ledger WHERE run_id = ?", (run_id,))
+                db.execute("UPDATE delivery_runs SET status = 'compacted' WHERE run_id = ?", (run_id,))
+        if old:
+            print(f"[DEBUG] Compacted {len(old)} finished delivery runs: {old}")
+
+    def _resumable(self, max_age_hours):
+        db = self.store.db()
+        cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=max_age_hours)).isoformat(timespec="seconds")
+        with db:
+            stale = [row[0] for row in db.execute(
+                "SELECT run_id FROM delivery_runs WHERE status = 'running' AND updated_at < ?", (cutoff,)
+            )]
+            for run_id in stale:
+                db.execute("UPDATE delivery_ledger SET state = 'expired', message = NULL WHERE run_id = ? AND state = 'pending'", (run_id,))
+                db.execute("UPDATE delivery_runs SET status = 'done' WHERE run_id = ?", (run_id,))
+        self._compact(max_age_hours)
+        rows = db.execute(
+            "SELECT l.run_id, r.kind, l.user_id, l.message FROM delivery_ledger l JOIN delivery_runs r ON r.run_id = l.run_id "
+            "WHERE r.status = 'running' AND l.state = 'pending'"
+        ).fetchall()
+        return stale, rows
+
+    def _progress(self, run_id):
+        counts = dict(self.store.db().execute(
+            "SELECT state, COUNT(*) FROM delivery_ledger WHERE run_id = ? GROUP BY state", (run_id,)
+        ).fetchall())
+        status = self.store.db().execute("SELECT status FROM delivery_runs WHERE run_id = ?", (run_id,)).fetchone()
+        return dict(counts, status=status[0] if status else None)
+
+    async def plan(self, items, kind):
+        """Record [(run_id, user_id, message)] as pending; returns only the ones not already in their run."""
+        return await self.store.run(self._plan, items, kind)
+
+    async def record(self, run_id, user_id, outcome):
+        self._results.append((outcome, run_id, str(user_id)))
+        if len(self._results) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        results, self._results = self._results, []
+        if results:
+            await self.store.run(self._save_results, results)
+
+    async def finish(self, run_ids, max_age_hours=DELIVERY_RESUME_MAX_AGE_HOURS):
+        await self.store.run(self._finish, list(run_ids), max_age_hours)
+
+    async def resumable(self, max_age_hours=DELIVERY_RESUME_MAX_AGE_HOURS):
+        """Return {kind: [(run_id, user_id, message)]} still pending in recent runs; older runs are expired."""
+        stale, rows = await self.store.run(self._resumable, max_age_hours)
+        if stale:
+            print(f"[DEBUG] Expired {len(stale)} delivery runs too old to resume: {stale}")
+        pending = {}
+        for run_id, kind, user_id, message in rows:
+            pending.setdefault(kind, []).append((run_id, user_id, decode_message(message)))
+        return pending
+
+    async def progress(self, run_id):
+        """Return the run's status and how many users are pending/sent/blocked/failed."""
+        return await self.store.run(self._progress, run_id)
+
+    def track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Cancel running deliveries and write every outcome recorded so far."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+delivery_ledger = DeliveryLedger(bot_state)
+
+async def deliver(bot, items, kind, spread_seconds=None, resume=False, concurrency=BROADCAST_CONCURRENCY):
+    """Broadcast [(run_id, user_id, message)] at most once per run and user, recording outcomes in the ledger."""
+    total = len(items)
+    run_ids = {run_id for run_id, _, _ in items}
+    if not resume:
+        items = await delivery_ledger.plan(items, kind)
+    targets = {id(message): (run_id, user_id) for run_id, user_id, message in items}
+
+    async def on_result(message, outcome):
+        run_id, user_id = targets[id(message)]
+        await delivery_ledger.record(run_id, user_id, outcome)
+
+    delivery_ledger.track(asyncio.current_task())
+    try:
+        report = await broadcast(
+            bot, [message for _, _, message in items],
+            concurrency=concurrency, spread_seconds=spread_seconds, on_result=on_result
+        )
+    finally:
+        await delivery_ledger.flush()
+        await delivery_ledger.finish(run_ids)
+    report['skipped'] = total - len(items)
+    return report
+
+async def resume_deliveries(app):
+    """Return jobs that finish broadcasts interrupted by a restart, from the ledger's stored messages."""
+    try:
+        pending = await delivery_ledger.resumable()
+    except Exception as e:
+        print(f"[ERROR] Could not read the delivery ledger: {e}")
+        pending = {}
+
+    async def resume(kind, items):
+        print(f"[DEBUG] Resuming {len(items)} pending {kind} deliveries")
+        concurrency = ANNOUNCE_CONCURRENCY if kind == "announcement" else BROADCAST_CONCURRENCY
+        report = await deliver(app.bot, items, kind, resume=True, concurrency=concurrency)
+        print(f"[DEBUG] Resumed {kind} deliveries: {report}")
+
+    return [resume(kind, items) for kind, items in pending.items()]
+
+async def background_deliveries(app):
+    """Resume interrupted broadcasts and announce the release, without holding up startup.
+
+    The ledger is read before the announcement is planned, so a resumed
+    announcement and this release's announcement never pick up the same user.
+    """
+    jobs = await resume_deliveries(app)
+    if ANNOUNCE_ON_DEPLOY:
+        jobs.append(announce_update(app))
+    await asyncio.gather(*jobs)
+
+class SqliteUserDataPersistence(BasePersistence):
+    """Persists context.user_data so onboarding, feedback and testimonial flows survive restarts.
+
+    Only user_data is stored, one JSON row per user. The Application hands
+    over the users that had updates every USER_DATA_FLUSH_INTERVAL_SECONDS;
+    users whose data did not change since the last write are skipped, and the
+    rest are written together in one transaction.
+    """
+
+    def __init__(self, store, update_interval=USER_DATA_FLUSH_INTERVAL_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
         )
-        return True
-    return False  # Not handled
+        self.store = store
+        self._written = {}
+        self._pending = {}
+        self._write_task = None
 
-# --- Handler for milestone testimonial prompt ---
-async def handle_milestone_testimonial_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("[DEBUG] handle_milestone_testimonial_response called")
-    if not hasattr(context, 'user_data') or not isinstance(context.user_data, dict):
-        context.user_data = {}
-    pending = context.user_data.get('pending_milestone_testimonial')
-    if not pending:
-        print("[DEBUG] No pending milestone testimonial, allowing fallthrough")
-        return False  # Allow fallthrough to main handler
-    if update.callback_query:
-        data = update.callback_query.data
-        await update.callback_query.answer()
-        if data == 'milestone_testimonial_yes':
-            pending['step'] = 'write_testimonial'
-            context.user_data['pending_milestone_testimonial'] = pending
-            await update.callback_query.edit_message_text(
-                "Awesome! Please write your testimonial below."
+    def _load(self):
+        rows = self.store.db().execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: data for user_id, data in rows}
+
+    def _save(self, changes):
+        db = self.store.db()
+        timestamp = get_pht_timestamp()
+        with db:
+            db.executemany(
+                "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(user_id, data, timestamp) for user_id, data in changes.items() if data is not None]
             )
-            return True
-        elif data == 'milestone_testimonial_no':
-            context.user_data.pop('pending_milestone_testimonial', None)
-            await update.callback_query.edit_message_text(
-                "Ok, keep up the great work!"
+            db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in changes.items() if data is None]
             )
-            return True
-    elif pending['step'] == 'write_testimonial' and update.message and update.message.text:
-        pending['testimonial'] = update.message.text.strip()
-        pending['step'] = 'ask_permission'
-        context.user_data['pending_milestone_testimonial'] = pending
-        reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Yes", callback_data="milestone_testimonial_permission_yes"), InlineKeyboardButton("No", callback_data="milestone_testimonial_permission_no")]
-        ])
-        await update.message.reply_text(
-            "Can we use your testimonial for marketing (anonymously)?", reply_markup=reply_markup
-        )
-        return True
-    elif pending['step'] == 'ask_permission' and update.callback_query:
-        data = update.callback_query.data
-        await update.callback_query.answer()
-        permission = 'Yes' if data == 'milestone_testimonial_permission_yes' else 'No'
-        feedback_sheet.append_row([
-            pending['user_id'],
-            pending['username'],
-            f"Day {pending['milestone']} Testimonial",
-            'Testimonial',
-            pending['testimonial'],
-            pending['timestamp'],
-            permission
-        ])
-        context.user_data.pop('pending_milestone_testimonial', None)
-        await update.callback_query.edit_message_text(
-            "Thank you for sharing your story! Keep inspiring others."
-        )
-        return True
-    return False  # Not handled
 
-# Add this handler function
-async def handle_baseline_permission_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not hasattr(context, 'user_data') or not isinstance(context.user_data, dict):
-        context.user_data = {}
-    query = update.callback_query
-    if not query or not query.data:
-        return
-    await query.answer()
-    try:
-        await query.edit_message_reply_markup(reply_markup=None)
-    except Exception:
+    async def _write_pending(self):
+        # Let the rest of this persistence round stage its users first
+        await asyncio.sleep(0)
+        changes, self._pending = self._pending, {}
+        self._write_task = None
+        if not changes:
+            return
+        try:
+            await self.store.run(self._save, changes)
+            self._written.update(changes)
+            print(f"[DEBUG] Persisted user_data for {len(changes)} users")
+        except Exception as e:
+            print(f"[ERROR] Could not persist user_data: {e}")
+            # Keep them for the next round unless newer data has been staged since
+            for user_id, data in changes.items():
+                self._pending.setdefault(user_id, data)
+
+    def _stage(self, user_id, data):
+        self._pending[user_id] = data
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def get_user_data(self):
+        rows = await self.store.run(self._load)
+        self._written = dict(rows)
+        user_data = {}
+        for user_id, data in rows.items():
+            try:
+                user_data[user_id] = json.loads(data)
+            except ValueError as e:
+                print(f"[ERROR] Ignoring unreadable user_data for {user_id}: {e}")
+        print(f"[DEBUG] Restored user_data for {len(user_data)} users")
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        try:
+            serialized = json.dumps(data, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            print(f"[ERROR] user_data for {user_id} is not JSON serializable, not persisted: {e}")
+            return
+        if self._written.get(user_id) == serialized and user_id not in self._pending:
+            return
+        self._stage(user_id, serialized)
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._written or user_id in self._pending:
+            self._stage(user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
         pass
-    if query.data == 'baseline_permission_yes':
-        context.user_data['onboarding_baseline_permission'] = 'yes'
-        await ask_onboarding_baseline(update, context)
-    else:
-        context.user_data['onboarding_baseline_permission'] = 'no'
-        # Provide a proper response when user declines baseline questions
-        if query.message:
-            await query.message.reply_text("👍 No problem! We'll skip the baseline questions and get you set up right away.")
-        await finalize_onboarding(update, context)
 
-async def announce_update(app):
-    update_message = "🚀 Kaka-install lang ng update sakin! Check out what's new or DM me for help. 💡"
-    # Announce in all groups
-    for group_name, chat_id in GROUP_CHAT_IDS.items():
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            self._write_task = asyncio.create_task(self._write_pending())
+            await self._write_task
+
+    # Only user_data is persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# Updates waiting to be handled; when full, polling waits and the webhook answers 503 so Telegram retries later
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Handlers that may run at the same time (updates from one user always run one after another)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently, and each user's updates in order.
+
+    Every update takes its user's lock before it may run, so onboarding state
+    in context.user_data never sees two updates from the same chat at once,
+    while a slow GPT reply for one user no longer holds up everyone else's
+    check-in taps. At most `concurrency` handlers run at a time. stats()
+    reports how many updates are running and how many are queued.
+    """
+
+    def __init__(self, concurrency, max_pending):
+        # PTB's own semaphore only bounds how many updates may be waiting here
+        super().__init__(max(2, max_pending))
+        self.concurrency = concurrency
+        self._slots = None
+        self._user_locks = {}
+        self._user_waiters = collections.Counter()
+        self.running = 0
+        self.waiting = 0
+        self.processed = 0
+        self.max_waiting = 0
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        print(f"[DEBUG] Update processor stats at shutdown: {self.stats()}")
+
+    @staticmethod
+    def _ordering_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
+
+    @staticmethod
+    def _is_chat_message(update):
+        message = getattr(update, 'message', None)
+        return message is not None and bool(message.text) and not message.text.startswith('/')
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        if key is None:
+            lock = contextlib.nullcontext()
+        else:
+            lock = self._user_locks.setdefault(key, asyncio.Lock())
+            self._user_waiters[key] += 1
+            if lock.locked() and self._is_chat_message(update):
+                # The user wrote again while an earlier message is still being handled:
+                # if that one is still queued for GPT, answer this newer one instead
+                gpt_admission.supersede(key)
         try:
-            await app.bot.send_message(chat_id=chat_id, text=update_message)
-        except Exception as e:
-            print(f"[ERROR] Could not send update to group {group_name}: {e}")
-    # Announce to all active users
-    try:
-        rows = worksheet.get_all_records()
-        for row in rows:
-            if str(row.get("status", "")).lower() == "active":
-                user_id = row.get("user_id")
-                if user_id:
+            async with lock:
+                async with self._slots:
+                    self.waiting -= 1
+                    self.running += 1
                     try:
-                        await app.bot.send_message(chat_id=int(user_id), text=update_message)
-                    except Exception as e:
-                        print(f"[ERROR] Could not send update to user {user_id}: {e}")
-    except Exception as e:
-        print(f"[ERROR] Could not send update to users: {e}")
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            if key is not None:
+                self._user_waiters[key] -= 1
+                if self._user_waiters[key] == 0:
+                    del self._user_waiters[key]
+                    self._user_locks.pop(key, None)
 
-# ✅ Start app
-if __name__ == '__main__':
-    print("[DEBUG] Entered __main__ block")
-    print("[DEBUG] Starting bot setup...")
-    TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not TELEGRAM_BOT_TOKEN:
-        print("[ERROR] TELEGRAM_BOT_TOKEN environment variable is not set. Exiting.")
-        exit(1)
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    @contextlib.asynccontextmanager
+    async def released_slot(self):
+        """Give up the running handler's concurrency slot while it waits on something slow.
+
+        The user's lock stays held, so their updates remain in order.
+        """
+        self._slots.release()
+        self.running -= 1
+        try:
+            yield
+        finally:
+            try:
+                # Shielded so a cancelled handler still takes its slot back for the caller to release
+                await asyncio.shield(self._slots.acquire())
+            finally:
+                self.running += 1
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'processed': self.processed,
+            'users_with_pending_updates': len(self._user_locks),
+        }
+
+def update_backlog(application):
+    """Updates received but not yet being handled: still queued, or waiting in the update processor."""
+    backlog = application.update_queue.qsize()
+    if isinstance(application.update_processor, PerUserUpdateProcessor):
+        backlog += application.update_processor.waiting
+    return backlog
+
+def build_application(token, request=None):
+    """Build the Application and register every handler. request overrides the Bot API transport (used by the webhook harness)."""
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, max_pending=UPDATE_QUEUE_SIZE))
+        .persistence(SqliteUserDataPersistence(bot_state))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
 
     # Add handlers
     print("[DEBUG] Registering /start handler")
@@ -2336,6 +5071,9 @@ if __name__ == '__main__':
     print("[DEBUG] Registering /reset handler")
     app.add_handler(CommandHandler("reset", reset_streak))
     print("[DEBUG] Registered /reset handler")
+    print("[DEBUG] Registering /checkintime handler")
+    app.add_handler(CommandHandler("checkintime", set_checkin_time))
+    print("[DEBUG] Registered /checkintime handler")
     print("[DEBUG] Registering /milestones handler")
     app.add_handler(CommandHandler("milestones", check_milestones))
     print("[DEBUG] Registered /milestones handler")
@@ -2402,76 +5140,155 @@ if __name__ == '__main__':
     print("[DEBUG] Registering baseline permission callback handler")
     app.add_handler(CallbackQueryHandler(handle_baseline_permission_callback, pattern="^baseline_permission_"))
     print("[DEBUG] Registered baseline permission callback handler")
-    print("[DEBUG] All handlers registered. Starting scheduler and polling...")
-    loop = asyncio.get_event_loop()
-    scheduler = BackgroundScheduler()
-    
-    # Schedule daily check-ins at 9AM PHT (UTC+8)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_daily_checkins(app), loop),
-        CronTrigger(hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    # Schedule group prompts - all at 9AM PHT (UTC+8)
-    # General: Monday (text) + Friday (poll)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_general_monday_prompt(app), loop),
-        CronTrigger(day_of_week='mon', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_general_friday_prompt(app), loop),
-        CronTrigger(day_of_week='fri', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    # NoFap: Tuesday (text) + Thursday (poll)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_nofap_tuesday_prompt(app), loop),
-        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_nofap_thursday_prompt(app), loop),
-        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    # ScreenBreak: Tuesday (text) + Thursday (poll)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_screenbreak_tuesday_prompt(app), loop),
-        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_screenbreak_thursday_prompt(app), loop),
-        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    # GameBreak: Tuesday (text) + Thursday (poll)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_gamebreak_tuesday_prompt(app), loop),
-        CronTrigger(day_of_week='tue', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_gamebreak_thursday_prompt(app), loop),
-        CronTrigger(day_of_week='thu', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    # Moneytalk: Wednesday (text) + Saturday (poll)
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_moneytalk_wednesday_prompt(app), loop),
-        CronTrigger(day_of_week='wed', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    scheduler.add_job(
-        lambda: asyncio.run_coroutine_threadsafe(send_moneytalk_saturday_prompt(app), loop),
-        CronTrigger(day_of_week='sat', hour=9, minute=0, timezone='Asia/Manila')
-    )
-    
-    scheduler.start()
+    return app
+
+# --- Webhook mode ---
+# BOT_MODE=webhook serves updates from an HTTP endpoint instead of long polling,
+# so several replicas never compete for getUpdates
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+
+class TelegramWebhook:
+    """Minimal ASGI app that accepts Telegram updates and queues them for the Application.
+
+    POSTs to WEBHOOK_PATH must carry the secret token Telegram was given in
+    setWebhook. Updates are put on the Application's bounded update queue and
+    acknowledged immediately; when the backlog reaches UPDATE_QUEUE_SIZE the
+    request is answered with 503 so Telegram redelivers it later. GET /healthz
+    reports queue depth, update processor metrics, the release announcement's
+    progress, startup timings, response cache counters, GPT token usage and
+    GPT admission queue counters.
+    """
+
+    def __init__(self, application, secret_token, path=WEBHOOK_PATH):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.stats = {'accepted': 0, 'rejected': 0, 'queue_full': 0}
+
+    async def _respond(self, send, status, body=b""):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _read_body(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get('body', b"")
+            if len(body) > WEBHOOK_MAX_BODY_BYTES:
+                return None
+            if not message.get('more_body'):
+                return body
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['method'] == 'GET' and scope['path'] == '/healthz':
+            status = dict(self.stats, queued=self.application.update_queue.qsize(), backlog=update_backlog(self.application))
+            if isinstance(self.application.update_processor, PerUserUpdateProcessor):
+                status['processor'] = self.application.update_processor.stats()
+            status['announcement'] = await delivery_ledger.progress(announcement_run_id())
+            status['boot'] = boot_timings
+            status['response_cache'] = response_cache.stats()
+            status['gpt_usage'] = gpt_usage.stats()
+            status['gpt_admission'] = gpt_admission.stats()
+            await self._respond(send, 200, json.dumps(status).encode())
+            return
+        if scope['path'] != self.path:
+            await self._respond(send, 404)
+            return
+        if scope['method'] != 'POST':
+            await self._respond(send, 405)
+            return
+        headers = dict(scope['headers'])
+        token = headers.get(b'x-telegram-bot-api-secret-token', b"").decode('latin-1')
+        if not hmac.compare_digest(token, self.secret_token):
+            self.stats['rejected'] += 1
+            print("[DEBUG] Webhook request with a bad secret token rejected")
+            await self._respond(send, 403)
+            return
+        body = await self._read_body(receive)
+        if body is None:
+            self.stats['rejected'] += 1
+            await self._respond(send, 413)
+            return
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            self.stats['rejected'] += 1
+            print(f"[ERROR] Could not parse webhook update: {e}")
+            await self._respond(send, 400)
+            return
+        try:
+            if update_backlog(self.application) >= UPDATE_QUEUE_SIZE:
+                raise asyncio.QueueFull
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats['queue_full'] += 1
+            print("[ERROR] Update queue is full, asking Telegram to retry")
+            await self._respond(send, 503)
+            return
+        self.stats['accepted'] += 1
+        await self._respond(send, 200)
+
+async def run_webhook(application):
+    """Run the Application behind the webhook server until the process is asked to stop."""
+    import uvicorn  # only needed in webhook mode
+
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET")
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        print(f"[DEBUG] Webhook set, listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        server = uvicorn.Server(uvicorn.Config(
+            TelegramWebhook(application, WEBHOOK_SECRET),
+            host=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            lifespan="off",
+            log_level="warning"
+        ))
+        await server.serve()
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+boot_timings['import'] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+
+# ✅ Start app
+if __name__ == '__main__':
+    print("[DEBUG] Entered __main__ block")
+    print("[DEBUG] Starting bot setup...")
+    TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not TELEGRAM_BOT_TOKEN:
+        print("[ERROR] TELEGRAM_BOT_TOKEN environment variable is not set. Exiting.")
+        exit(1)
+    with boot_phase("build_application"):
+        app = build_application(TELEGRAM_BOT_TOKEN)
+    print("[DEBUG] All handlers registered. Scheduler starts with the application...")
     print("✅ Bot is running... waiting for Telegram messages.")
-    print("📅 Group prompts scheduled:")
-    print("   - General: Monday 9AM (text) + Friday 9AM (poll)")
-    print("   - NoFap: Tuesday 9AM (text) + Thursday 9AM (poll)")
-    print("   - ScreenBreak: Tuesday 9AM (text) + Thursday 9AM (poll)")
-    print("   - GameBreak: Tuesday 9AM (text) + Thursday 9AM (poll)")
-    print("   - Moneytalk: Wednesday 9AM (text) + Saturday 9AM (poll)")
-    print("[DEBUG] About to start polling loop")
-    # Announce update to all groups and users
-    loop.run_until_complete(announce_update(app))
-    app.run_polling()
+    loop = asyncio.get_event_loop()
+    if BOT_MODE == "webhook":
+        print("[DEBUG] About to start webhook server")
+        loop.run_until_complete(run_webhook(app))
+    else:
+        print("[DEBUG] About to start polling loop")
+        app.run_polling()
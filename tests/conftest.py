@@ -0,0 +1,21 @@
+"""Shared setup for the offline tests: nothing here talks to Telegram, Google Sheets or OpenAI."""
+import os
+import sys
+
+os.environ.setdefault("BOT_STATE_DB_PATH", ":memory:")
+os.environ.setdefault("ANNOUNCE_ON_DEPLOY", "0")
+os.environ.pop("OPENAI_API_KEY", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import mainv3wgpt as bot
+
+@pytest.fixture
+def store(monkeypatch):
+    """A fresh in-memory bot_state database, also installed as the module's bot_state."""
+    fresh = bot.BotStateStore(":memory:")
+    monkeypatch.setattr(bot, "bot_state", fresh)
+    yield fresh
+    if fresh._conn is not None:
+        fresh._conn.close()
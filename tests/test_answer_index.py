@@ -0,0 +1,72 @@
+import asyncio
+import sqlite3
+
+import mainv3wgpt as bot
+import build_answer_index
+
+NIGHT = "how do i handle urges at night"
+
+def context(habit="gaming", streak=9, group=""):
+    return {'fasting_target': habit, 'current_streak': streak, 'group': group}
+
+def partition(**kwargs):
+    return bot.answer_partition(*bot.answer_scope(context(**kwargs)))
+
+def test_answer_index_matches_paraphrases_within_a_partition():
+    index = bot.AnswerIndex.build([
+        (NIGHT, partition(), "Plan your evenings."),
+        (NIGHT, partition(habit="social media"), "Put the phone away."),
+        ("what should i eat for breakfast", partition(), "Not my area."),
+    ])
+    answer, similarity = index.lookup("How do I handle urges at night??", partition(habit="social media"), 0.8)
+    assert answer == "Put the phone away."
+    assert similarity > 0.99
+    assert index.lookup("how can i handle my urges at night", partition(), 0.5)[0] == "Plan your evenings."
+    assert index.lookup(NIGHT, partition(habit="porn"), 0.5) is None
+    assert index.lookup("completely unrelated words", partition(), 0.8) is None
+
+def test_answers_are_not_shared_across_streak_ranges_or_groups(tmp_path, monkeypatch):
+    index = bot.AnswerIndex.build([
+        (NIGHT, partition(streak=9), "A week in, keep it up."),
+        (NIGHT, partition(streak=9, group="Team A"), "Team A, evenings are hard."),
+    ])
+    path = tmp_path / "answer_index.npz"
+    index.save(path)
+    monkeypatch.setattr(bot, "answer_index", bot.AnswerIndex.load(path))
+    assert bot.similar_answer(NIGHT, context(streak=12)) == "A week in, keep it up."
+    assert bot.similar_answer(NIGHT, context(streak=40)) is None
+    assert bot.similar_answer(NIGHT, context(streak=9, group="team a")) == "Team A, evenings are hard."
+    assert bot.similar_answer(NIGHT, context(streak=9, group="Team B")) is None
+
+def test_logged_answers_are_built_per_scope_and_pruned(store):
+    asyncio.run(bot.log_answer(NIGHT, context(streak=9), "old answer"))
+    asyncio.run(bot.log_answer(NIGHT, context(streak=9), "new answer"))
+    asyncio.run(bot.log_answer(NIGHT, context(streak=40), "a month in"))
+    db = store.db()
+    with db:
+        db.execute(
+            "INSERT INTO gpt_answers (question, habit, answer, created_at) VALUES (?, 'gaming', 'unscoped', ?)",
+            (NIGHT, bot.utc_now_iso())
+        )
+        db.execute(
+            "INSERT INTO gpt_answers (question, habit, bucket, group_name, answer, created_at) "
+            "VALUES ('stale', 'gaming', 2, '', 'stale', '2020-01-01T00:00:00+00:00')"
+        )
+    assert build_answer_index.prune_answers(db, 30) == 1
+    pairs = build_answer_index.load_pairs(db, 30)
+    assert sorted(answer for _, _, answer in pairs) == ["a month in", "new answer"]
+    index = bot.AnswerIndex.build(pairs)
+    assert index.lookup(NIGHT, partition(streak=9), 0.8)[0] == "new answer"
+    assert index.lookup(NIGHT, partition(streak=40), 0.8)[0] == "a month in"
+
+def test_old_answer_log_gets_scope_columns(tmp_path):
+    path = str(tmp_path / "bot_state.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE gpt_answers (id INTEGER PRIMARY KEY, question TEXT NOT NULL, habit TEXT NOT NULL, "
+        "answer TEXT NOT NULL, created_at TEXT NOT NULL)"
+    )
+    conn.close()
+    db = bot.BotStateStore(path).db()
+    columns = {row[1] for row in db.execute("PRAGMA table_info(gpt_answers)")}
+    assert {"bucket", "group_name"} <= columns
@@ -0,0 +1,68 @@
+import asyncio
+import datetime
+
+import mainv3wgpt as bot
+
+UTC = datetime.timezone.utc
+ROWS = [
+    {'user_id': '1', 'timezone': 'UTC', 'checkin_time': '09:00'},
+    {'user_id': '2', 'timezone': 'UTC', 'checkin_time': '09:40'},
+]
+
+def at(hour, minute):
+    return datetime.datetime(2026, 5, 1, hour, minute, tzinfo=UTC)
+
+def due_users(slots, now):
+    return [row['user_id'] for row, _ in slots.due(ROWS, now)]
+
+def test_each_run_covers_the_minutes_since_the_last():
+    slots = bot.CheckinSlots()
+    assert due_users(slots, at(8, 59)) == []
+    assert due_users(slots, at(9, 0)) == ["1"]
+    assert due_users(slots, at(9, 39)) == []
+    assert due_users(slots, at(9, 45)) == ["2"]
+
+def test_user_gets_one_checkin_per_local_day():
+    slots = bot.CheckinSlots()
+    slots.due(ROWS, at(8, 59))
+    for row, local_date in slots.due(ROWS, at(9, 0)):
+        slots.mark_sent(row['user_id'], local_date)
+    slots._last_run = at(8, 0)
+    assert due_users(slots, at(9, 1)) == []
+
+def test_slots_missed_during_a_restart_are_caught_up(store):
+    async def scenario():
+        before = bot.CheckinSlots()
+        await before.load()
+        before.due(ROWS, at(8, 59))
+        await before.save()
+        after = bot.CheckinSlots()
+        await after.load()
+        return due_users(after, at(9, 45))
+
+    assert asyncio.run(scenario()) == ["1", "2"]
+
+def test_catch_up_is_capped(store):
+    async def scenario():
+        before = bot.CheckinSlots()
+        await before.load()
+        before.due(ROWS, at(0, 0))
+        await before.save()
+        after = bot.CheckinSlots()
+        await after.load()
+        return due_users(after, at(9, 20) + datetime.timedelta(minutes=bot.CHECKIN_CATCHUP_MINUTES))
+
+    assert asyncio.run(scenario()) == ["2"]
+
+def test_last_run_is_kept_in_scheduler_state(store):
+    async def scenario():
+        slots = bot.CheckinSlots()
+        slots.due(ROWS, at(9, 0))
+        await slots.save()
+
+    asyncio.run(scenario())
+    db = store.db()
+    assert db.execute("SELECT name, value FROM scheduler_state").fetchall() == [
+        ("checkin_last_run", at(9, 0).isoformat())
+    ]
+    assert db.execute("SELECT COUNT(*) FROM prompt_cursors").fetchone()[0] == 0
@@ -0,0 +1,107 @@
+import asyncio
+import datetime
+
+import mainv3wgpt as bot
+
+def items(run_id, user_ids):
+    return [(run_id, user_id, {'chat_id': user_id, 'text': 'hi'}) for user_id in user_ids]
+
+def test_plan_skips_users_already_in_the_run(store):
+    ledger = bot.DeliveryLedger(store)
+
+    async def scenario():
+        first = await ledger.plan(items("checkins:2026-05-01", [1, 2, 3]), "checkins")
+        again = await ledger.plan(items("checkins:2026-05-01", [2, 3, 4]), "checkins")
+        return first, again
+
+    first, again = asyncio.run(scenario())
+    assert [user_id for _, user_id, _ in first] == ["1", "2", "3"]
+    assert [user_id for _, user_id, _ in again] == ["4"]
+
+def test_pending_sends_are_resumed_from_stored_messages(store):
+    ledger = bot.DeliveryLedger(store, batch_size=100)
+
+    async def scenario():
+        await ledger.plan(items("announcement:r1", [1, 2, 3]), "announcement")
+        await ledger.record("announcement:r1", 1, "sent")
+        await ledger.flush()
+        await ledger.finish(["announcement:r1"])
+        return await ledger.resumable(), await ledger.progress("announcement:r1")
+
+    pending, progress = asyncio.run(scenario())
+    assert [(run_id, user_id) for run_id, user_id, _ in pending["announcement"]] == [
+        ("announcement:r1", "2"), ("announcement:r1", "3")
+    ]
+    assert pending["announcement"][0][2] == {'chat_id': 2, 'text': 'hi'}
+    assert progress == {'pending': 2, 'sent': 1, 'status': 'running'}
+
+def test_finished_run_is_done(store):
+    ledger = bot.DeliveryLedger(store)
+
+    async def scenario():
+        await ledger.plan(items("checkins:2026-05-01", [1, 2]), "checkins")
+        for user_id in (1, 2):
+            await ledger.record("checkins:2026-05-01", user_id, "sent")
+        await ledger.flush()
+        await ledger.finish(["checkins:2026-05-01"])
+        return await ledger.resumable(), await ledger.progress("checkins:2026-05-01")
+
+    pending, progress = asyncio.run(scenario())
+    assert pending == {}
+    assert progress == {'sent': 2, 'status': 'done'}
+
+def age_runs(store):
+    db = store.db()
+    with db:
+        db.execute("UPDATE delivery_runs SET updated_at = '2020-01-01T00:00:00+00:00'")
+
+def test_old_runs_expire_and_compact_but_stay_idempotent(store):
+    ledger = bot.DeliveryLedger(store)
+
+    async def scenario():
+        await ledger.plan(items("announcement:r1", [1, 2]), "announcement")
+        await ledger.record("announcement:r1", 1, "sent")
+        await ledger.flush()
+        age_runs(store)
+        pending = await ledger.resumable(max_age_hours=6)
+        replanned = await ledger.plan(items("announcement:r1", [1, 2, 3]), "announcement")
+        return pending, replanned
+
+    pending, replanned = asyncio.run(scenario())
+    assert pending == {}
+    assert replanned == []
+    db = store.db()
+    assert db.execute("SELECT status FROM delivery_runs").fetchall() == [("compacted",)]
+    assert db.execute("SELECT COUNT(*) FROM delivery_ledger").fetchone() == (0,)
+
+def test_todays_checkin_run_still_plans_later_users(store):
+    ledger = bot.DeliveryLedger(store)
+    run_id = f"checkins:{datetime.datetime.now(datetime.timezone.utc).date()}"
+
+    async def scenario():
+        await ledger.plan(items(run_id, [1]), "checkins")
+        await ledger.record(run_id, 1, "sent")
+        await ledger.flush()
+        await ledger.finish([run_id])
+        age_runs(store)
+        await ledger.resumable(max_age_hours=6)
+        return await ledger.plan(items(run_id, [1, 2]), "checkins")
+
+    assert [user_id for _, user_id, _ in asyncio.run(scenario())] == ["2"]
+
+def test_checkin_run_compacts_once_its_date_is_over(store):
+    ledger = bot.DeliveryLedger(store)
+    old_date = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=3)
+    run_id = f"checkins:{old_date}"
+
+    async def scenario():
+        await ledger.plan(items(run_id, [1]), "checkins")
+        await ledger.record(run_id, 1, "sent")
+        await ledger.flush()
+        await ledger.finish([run_id])
+        age_runs(store)
+        await ledger.resumable(max_age_hours=6)
+        return await ledger.plan(items(run_id, [1, 2]), "checkins")
+
+    assert asyncio.run(scenario()) == []
+    assert store.db().execute("SELECT status FROM delivery_runs").fetchall() == [("compacted",)]
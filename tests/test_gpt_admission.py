@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import mainv3wgpt as bot
+
+async def hold(admission, user_id, lane, order, release, timeout=5, on_wait=None):
+    async with admission.slot(user_id, lane, timeout, on_wait):
+        order.append(user_id)
+        await release.wait()
+
+def test_capacity_is_respected():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=2, busy_depth=100)
+        order, release = [], asyncio.Event()
+        tasks = [asyncio.create_task(hold(admission, f"u{i}", "lane", order, release)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        assert order == ["u0", "u1"]
+        assert admission.stats()['running'] == 2
+        assert admission.stats()['waiting'] == 3
+        release.set()
+        await asyncio.gather(*tasks)
+        assert admission.stats()['running'] == 0
+        assert admission.stats()['admitted'] == 5
+    asyncio.run(scenario())
+
+def test_lanes_take_turns():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=1, busy_depth=100)
+        order, release = [], asyncio.Event()
+        release.set()
+        blocker = asyncio.Event()
+        first = asyncio.create_task(hold(admission, "first", "nofap", order, blocker))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(hold(admission, f"n{i}", "nofap", order, release)) for i in range(4)]
+        tasks += [asyncio.create_task(hold(admission, f"g{i}", "gaming", order, release)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        blocker.set()
+        await asyncio.gather(first, *tasks)
+        assert order == ["first", "n0", "g0", "n1", "g1", "n2", "n3"]
+    asyncio.run(scenario())
+
+def test_newer_request_supersedes_waiting_one():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=1, busy_depth=100)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(admission, "other", "lane", order, release))
+        await asyncio.sleep(0)
+        older = asyncio.create_task(hold(admission, "u1", "lane", order, release))
+        await asyncio.sleep(0)
+        newer = asyncio.create_task(hold(admission, "u1", "lane", order, release))
+        await asyncio.sleep(0.01)
+        with pytest.raises(bot.GptSuperseded):
+            await older
+        release.set()
+        await asyncio.gather(running, newer)
+        assert order == ["other", "u1"]
+        assert admission.stats()['superseded'] == 1
+    asyncio.run(scenario())
+
+def test_supersede_hook_drops_waiting_request():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=1, busy_depth=100)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(admission, "other", "lane", order, release))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(hold(admission, 42, "lane", order, release))
+        await asyncio.sleep(0)
+        admission.supersede(42)
+        with pytest.raises(bot.GptSuperseded):
+            await waiting
+        release.set()
+        await running
+        assert admission.stats()['waiting'] == 0
+    asyncio.run(scenario())
+
+def test_queue_timeout_frees_the_place():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=1, busy_depth=100)
+        order, release = [], asyncio.Event()
+        running = asyncio.create_task(hold(admission, "other", "lane", order, release))
+        await asyncio.sleep(0)
+        with pytest.raises(bot.GptQueueTimeout):
+            await hold(admission, "late", "lane", order, release, timeout=0.05)
+        assert admission.stats()['waiting'] == 0
+        assert admission.stats()['timed_out'] == 1
+        release.set()
+        await running
+        assert admission.stats()['running'] == 0
+    asyncio.run(scenario())
+
+def test_busy_notice_only_behind_a_deep_queue():
+    async def scenario():
+        admission = bot.GptAdmission(capacity=1, busy_depth=2)
+        order, release, notified = [], asyncio.Event(), []
+
+        def notice(user_id):
+            async def on_wait():
+                notified.append(user_id)
+            return on_wait
+
+        tasks = [
+            asyncio.create_task(hold(admission, f"u{i}", "lane", order, release, on_wait=notice(f"u{i}")))
+            for i in range(4)
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert notified == ["u2", "u3"]
+    asyncio.run(scenario())
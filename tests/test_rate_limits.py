@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import mainv3wgpt as bot
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake monotonic clock; asyncio.sleep advances it instead of waiting."""
+    now = [0.0]
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(bot.asyncio, "sleep", sleep)
+    return now, slept
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    now, _ = clock
+    bucket = bot.TokenBucket(rate=4, capacity=5)
+    started = now[0]
+
+    async def scenario():
+        times = []
+        for _ in range(9):
+            await bucket.acquire()
+            times.append(now[0] - started)
+        return times
+
+    times = asyncio.run(scenario())
+    assert times[:5] == [0.0] * 5
+    assert times[5:] == [0.25, 0.5, 0.75, 1.0]
+
+def test_token_bucket_pause_holds_every_send(clock):
+    now, _ = clock
+    bucket = bot.TokenBucket(rate=10)
+    bucket.pause(3)
+    started = now[0]
+    asyncio.run(bucket.acquire())
+    assert now[0] - started >= 3
+
+def test_chat_limiter_spaces_messages_per_chat(clock):
+    now, slept = clock
+    limiter = bot.ChatRateLimiter(private_interval=1.0, group_interval=3.0)
+
+    async def scenario():
+        await limiter.acquire(5)
+        await limiter.acquire(6)
+        await limiter.acquire(-100)
+        await limiter.acquire(5)
+        await limiter.acquire(-100)
+
+    asyncio.run(scenario())
+    # Different chats don't wait on each other; the same chat waits its interval
+    assert slept == [1.0, 2.0]
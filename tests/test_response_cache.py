@@ -0,0 +1,69 @@
+import random
+
+import mainv3wgpt as bot
+
+CONTEXT = {'fasting_target': 'Gaming', 'current_streak': 9, 'group': 'GameBreak'}
+
+def test_key_normalizes_and_buckets_the_streak():
+    cache = bot.ResponseCache(ttl=60, max_entries=10, max_words=12, variants=1)
+    key = cache.key("Any tips??", CONTEXT)
+    assert key == ("any tips", "gaming", 2, "gamebreak")
+    assert cache.key("any tips", dict(CONTEXT, current_streak=13)) == key
+    assert cache.key("any tips", dict(CONTEXT, current_streak=14)) != key
+    assert cache.key("word " * 13, CONTEXT) is None
+
+def test_streak_bucket_labels():
+    assert bot.streak_bucket({'current_streak': 0}) == (0, "0 days")
+    assert bot.streak_bucket({'current_streak': 9}) == (2, "7-13 days")
+    assert bot.streak_bucket({'current_streak': 400}) == (6, "90+ days")
+    assert bot.streak_bucket({'current_streak': "oops"}) == (0, "0 days")
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    cache = bot.ResponseCache(ttl=60, max_entries=10, max_words=12, variants=1)
+    key = cache.key("any tips", CONTEXT)
+    cache.put(key, "Try a walk.")
+    assert cache.get(key) == "Try a walk."
+    now[0] += 61
+    assert cache.get(key) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_least_recently_used_entry_is_evicted():
+    cache = bot.ResponseCache(ttl=60, max_entries=2, max_words=12, variants=1)
+    keys = [cache.key(question, CONTEXT) for question in ("one", "two", "three")]
+    cache.put(keys[0], "a")
+    cache.put(keys[1], "b")
+    cache.get(keys[0])
+    cache.put(keys[2], "c")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == "a"
+    assert cache.get(keys[2]) == "c"
+
+def test_variants_are_collected_before_hits():
+    random.seed(0)
+    cache = bot.ResponseCache(ttl=60, max_entries=10, max_words=12, variants=2)
+    key = cache.key("any tips", CONTEXT)
+    cache.put(key, "a")
+    assert cache.get(key) is None
+    cache.put(key, "a")
+    assert cache.get(key) is None
+    cache.put(key, "b")
+    assert {cache.get(key) for _ in range(20)} == {"a", "b"}
+
+def test_uncached_prompt_sends_only_the_streak_range():
+    _, request = bot.build_chatgpt_request("any tips for the weekend?", CONTEXT)
+    assert "Current streak: 7-13 days" in request['messages'][1]['content']
+    _, request = bot.build_chatgpt_request("any tips for the weekend?", CONTEXT, [{"role": "user", "content": "hi"}])
+    assert "Current streak: 9 days" in request['messages'][1]['content']
+
+def test_idle_conversation_is_forgotten(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    memory = bot.ConversationMemory(token_budget=800, min_turns=2, max_users=10, max_bytes=10 ** 6, idle_seconds=60)
+    memory.add_exchange(1, "hi", "hello")
+    assert len(memory.history(1)) == 2
+    now[0] += 61
+    assert memory.history(1) == []
+    assert memory._bytes == 0
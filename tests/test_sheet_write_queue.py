@@ -0,0 +1,131 @@
+import asyncio
+import contextlib
+
+import gspread
+
+import mainv3wgpt as bot
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = "error"
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': 'error', 'status': 'ERROR'}}
+
+def api_error(status_code):
+    return gspread.exceptions.APIError(FakeResponse(status_code))
+
+class FakeSheet:
+    def __init__(self):
+        self.rows = []
+        self.cells = {}
+        self.calls = 0
+        self.fail = None  # rows -> exception to raise, or None
+
+    def append_rows(self, rows):
+        self.calls += 1
+        error = self.fail(rows) if self.fail else None
+        if error is not None:
+            raise error
+        self.rows += rows
+
+    def batch_update(self, data, raw=True):
+        self.calls += 1
+        for item in data:
+            self.cells[item['range']] = item['values'][0][0]
+
+class FakeRegistry:
+    def __init__(self, *names):
+        self.sheets = {name: FakeSheet() for name in names}
+
+    @contextlib.contextmanager
+    def using(self, name):
+        yield self.sheets[name]
+
+def make_queue(max_attempts=3):
+    registry = FakeRegistry("users", "checkins", "feedback")
+    return bot.SheetWriteQueue(1, 100, registry, max_attempts=max_attempts), registry.sheets
+
+def unsent(store):
+    return store.db().execute("SELECT sheet, reason FROM unsent_sheet_writes ORDER BY id").fetchall()
+
+def test_batches_one_call_per_sheet_and_kind(store):
+    queue, sheets = make_queue()
+    for i in range(5):
+        queue.append_row("checkins", [i, "yes"])
+    queue.update_cell("users", 2, 3, "a")
+    queue.update_cell("users", 2, 3, "b")
+    assert asyncio.run(queue.flush())
+    assert sheets["checkins"].rows == [[i, "yes"] for i in range(5)]
+    assert sheets["checkins"].calls == 1
+    assert sheets["users"].cells == {"C2": "b"}
+    assert sheets["users"].calls == 1
+    assert queue.pending_count() == 0
+
+def test_transient_error_backs_off_only_that_sheet(store):
+    queue, sheets = make_queue()
+    sheets["checkins"].fail = lambda rows: api_error(429)
+    queue.append_row("checkins", ["a"])
+    queue.append_row("checkins", ["b"])
+    queue.append_row("feedback", ["f1"])
+
+    async def scenario():
+        assert not await queue.flush()
+        queue.append_row("feedback", ["f2"])
+        await queue.flush()
+
+    asyncio.run(scenario())
+    assert sheets["feedback"].rows == [["f1"], ["f2"]]
+    assert [op['row'] for op in queue.pending("checkins")] == [["a"], ["b"]]
+    sheets["checkins"].fail = None
+    queue._retry_at.clear()
+    assert asyncio.run(queue.flush())
+    assert sheets["checkins"].rows == [["a"], ["b"]]
+
+def test_rejected_write_is_set_aside_and_the_rest_written(store):
+    queue, sheets = make_queue()
+    sheets["checkins"].fail = lambda rows: api_error(400) if ["bad"] in rows else None
+    for row in (["a"], ["bad"], ["c"]):
+        queue.append_row("checkins", row)
+    assert asyncio.run(queue.flush())
+    assert sheets["checkins"].rows == [["a"], ["c"]]
+    assert queue.dead_lettered == 1
+    assert unsent(store)[0][0] == "checkins"
+    assert unsent(store)[0][1].startswith("rejected")
+
+def test_gives_up_after_max_attempts(store):
+    queue, sheets = make_queue(max_attempts=3)
+    sheets["checkins"].fail = lambda rows: api_error(503)
+    queue.append_row("checkins", ["a"])
+
+    async def scenario():
+        for _ in range(3):
+            queue._retry_at.clear()
+            await queue.flush()
+
+    asyncio.run(scenario())
+    assert queue.pending_count() == 0
+    assert queue.dead_lettered == 1
+    assert unsent(store)[0][1].startswith("gave up after 3 attempts")
+
+def test_stop_saves_unflushed_writes_for_the_next_start(store, monkeypatch):
+    queue, sheets = make_queue(max_attempts=100)
+    sheets["checkins"].fail = lambda rows: api_error(503)
+    queue.append_row("checkins", ["a"])
+    queue.update_cell("checkins", 4, 1, "x")
+
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(bot.asyncio, "sleep", no_sleep)
+    asyncio.run(queue.stop())
+    assert [reason for _, reason in unsent(store)] == ["shutdown", "shutdown"]
+
+    restarted, sheets = make_queue()
+    asyncio.run(restarted._restore_unsent())
+    assert [op['kind'] for op in restarted.pending("checkins")] == ["append", "update"]
+    assert asyncio.run(restarted.flush())
+    assert sheets["checkins"].rows == [["a"]]
+    assert sheets["checkins"].cells == {"A4": "x"}
+    assert unsent(store) == []
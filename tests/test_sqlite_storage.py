@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import mainv3wgpt as bot
+
+class FakeWrites:
+    def __init__(self):
+        self.rows = []
+
+    def pending_count(self):
+        return 0
+
+    def append_row(self, sheet, row):
+        self.rows.append((sheet, row))
+
+    async def flush(self):
+        return True
+
+class FakeMirror:
+    """Stands in for SheetsStorage: list_users() fails `failures` times before answering."""
+
+    def __init__(self, users=(), failures=0):
+        self.users = {user['user_id']: dict(user) for user in users}
+        self.failures = failures
+        self.calls = 0
+        self.writes = FakeWrites()
+
+    async def list_users(self):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise OSError("quota exceeded")
+        return list(self.users.values())
+
+    async def update_user_fields(self, user_id, fields):
+        if str(user_id) not in self.users:
+            return False
+        self.users[str(user_id)].update({column.lower(): value for column, value in fields.items()})
+        return True
+
+    async def upsert_user(self, user_id, fields):
+        self.users[str(user_id)] = dict({column.lower(): value for column, value in fields.items()}, user_id=str(user_id))
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    async def sleep(seconds):
+        pass
+    monkeypatch.setattr(bot.asyncio, "sleep", sleep)
+
+@pytest.fixture
+def no_sheet_history(monkeypatch):
+    monkeypatch.setattr(bot, "read_checkin_history", lambda: [{"user_id": "1", "status": "yes", "timestamp": "2026-05-01 09:00:00"}])
+
+def test_users_and_checkins_offline(tmp_path):
+    async def scenario():
+        storage = bot.SqliteStorage(str(tmp_path / "bot.db"))
+        await storage.start()
+        await storage.upsert_user(1, {'USERNAME': 'ana', 'STATUS': 'active'})
+        await storage.upsert_user(2, {'USERNAME': 'ben'})
+        updated = await storage.update_user_fields(1, {'STATUS': 'stopped'})
+        unknown = await storage.update_user_fields(3, {'STATUS': 'active'})
+        await storage.append_checkin(1, "yes", "2026-05-01 09:00:00")
+        await storage.append_checkin(1, "yes", "2026-05-02 09:00:00")
+        user = await storage.get_user(1)
+        users = await storage.list_users()
+        await storage.stop()
+        reopened = bot.SqliteStorage(str(tmp_path / "bot.db"))
+        await reopened.start()
+        streak = await reopened.get_streak(1)
+        await reopened.stop()
+        return updated, unknown, user, users, streak
+
+    updated, unknown, user, users, streak = asyncio.run(scenario())
+    assert updated and not unknown
+    assert user['username'] == 'ana' and user['status'] == 'stopped'
+    assert [row['user_id'] for row in users] == ['1', '2']
+    assert streak['current_streak'] == 2
+
+def test_writes_are_replicated_to_the_mirror_in_order(tmp_path, no_sheet_history):
+    async def scenario():
+        mirror = FakeMirror(users=[{'user_id': '1', 'username': 'ana'}])
+        storage = bot.SqliteStorage(str(tmp_path / "bot.db"), mirror=mirror, replication_interval=3600)
+        await storage.start()
+        await storage.upsert_user(2, {'USERNAME': 'ben'})
+        await storage.update_user_fields(1, {'STATUS': 'active'})
+        await storage.append_checkin(2, "no", "2026-05-02 09:00:00")
+        assert await storage.replicate_once()
+        left = await storage._run(storage._read_outbox, 10)
+        await storage.stop()
+        return mirror, left
+
+    mirror, left = asyncio.run(scenario())
+    assert mirror.users['1']['status'] == 'active'
+    assert mirror.users['2']['username'] == 'ben'
+    assert mirror.writes.rows == [("checkins", ["2", "no", "2026-05-02 09:00:00"])]
+    assert left == []
+
+def test_empty_store_is_seeded_after_transient_failures(tmp_path, no_sleep, no_sheet_history):
+    async def scenario():
+        mirror = FakeMirror(users=[{'user_id': '1', 'username': 'ana'}], failures=2)
+        storage = bot.SqliteStorage(str(tmp_path / "bot.db"), mirror=mirror, replication_interval=3600, seed_attempts=5)
+        await storage.start()
+        users = await storage.list_users()
+        streak = await storage.get_streak(1)
+        await storage.stop()
+        return mirror, users, streak
+
+    mirror, users, streak = asyncio.run(scenario())
+    assert mirror.calls == 3
+    assert [row['username'] for row in users] == ['ana']
+    assert streak['current_streak'] == 1
+
+def test_startup_fails_rather_than_serve_an_unseeded_store(tmp_path, no_sleep, no_sheet_history):
+    async def scenario():
+        mirror = FakeMirror(users=[{'user_id': '1'}], failures=10)
+        storage = bot.SqliteStorage(str(tmp_path / "bot.db"), mirror=mirror, seed_attempts=3)
+        with pytest.raises(RuntimeError):
+            await storage.start()
+        assert storage._task is None
+        return mirror
+
+    assert asyncio.run(scenario()).calls == 3
@@ -0,0 +1,43 @@
+import mainv3wgpt as bot
+
+def history(*entries):
+    return [{"user_id": user_id, "status": status, "timestamp": timestamp} for user_id, status, timestamp in entries]
+
+def test_rebuild_counts_current_streak_and_misses():
+    engine = bot.StreakEngine()
+    engine.rebuild(history(
+        ("1", "yes", "2026-05-01 09:00:00"),
+        ("1", "yes", "2026-05-02 09:00:00"),
+        ("1", "no", "2026-05-03 09:00:00"),
+        ("1", "yes", "2026-05-04 09:00:00"),
+        ("1", "yes", "2026-05-05 09:00:00"),
+        ("2", "no", "2026-05-04 09:00:00"),
+        ("2", "no", "2026-05-05 09:00:00"),
+    ))
+    assert engine.get(1) == {
+        'current_streak': 2, 'last_status': 'yes', 'consecutive_no': 0, 'last_checkin_date': '2026-05-05'
+    }
+    assert engine.get("2")['current_streak'] == 0
+    assert engine.get("2")['consecutive_no'] == 2
+
+def test_reset_breaks_both_runs():
+    engine = bot.StreakEngine()
+    engine.rebuild(history(("1", "yes", "2026-05-01"), ("1", "no", "2026-05-02"), ("1", "reset", "2026-05-03")))
+    assert engine.get("1")['current_streak'] == 0
+    assert engine.get("1")['consecutive_no'] == 0
+
+def test_record_updates_counters_once_loaded():
+    engine = bot.StreakEngine()
+    engine.record("1", "yes", "2026-05-01 09:00:00")
+    assert engine.get("1") == bot.StreakEngine.empty_state()
+    engine.rebuild([])
+    engine.record("1", "yes", "2026-05-01 09:00:00")
+    engine.record("1", "yes", "2026-05-02 09:00:00")
+    assert engine.get("1")['current_streak'] == 2
+    assert engine.get("1")['last_checkin_date'] == "2026-05-02"
+
+def test_get_returns_a_copy():
+    engine = bot.StreakEngine()
+    engine.rebuild(history(("1", "yes", "2026-05-01")))
+    engine.get("1")['current_streak'] = 99
+    assert engine.get("1")['current_streak'] == 1
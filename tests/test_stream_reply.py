@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import mainv3wgpt as bot
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+        return SimpleNamespace(edit_text=self._edit)
+
+    async def _edit(self, text):
+        self.replies.append(text)
+
+
+class FakeStream:
+    def __init__(self, pieces, fail_after=None):
+        self.pieces = pieces
+        self.fail_after = fail_after
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for n, piece in enumerate(self.pieces):
+            if n == self.fail_after:
+                raise ConnectionError("connection reset")
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def openai_stream(monkeypatch):
+    holder = {}
+
+    async def create(**kwargs):
+        return holder["stream"]
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(bot, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(bot, "get_openai_client", lambda: client)
+    monkeypatch.setattr(bot, "stored_answer", lambda q, ctx, history: (None, ("key",)))
+    monkeypatch.setattr(bot.response_cache, "put", lambda key, answer: None)
+
+    async def no_log(*args):
+        return None
+
+    monkeypatch.setattr(bot, "log_answer", no_log)
+    return holder
+
+
+def test_stream_closed_after_full_reply(openai_stream):
+    openai_stream["stream"] = stream = FakeStream(["Keep ", "going!"])
+    message = FakeMessage()
+    asyncio.run(bot.stream_chatgpt_reply(message, "how do I stay consistent?", {"habit": "running"}))
+    assert stream.closed
+    assert message.replies[-1] == "Keep going!"
+
+
+def test_stream_closed_when_cut_short(openai_stream):
+    openai_stream["stream"] = stream = FakeStream(["Keep ", "going!"], fail_after=1)
+    message = FakeMessage()
+    asyncio.run(bot.stream_chatgpt_reply(message, "how do I stay consistent?", {"habit": "running"}))
+    assert stream.closed
+    assert message.replies == ["Keep"]
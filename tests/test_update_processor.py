@@ -0,0 +1,92 @@
+import asyncio
+from types import SimpleNamespace
+
+import mainv3wgpt as bot
+
+def update(user_id, text=None):
+    message = SimpleNamespace(text=text) if text else None
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=None, message=message)
+
+def test_one_users_updates_run_in_order_while_others_run_alongside():
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(concurrency=4, max_pending=100)
+        await processor.initialize()
+        log = []
+
+        async def handle(name, delay):
+            log.append(f"start {name}")
+            await asyncio.sleep(delay)
+            log.append(f"end {name}")
+
+        await asyncio.gather(
+            processor.do_process_update(update(1), handle("1a", 0.05)),
+            processor.do_process_update(update(1), handle("1b", 0)),
+            processor.do_process_update(update(2), handle("2a", 0)),
+        )
+        return log, processor.stats()
+
+    log, stats = asyncio.run(scenario())
+    assert log.index("end 1a") < log.index("start 1b")
+    assert log.index("end 2a") < log.index("end 1a")
+    assert stats['running'] == 0
+    assert stats['processed'] == 3
+
+def test_concurrency_is_bounded():
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(concurrency=2, max_pending=100)
+        await processor.initialize()
+        peak = [0]
+
+        async def handle():
+            peak[0] = max(peak[0], processor.running)
+            await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(processor.do_process_update(update(i), handle()) for i in range(6)))
+        return peak[0]
+
+    assert asyncio.run(scenario()) == 2
+
+def test_released_slot_lets_others_run_and_is_taken_back():
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(concurrency=1, max_pending=100)
+        await processor.initialize()
+        log = []
+
+        async def slow_gpt():
+            async with processor.released_slot():
+                log.append("waiting on gpt")
+                await asyncio.sleep(0.05)
+            log.append("gpt done")
+
+        async def quick():
+            log.append("quick")
+
+        await asyncio.gather(
+            processor.do_process_update(update(1), slow_gpt()),
+            processor.do_process_update(update(2), quick()),
+        )
+        return log, processor.stats()
+
+    log, stats = asyncio.run(scenario())
+    assert log == ["waiting on gpt", "quick", "gpt done"]
+    assert stats['running'] == 0
+
+def test_new_message_supersedes_the_users_queued_gpt_request(monkeypatch):
+    superseded = []
+    monkeypatch.setattr(bot.gpt_admission, "supersede", superseded.append)
+
+    async def scenario():
+        processor = bot.PerUserUpdateProcessor(concurrency=4, max_pending=100)
+        await processor.initialize()
+
+        async def handle():
+            await asyncio.sleep(0.01)
+
+        await asyncio.gather(
+            processor.do_process_update(update(7, "first"), handle()),
+            processor.do_process_update(update(7, "/checkin"), handle()),
+            processor.do_process_update(update(7, "second"), handle()),
+        )
+
+    asyncio.run(scenario())
+    assert superseded == [7]
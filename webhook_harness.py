@@ -0,0 +1,150 @@
+"""Offline webhook harness: POSTs synthetic Telegram updates at the bot and measures update-to-reply latency.
+
+Nothing here talks to Telegram. Bot API calls made by the handlers are answered
+by a fake transport that records when each reply was sent. By default the
+updates go straight into the webhook ASGI app in-process; pass --url to POST
+them to a bot already running with BOT_MODE=webhook instead (latency is then
+only measured up to the HTTP response, since the replies go to that process).
+
+    STORAGE_BACKEND=sqlite SQLITE_MIRROR_TO_SHEETS=0 python webhook_harness.py --updates 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import httpx
+from telegram.request import BaseRequest
+
+os.environ.setdefault("WEBHOOK_SECRET", "harness-secret")
+os.environ.setdefault("BOT_STATE_DB_PATH", ":memory:")
+os.environ.setdefault("ANNOUNCE_ON_DEPLOY", "0")
+
+import mainv3wgpt as bot
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Harness", "username": "harness_bot"}
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally and records when each chat got a message."""
+
+    def __init__(self):
+        self.replies = {}
+        self.calls = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText", "sendPhoto", "sendVideo", "sendPoll"):
+            self._message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            self.replies.setdefault(chat_id, time.perf_counter())
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def synthetic_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+
+async def post_updates(client, url, count, first_user_id, text):
+    posted = {}
+    statuses = {}
+    for i in range(count):
+        user_id = first_user_id + i
+        posted[user_id] = time.perf_counter()
+        response = await client.post(
+            url,
+            json=synthetic_update(i + 1, user_id, text),
+            headers={"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET},
+        )
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return posted, statuses
+
+def summarize(label, samples):
+    if not samples:
+        print(f"{label}: no samples")
+        return
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label}: n={len(samples)} p50={statistics.median(samples) * 1000:.1f}ms p95={p95 * 1000:.1f}ms max={samples[-1] * 1000:.1f}ms")
+
+async def run_in_process(args):
+    fake = FakeTelegramRequest()
+    application = bot.build_application("0:harness", request=fake)
+    webhook = bot.TelegramWebhook(application, bot.WEBHOOK_SECRET)
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        transport = httpx.ASGITransport(app=webhook)
+        async with httpx.AsyncClient(transport=transport, base_url="http://harness") as client:
+            started = time.perf_counter()
+            posted, statuses = await post_updates(client, bot.WEBHOOK_PATH, args.updates, args.first_user_id, args.text)
+            deadline = time.perf_counter() + args.timeout
+            while len(fake.replies) < len(posted) and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+        await application.stop()
+        await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    print(f"HTTP statuses: {statuses}")
+    print(f"Replies: {len(fake.replies)}/{len(posted)} in {elapsed:.2f}s ({fake.calls} Bot API calls)")
+    summarize("update-to-reply", [fake.replies[uid] - t for uid, t in posted.items() if uid in fake.replies])
+    print(f"Webhook stats: {webhook.stats}")
+
+async def run_against_url(args):
+    async with httpx.AsyncClient() as client:
+        started = time.perf_counter()
+        latencies = []
+        statuses = {}
+        for i in range(args.updates):
+            sent = time.perf_counter()
+            response = await client.post(
+                args.url,
+                json=synthetic_update(i + 1, args.first_user_id + i, args.text),
+                headers={"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET},
+            )
+            latencies.append(time.perf_counter() - sent)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    print(f"HTTP statuses: {statuses} in {time.perf_counter() - started:.2f}s")
+    summarize("POST round trip", latencies)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=50, help="number of synthetic updates to send")
+    parser.add_argument("--text", default="hello", help="message text each synthetic user sends")
+    parser.add_argument("--first-user-id", type=int, default=900000001)
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for all replies")
+    parser.add_argument("--url", help="POST to a running webhook server instead of the in-process app")
+    args = parser.parse_args()
+    asyncio.run(run_against_url(args) if args.url else run_in_process(args))